@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+# Adaptive (inverse-variance weighted) stacking of band images, shared
+# by makecat.py and convolve_combine.py. Bands are read through memory
+# maps a block of rows at a time, and the uncorrected and corrected
+# images of each band are added in the same pass, so only the two
+# output accumulators are ever held in memory.
+
+import threading
+import numpy as np
+from astropy.io import fits
+
+def prefetch(filenames,bufsize=16*1024*1024):
+
+    '''
+    Read the given files sequentially in a background thread, so that
+    they are in the page cache by the time they are memory-mapped.
+    Returns the thread, which should be joined.
+    '''
+
+    def reader():
+        for f in filenames:
+            try:
+                infile=open(f,'rb')
+                while infile.read(bufsize):
+                    pass
+                infile.close()
+            except IOError:
+                pass
+
+    th=threading.Thread(target=reader)
+    th.daemon=True
+    th.start()
+    return th
+
+def adaptive_stack(pairs,weights,outname,coutname,template,ctemplate,tilerows=512,dtype=np.float32):
+
+    '''
+    Make the weighted means of the uncorrected and corrected images in
+    pairs, a list of (image,corrected image) filenames, with the given
+    weights (normally 1/rms**2). The results are written to outname and
+    coutname with the headers of template and ctemplate respectively.
+    tilerows rows of each image are read at a time; dtype is the type of
+    the accumulators.
+    '''
+
+    s=None
+    sc=None
+    w=0
+    fetch=prefetch(pairs[0])
+    for k,((iname,cname),weight) in enumerate(zip(pairs,weights)):
+        fetch.join()
+        if k+1<len(pairs):
+            fetch=prefetch(pairs[k+1])
+        ihdu=fits.open(iname,memmap=True)
+        chdu=fits.open(cname,memmap=True)
+        image=ihdu[0].data[0,0]
+        cimage=chdu[0].data[0,0]
+        if s is None:
+            s=np.zeros(image.shape,dtype=dtype)
+            sc=np.zeros(image.shape,dtype=dtype)
+        ny=image.shape[0]
+        for r0 in range(0,ny,tilerows):
+            r1=min(r0+tilerows,ny)
+            s[r0:r1]+=image[r0:r1].astype(dtype)*weight
+            sc[r0:r1]+=cimage[r0:r1].astype(dtype)*weight
+        del image,cimage
+        ihdu.close()
+        chdu.close()
+        w+=weight
+
+    s/=w
+    sc/=w
+    for data,name,tname in ((s,outname,template),(sc,coutname,ctemplate)):
+        header=fits.getheader(tname)
+        hdu=fits.PrimaryHDU(data=data.astype(np.float32).reshape((1,1)+data.shape),header=header)
+        hdu.writeto(name,clobber=True)
@@ -137,8 +137,9 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     approaches, such as moving averages techniques.
     Parameters
     ----------
-    y : array_like, shape (N,)
-        the values of the time history of the signal.
+    y : array_like, shape (..., N)
+        the values of the time history of the signal. Arrays of
+        more than one dimension are smoothed along the last axis.
     window_size : int
         the length of the window. Must be an odd integer number.
     order : int
@@ -148,7 +149,7 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
         the order of the derivative to compute (default = 0 means only smoothing)
     Returns
     -------
-    ys : ndarray, shape (N)
+    ys : ndarray, shape (..., N)
         the smoothed signal (or it's n-th derivative).
     Notes
     -----
@@ -178,6 +179,24 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
        Cambridge University Press ISBN-13: 9780521880688
     """
     import numpy as np
+
+    m = savitzky_golay_coeffs(window_size, order, deriv, rate)
+    half_window = (len(m) -1) // 2
+    # pad the signal at the extremes with
+    # values taken from the signal itself
+    y = np.asarray(y)
+    firstvals = y[...,:1] - np.abs( y[...,1:half_window+1][...,::-1] - y[...,:1] )
+    lastvals = y[...,-1:] + np.abs(y[...,-half_window-1:-1][...,::-1] - y[...,-1:])
+    y = np.concatenate((firstvals, y, lastvals), axis=-1)
+    # one correlation along the last axis for all the signals at once
+    ys = scipy.ndimage.correlate1d(y, m, axis=-1, mode='constant')
+    return ys[...,half_window:-half_window]
+
+def savitzky_golay_coeffs(window_size, order, deriv=0, rate=1):
+    """Return the Savitzky-Golay filter coefficients used by
+    savitzky_golay, such that ys[n] = sum(m * y[n-half_window:n+half_window+1]).
+    """
+    import numpy as np
     from math import factorial
     
     try:
@@ -193,87 +212,23 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     half_window = (window_size -1) // 2
     # precompute coefficients
     b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
-    # pad the signal at the extremes with
-    # values taken from the signal itself
-    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve( m[::-1], y, mode='valid')
-    
-def median_window_filter(ampl, half_window, threshold):
-    ampl_tot_copy = numpy.copy(ampl)
-    ndata = len(ampl)
-    flags = numpy.zeros(ndata, dtype=bool)
-    sol = numpy.zeros(ndata+2*half_window)
-    sol[half_window:half_window+ndata] = ampl
-
-    for i in range(0, half_window):
-        # Mirror at left edge.
-        idx = min(ndata-1, half_window-i)
-        sol[i] = ampl[idx]
-
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        sol[ndata+half_window+i] = ampl[idx]
-
-    #fix oct 2012
-    median_array  = scipy.signal.medfilt(sol,half_window*2.-1)
-
-    sol_flag = numpy.zeros(ndata+2*half_window, dtype=bool)
-    sol_flag_val = numpy.zeros(ndata+2*half_window, dtype=bool)
-
-    for i in range(half_window, half_window + ndata):
-        # Compute median of the absolute distance to the median.
-        window = sol[i-half_window:i+half_window+1]
-        window_flag = sol_flag[i-half_window:i+half_window+1]
-        window_masked = window[~window_flag]
-
-        if len(window_masked) < math.sqrt(len(window)):
-            # Not enough data to get accurate statistics.
-            continue
-
-        median = numpy.median(window_masked)
-        q = 1.4826 * numpy.median(numpy.abs(window_masked - median))
-
-        # Flag sample if it is more than 1.4826 * threshold * the
-        # median distance away from the median.
-        if abs(sol[i] - median) > (threshold * q):
-            sol_flag[i] = True
-
-    mask = sol_flag[half_window:half_window + ndata]
-
-    for i in range(len(mask)):
-        if mask[i]:
-           ampl_tot_copy[i] = median_array[half_window+i] # fixed 2012
-    return ampl_tot_copy
-    
-    
-def running_median(ampl,half_window) :
-
-    ampl_tot_copy = numpy.copy(ampl)
-
-    ndata = len(ampl)
-    flags = numpy.zeros(ndata, dtype=bool)
-    sol = numpy.zeros(ndata+2*half_window)
-    sol[half_window:half_window+ndata] = ampl
-    std = numpy.zeros(len(ampl))
+    return np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
 
-    for i in range(0, half_window):
-        # Mirror at left edge.
-        idx = min(ndata-1, half_window-i)
-        sol[i] = ampl[idx]
-
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        sol[ndata+half_window+i] = ampl[idx]
+def interpolate_freq(freqs, amps, freqs_new):
+    """Linearly interpolate amps along its last axis from freqs onto
+    freqs_new, giving NaN outside the range of freqs, as
+    interp1d(kind='slinear',bounds_error=False) does, but for all the
+    leading axes at once.
+    """
+    order = numpy.argsort(freqs)
+    f = numpy.asarray(freqs)[order]
+    amps = amps[...,order]
+    i = numpy.clip(numpy.searchsorted(f, freqs_new), 1, len(f)-1)
+    w = (freqs_new - f[i-1])/(f[i] - f[i-1])
+    result = amps[...,i-1] + (amps[...,i] - amps[...,i-1])*w
+    result[...,(freqs_new < f[0]) | (freqs_new > f[-1])] = numpy.nan
+    return result
     
-    for i in range(len(ampl)):
-      #print i, i+half_window
-      std[i] =  numpy.median(sol[i:i+(2*half_window)])  
-
-    return std
-
 
 ionmodel = h5parm(globaldbname ,readonly=True)
 amptab = ionmodel.getSoltab('sol000','amplitude000')
@@ -381,18 +336,15 @@ if make_matrixplot:
         fp.savefig('matrix_yy.png')
         
        
-for antenna_id in range(0,len(amptab.ant[:])):
- amp_xx_tmp = numpy.copy(amplitude_array[0,source_id,antenna_id,:,:])# array(time, freq)
- amp_yy_tmp = numpy.copy(amplitude_array[1,source_id,antenna_id,:,:]) # array(time, freq)
-        
- amp_xx = numpy.copy(amp_xx_tmp[goodfreq_el,:])
- amp_yy = numpy.copy(amp_yy_tmp[goodfreq_el,:])
- 
- print 'Doing', amptab.ant[antenna_id]
-         
- if show_plot:
-   minscale = numpy.median(amp_xx)*0.3
-   maxscale = numpy.median(amp_xx)*2.0
+# (pol, antenna, subband, time) cube of the good subbands
+amp_cube = numpy.copy(amplitude_array[:,source_id][:,:,goodfreq_el,:])
+scales = [(numpy.median(amp_cube[0,antenna_id])*0.3, numpy.median(amp_cube[0,antenna_id])*2.0) for antenna_id in range(0,len(amptab.ant[:]))]
+
+if show_plot:
+ for antenna_id in range(0,len(amptab.ant[:])):
+   amp_xx = amp_cube[0,antenna_id]
+   amp_yy = amp_cube[1,antenna_id]
+   minscale, maxscale = scales[antenna_id]
    subplots_adjust(wspace = 0.6)
 
    matplotlib.pyplot.subplot(121)
@@ -413,14 +365,17 @@ for antenna_id in range(0,len(amptab.ant[:])):
    matplotlib.pyplot.close()
    matplotlib.pyplot.cla()
 
- #print np.shape(amp_xx),'asdfdf'
- amp_xx = scipy.ndimage.filters.median_filter(amp_xx, (3,3))
- amp_xx = scipy.ndimage.filters.median_filter(amp_xx, (1,7))
- amp_yy = scipy.ndimage.filters.median_filter(amp_yy, (3,3))
- amp_yy = scipy.ndimage.filters.median_filter(amp_yy, (1,7))
- #print numpy.shape(amp_xx)
- 
- if show_plot:
+# median filter all antennas and both polarisations at once; the filter
+# size is 1 along those axes, so they do not mix
+print 'Smoothing amplitudes'
+amp_cube = scipy.ndimage.filters.median_filter(amp_cube, (1,1,3,3))
+amp_cube = scipy.ndimage.filters.median_filter(amp_cube, (1,1,1,7))
+
+if show_plot:
+ for antenna_id in range(0,len(amptab.ant[:])):
+   amp_xx = amp_cube[0,antenna_id]
+   amp_yy = amp_cube[1,antenna_id]
+   minscale, maxscale = scales[antenna_id]
    subplots_adjust(wspace = 0.6)
 
    matplotlib.pyplot.subplot(121)
@@ -439,17 +394,15 @@ for antenna_id in range(0,len(amptab.ant[:])):
    matplotlib.pyplot.close()
    matplotlib.pyplot.cla()
 
-  #2D interpol XX
- for time in range(0,len(amptab.time[:])):
-  
-   amps      = numpy.copy(amp_xx[:,time])
-   fl = scipy.interpolate.interp1d(freqs,amps,kind='slinear',bounds_error=False)
-   ynew= fl(freqs_new)
-   amps_array[antenna_id,time,:,0] = numpy.copy(savitzky_golay(ynew, 17, 2))
-   #if show_plot:
-      #print numpy.shape(freqs_new), numpy.shape(amps_array)
-      #matplotlib.pyplot.plot(freqs_new/1e6,amps_array[antenna_id,time,:,0])
- if show_plot:
+# 2D interpol: interpolate the whole (antenna, time, pol) cube onto
+# freqs_new and smooth along frequency in one pass
+print 'Interpolating amplitudes'
+amps_interp = interpolate_freq(freqs, amp_cube.transpose(1,3,0,2), freqs_new)
+amps_array[:] = numpy.swapaxes(savitzky_golay(amps_interp, 17, 2), 2, 3)
+del amps_interp
+
+if show_plot:
+ for antenna_id in range(0,len(amptab.ant[:])):
    matplotlib.pyplot.plot(freqs_new/1e6,numpy.median(amps_array[antenna_id,:,:,0], axis=0))
    matplotlib.pyplot.xlabel('freq [MHz]')
    matplotlib.pyplot.ylabel('ampl')
@@ -457,15 +410,6 @@ for antenna_id in range(0,len(amptab.ant[:])):
    matplotlib.pyplot.close()
    matplotlib.pyplot.cla()
 
-  #2D interpol YY
- for time in range(0,len(amptab.time[:])):
-   amps      = numpy.copy(amp_yy[:,time])
-   fl = scipy.interpolate.interp1d(freqs,amps,kind='slinear',bounds_error=False)
-   ynew= fl(freqs_new)
-   amps_array[antenna_id,time,:,1] = numpy.copy(savitzky_golay(ynew, 17, 2))
-   #if show_plot:
-     
- if show_plot:
    matplotlib.pyplot.plot(freqs_new/1e6,numpy.median(amps_array[antenna_id,:,:,1], axis=0))
    matplotlib.pyplot.xlabel('freq [MHz]')
    matplotlib.pyplot.ylabel('ampl')
@@ -473,10 +417,6 @@ for antenna_id in range(0,len(amptab.ant[:])):
    matplotlib.pyplot.close()
    matplotlib.pyplot.cla()
 
-
-
-
-
    #sys.exit()
  #for SB in range(len(ionmodel.freqs[:])):
  # print 'Doing SB', SB
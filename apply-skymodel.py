@@ -5,13 +5,7 @@
 import sys
 import config
 import os.path
-import pyrap.tables as pt
-
-def getfreq(ms):
-    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-    freq = t[0]['REF_FREQUENCY']
-    t.close()
-    return freq
+import manifest
 
 die=config.die
 report=config.report
@@ -42,7 +36,7 @@ beam_applied=cfg.getoption('control','beam_applied',False)
 bs='%02i' % band
 ms=troot+'_B'+bs+'_concat.MS'
 
-freq=getfreq(ms)
+freq=manifest.getfreq(ms)
 
 report('Generating sky model for file '+ms+' at frequency '+str(freq)+' Hz')
 outmodel=troot+'_B'+bs+'_skymodel.txt'
@@ -55,6 +49,6 @@ run('/home/mjh/lofar/bin/cluster-first-skymodel.py '+outmodel+' '+clusteredmodel
 
 report('Calibrating with the clustered model')
 if beam_applied:
-    run('calibrate-stand-alone --numthreads 8 -f '+ms+' /home/mjh/lofar/text/bbs-phaseonly-first-nobeam '+clusteredmodel)
+    run('calibrate-stand-alone --numthreads '+str(config.getthreads())+' -f '+ms+' /home/mjh/lofar/text/bbs-phaseonly-first-nobeam '+clusteredmodel)
 else:
-    run('calibrate-stand-alone --numthreads 8 -f '+ms+' /home/mjh/lofar/text/bbs-phaseonly-first '+clusteredmodel)
+    run('calibrate-stand-alone --numthreads '+str(config.getthreads())+' -f '+ms+' /home/mjh/lofar/text/bbs-phaseonly-first '+clusteredmodel)
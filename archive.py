@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# Unpack the raw sub-band data for calib.py. The archive directory is
+# listed once, into an inventory file shared by all the calib jobs,
+# instead of every job globbing it over NFS; the calibrator and target
+# archives are then extracted at the same time, with large reads, and
+# the results are checked before anything else is done with them.
+
+import os
+import json
+import fnmatch
+import threading
+import pyrap.tables as pt
+
+# tar blocking factor, in 512-byte records (1 MB reads)
+BLOCKING=2048
+
+# columns every unpacked MS must have
+COLUMNS=['UVW','ANTENNA1','ANTENNA2','TIME','DATA','FLAG']
+
+def listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+def stamp(unpackpath):
+    # the inventory is out of date if any of the directories has changed
+    s=[]
+    for d in ('','target','calib'):
+        try:
+            s.append(os.stat(os.path.join(unpackpath,d)).st_mtime)
+        except OSError:
+            s.append(None)
+    return s
+
+def inventory(unpackpath,cachefile):
+
+    '''
+    Return the listings of unpackpath and its target and calib
+    subdirectories, from cachefile if it is up to date, otherwise
+    listing them and writing cachefile for the other jobs.
+    '''
+
+    s=stamp(unpackpath)
+    try:
+        inv=json.load(open(cachefile))
+        if inv['path']==unpackpath and inv['stamp']==s:
+            return inv
+    except (IOError,ValueError,KeyError):
+        pass
+    inv={'path':unpackpath,'stamp':s}
+    for d in ('','target','calib'):
+        inv[d]=listdir(os.path.join(unpackpath,d))
+    try:
+        tmp=cachefile+'.%i' % os.getpid()
+        f=open(tmp,'w')
+        json.dump(inv,f)
+        f.close()
+        os.rename(tmp,cachefile)
+    except (IOError,OSError):
+        # another job got there first, or nowhere to write it
+        pass
+    return inv
+
+def find_tar(inv,root,sbs):
+
+    '''
+    Find the archive for observation root and sub-band sbs, in the same
+    places as calib.py always looked: <root>_SB<sbs>_uv.dppp.MS.tar, or
+    else the blazar project names in target/ or calib/. Returns None if
+    there is none.
+    '''
+
+    unpackpath=inv['path']
+    name=root+'_SB'+sbs+'_uv.dppp.MS.tar'
+    if name in inv['']:
+        return os.path.join(unpackpath,name)
+    for d in ('target','calib'):
+        g=fnmatch.filter(inv[d],'*'+root+'*_SB'+sbs+'*.tar')
+        if len(g)>1:
+            raise RuntimeError('More than one archive for '+root+' SB'+sbs+' in '+d)
+        if len(g)==1:
+            return os.path.join(unpackpath,d,g[0])
+    return None
+
+def run_all(run,commands):
+
+    '''
+    Run the commands at the same time, each with run (a
+    config.runner().run), and return their return values.
+    '''
+
+    results=[None]*len(commands)
+    def worker(i):
+        results[i]=run(commands[i],proceed=True)
+    threads=[threading.Thread(target=worker,args=(i,)) for i in range(len(commands))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def extract_command(tarfile):
+    return 'tar -x -b %i -f %s' % (BLOCKING,tarfile)
+
+def verify(ms):
+
+    '''
+    Check that ms looks complete: it opens, has rows and the columns
+    calibration needs, and its last row can be read. Returns a string
+    describing the problem, or None.
+    '''
+
+    try:
+        t=pt.table(ms,readonly=True,ack=False)
+    except Exception,e:
+        return 'cannot open '+ms+': '+str(e)
+    try:
+        nrows=t.nrows()
+        if nrows==0:
+            return ms+' has no rows'
+        names=t.colnames()
+        for c in COLUMNS:
+            if c not in names:
+                return ms+' has no '+c+' column'
+        for c in COLUMNS:
+            t.getcell(c,nrows-1)
+    except Exception,e:
+        return ms+' cannot be read: '+str(e)
+    finally:
+        t.close()
+    return None
@@ -3,14 +3,91 @@
 import sys
 import config
 import os.path
+import shutil
+import socket
+import subprocess
 import pyrap.tables as pt
 import flagrms
-import glob
+import flagengine
+import archive
+import publish
+import manifest
 
 die=config.die
 report=config.report
 warn=config.warn
 
+# highest sub-band number plus one
+NSB=367
+
+def subband_list(arg,perjob=1):
+    '''
+    Return the sub-bands given by arg: a number, a range such as 10-19
+    or a list such as 3,5,7. With perjob>1 a plain number k means the
+    perjob sub-bands starting at k*perjob, so that e.g. qsub -t 0-36
+    with perjob=10 covers them all.
+    '''
+    if '-' in arg or ',' in arg:
+        subbands=[]
+        for r in arg.split(','):
+            if '-' in r:
+                first,last=r.split('-')
+                subbands+=range(int(first),int(last)+1)
+            else:
+                subbands.append(int(r))
+        return subbands
+    n=int(arg)
+    if perjob>1:
+        return range(n*perjob,min(n*perjob+perjob,NSB))
+    return [n]
+
+def run_subbands(filename,subbands,workpath,ncpu,pool):
+    '''
+    Run this script for each sub-band, in a process and work directory
+    of its own, pool at a time with the CPUs shared between them. The
+    output of each goes to calib-SB<nnn>.log in workpath. Returns the
+    list of sub-bands that failed.
+    '''
+    cpus=max(1,ncpu/pool)
+    host=socket.gethostname()
+    waiting=list(subbands)
+    running={}
+    failed=[]
+    while waiting or running:
+        while waiting and len(running)<pool:
+            sb=waiting.pop(0)
+            sbdir=os.path.join(workpath,'SB%03i' % sb)
+            if not(os.path.isdir(sbdir)):
+                os.makedirs(sbdir)
+            nodefile=os.path.join(sbdir,'nodefile')
+            f=open(nodefile,'w')
+            for i in range(cpus):
+                f.write(host+'\n')
+            f.close()
+            env=dict(os.environ)
+            env['PBS_NODEFILE']=nodefile
+            env['OMP_NUM_THREADS']=str(cpus)
+            log=open(os.path.join(workpath,'calib-SB%03i.log' % sb),'w')
+            p=subprocess.Popen([sys.executable,os.path.abspath(__file__),filename,str(sb),sbdir],
+                               stdout=log,stderr=subprocess.STDOUT,env=env)
+            log.close()
+            running[p.pid]=(sb,p,sbdir)
+            report('Started sub-band %i with %i CPUs' % (sb,cpus))
+        pid,status=os.wait()
+        if pid not in running:
+            continue
+        sb,p,sbdir=running.pop(pid)
+        p.returncode=status
+        if status!=0:
+            failed.append(sb)
+            # the log is kept in workpath, the data need not be
+            shutil.rmtree(sbdir,ignore_errors=True)
+            warn('Sub-band %i FAILED, see %s' % (sb,os.path.join(workpath,'calib-SB%03i.log' % sb)))
+        else:
+            shutil.rmtree(sbdir,ignore_errors=True)
+            report('Sub-band %i done' % sb)
+    return failed
+
 if len(sys.argv)<2:
     die('Need a filename for config file')
 
@@ -21,12 +98,47 @@ if not(os.path.isfile(filename)):
 if len(sys.argv)<3:
     die('Need a sub-band number')
 
-sb=int(sys.argv[2])
-sbs='%03i' % sb
-
 cfg=config.LocalConfigParser()
 cfg.read(filename)
 
+try:
+    perjob=int(cfg.get('calibration','subbandsperjob'))
+except config.NoOptionError:
+    perjob=1
+if len(sys.argv)>3:
+    # one sub-band started by run_subbands
+    subbands=[int(sys.argv[2])]
+else:
+    subbands=subband_list(sys.argv[2],perjob)
+if not(subbands):
+    die('No sub-bands selected by '+sys.argv[2]+' with subbandsperjob=%i' % perjob)
+
+if len(subbands)>1:
+    # several sub-bands in this job: run one process per sub-band,
+    # several at a time, so that the flagging, calibration and copying
+    # of different sub-bands overlap
+    workpath=cfg.get('paths','work')
+    ncpu=config.getcpus()
+    try:
+        pool=int(cfg.get('calibration','pool'))
+    except config.NoOptionError:
+        pool=max(1,ncpu/2)
+    pool=min(pool,len(subbands))
+    if not(os.path.isdir(workpath)):
+        try:
+            os.makedirs(workpath)
+        except OSError:
+            pass
+    report('Calibrating sub-bands '+','.join([str(s) for s in subbands])+' %i at a time' % pool)
+    failed=run_subbands(os.path.abspath(filename),subbands,workpath,ncpu,pool)
+    if failed:
+        die('Sub-bands '+','.join([str(s) for s in sorted(failed)])+' failed')
+    report('All sub-bands done')
+    sys.exit(0)
+
+sb=subbands[0]
+sbs='%03i' % sb
+
 do_unpack=True
 try:
     unpackpath=cfg.get('paths','unpack')
@@ -38,13 +150,17 @@ except config.NoOptionError:
 
 processedpath=cfg.get('paths','processed')
 workpath=cfg.get('paths','work')
+if len(sys.argv)>3:
+    # a work directory of our own, from run_subbands
+    workpath=sys.argv[3]
 
 croot=cfg.get('files','calibrator')
 troot=cfg.get('files','target')
 
 print 'Target is',troot,'calibrator is',croot,'sub-band number is',sbs
 
-run=config.runner(cfg.getoption('control','dryrun',False)).run
+dryrun=cfg.getoption('control','dryrun',False)
+run=config.runner(dryrun).run
 cleanup=cfg.getoption('control','cleanup',True)
 
 # Expand this section with required options -- some not implemented yet
@@ -63,6 +179,21 @@ clip=cfg.getoption('calibration','clip',False)
 flagears=cfg.getoption('calibration','flagears',False)
 flagbadweight=cfg.getoption('calibration','flagbadweight',True)
 skipexisting=cfg.getoption('calibration','skip_existing',False)
+# apply the flagging rules below in one pass with flagengine.py where
+# it can do them, rather than with a separate tool for each
+useflagengine=cfg.getoption('calibration','flagengine',True)
+try:
+    clipvalue=float(cfg.get('calibration','clipvalue'))
+except config.NoOptionError:
+    clipvalue=None
+try:
+    earchannels=int(cfg.get('calibration','earchannels'))
+except config.NoOptionError:
+    earchannels=None
+try:
+    maxflagiter=int(cfg.get('calibration','maxflagiter'))
+except config.NoOptionError:
+    maxflagiter=4
 
 try:
     calibskymodel=cfg.get('calibration','skymodel')
@@ -131,22 +262,20 @@ if do_unpack:
             newname=r+'_SB'+sbs+'_uv.dppp.MS'
             run('cp -r '+oldname+' '+newname)
     else:
+        # one listing of the archive for all the sub-band jobs
+        inv=archive.inventory(unpackpath,os.path.join(processedpath,'.unpack-inventory.json'))
+        tarfiles=[]
+        for r in unpack:
+            tarfile=archive.find_tar(inv,r,sbs)
+            if tarfile is None:
+                die('File to unpack doesn\'t exist -- '+unpackpath+'/'+r+'_SB'+sbs+'_uv.dppp.MS.tar')
+            tarfiles.append(tarfile)
+        # calibrator and target at the same time
+        commands=[archive.extract_command(t) for t in tarfiles]
+        for c,retval in zip(commands,archive.run_all(run,commands)):
+            if retval:
+                die('FAILED to run '+c+': return value is '+str(retval))
         for r in unpack:
-            tarfile=unpackpath+'/'+r+'_SB'+sbs+'_uv.dppp.MS.tar'
-            if not(os.path.exists(tarfile)):
-                # OK, that was too easy. Now we should try blazar project format before giving up
-                g=glob.glob(unpackpath+'/target/*'+r+'*_SB'+sbs+'*.tar')
-                assert(len(g)<2)
-                if len(g)==1:
-                    tarfile=g[0]
-                else:
-                    g=glob.glob(unpackpath+'/calib/*'+r+'*_SB'+sbs+'*.tar')
-                    assert(len(g)<2)
-                    if len(g)==1:
-                        tarfile=g[0]
-                    else:
-                        die('File to unpack doesn\'t exist -- '+tarfile)
-            run('tar xf '+tarfile)
             # fix up stupid LC0 format
             lc0name=r+'_SAP000_SB'+sbs+'_uv.MS.dppp'
             newname=r+'_SB'+sbs+'_uv.dppp.MS'
@@ -154,8 +283,11 @@ if do_unpack:
                 run('mv '+lc0name+' '+newname)
 else:
     report('Copying files')
-    run('cp -r '+copyfrom+'/target/'+troot+'*_SB'+sbs+'_uv.MS.dppp '+troot+'_SB'+sbs+'_uv.dppp.MS')
-    run('cp -r '+copyfrom+'/calib/'+croot+'*_SB'+sbs+'_uv.MS.dppp '+croot+'_SB'+sbs+'_uv.dppp.MS')
+    commands=['cp -r '+copyfrom+'/target/'+troot+'*_SB'+sbs+'_uv.MS.dppp '+troot+'_SB'+sbs+'_uv.dppp.MS',
+              'cp -r '+copyfrom+'/calib/'+croot+'*_SB'+sbs+'_uv.MS.dppp '+croot+'_SB'+sbs+'_uv.dppp.MS']
+    for c,retval in zip(commands,archive.run_all(run,commands)):
+        if retval:
+            die('FAILED to run '+c+': return value is '+str(retval))
 
 if notarget:
     orign=(origcms,)
@@ -164,6 +296,13 @@ else:
     orign=(origcms,origtms)
     filtr=(filtercms,filtertms)
 
+if not(dryrun):
+    report('Checking unpacked data')
+    for d in orign:
+        problem=archive.verify(d)
+        if problem is not None:
+            die('Unpacked data are incomplete: '+problem)
+
 if antennafix:
     report('Fixing the beam info')
     for d in orign:
@@ -174,19 +313,70 @@ if antennafix15:
     for d in orign:
         run('/soft/fixinfo15/fixbeaminfo '+d)
 
-# flag antenna_weight>1
-if flagbadweight:
+# work out whether preflagging is required
+
+preflag=True
+try:
+    preflag_sb=cfg.get('preflag','sbrange')
+    preflag_ants=cfg.get('preflag','antenna')
+    bits=preflag_sb.split(',')
+    sbmin=int(bits[0])
+    sbmax=int(bits[1])
+    preflag_slist=[[sbmin,sbmax],]
+    preflag_antlist=[preflag_ants,]
+    
+except (config.NoSectionError,config.NoOptionError):
+    try:
+        preflag_slist=eval(cfg.get('preflag','sblist'))
+        preflag_antlist=eval(cfg.get('preflag','antlist'))
+    except (config.NoSectionError,config.NoOptionError):
+        preflag=False
+
+preflag_ants=None
+if preflag:
+    for i,r in enumerate(preflag_slist):
+        sbmin,sbmax=r
+        if sb>=sbmin and sb<=sbmax:
+            preflag_ants=preflag_antlist[i]
+
+# flag antenna_weight>1, clip, ears and preflag ranges
+engine_patterns=None
+engine_clip=None
+engine_ears=0
+if useflagengine:
+    if preflag_ants is not None:
+        # patterns that match no station go to NDPPP, as do ones we
+        # cannot parse
+        names=None
+        if not(dryrun):
+            names=[]
+            for d in orign:
+                names+=flagengine.antenna_names(d)
+        engine_patterns=flagengine.antenna_patterns(preflag_ants,names)
+    if clip and clipvalue is not None:
+        engine_clip=clipvalue
+    if flagears and earchannels is not None:
+        engine_ears=earchannels
+    if flagbadweight or engine_clip is not None or engine_ears>0 or engine_patterns is not None:
+        report('Flagging in one pass')
+        for d in orign:
+            print 'flagengine.flag_ms(%s,badweight=%s,clip=%s,ears=%i,antennas=%s)' % (d,flagbadweight,engine_clip,engine_ears,engine_patterns)
+            if not(dryrun):
+                counts=flagengine.flag_ms(d,flagbadweight,engine_clip,engine_ears,engine_patterns)
+                print 'Newly flagged:',counts
+
+if flagbadweight and not(useflagengine):
     report('Flagging bad antenna weights')
     for d in orign:
         run('taql "update '+d+' set FLAG=True where any(WEIGHT_SPECTRUM>1) and ANTENNA1!=ANTENNA2"')
 # Here we pass autocorrelations, which should be flagged anyway
 
-if clip:
+if clip and engine_clip is None:
     report('Clipping')
     for d in orign:
         run('/home/mjh/lofar/bin/clip.py '+d)
 
-if flagears:
+if flagears and engine_ears==0:
     report('Flagging ears')
     for d in orign:
         run('/home/mjh/lofar/bin/flag_ears.py '+d+' '+sbs)
@@ -212,33 +402,11 @@ else:
     if not(notarget):
         run('ln -s '+origtms+' '+filtertms)
 
-# now do preflagging if required
-
-preflag=True
-try:
-    preflag_sb=cfg.get('preflag','sbrange')
-    preflag_ants=cfg.get('preflag','antenna')
-    bits=preflag_sb.split(',')
-    sbmin=int(bits[0])
-    sbmax=int(bits[1])
-    preflag_slist=[[sbmin,sbmax],]
-    preflag_antlist=[preflag_ants,]
-    
-except config.NoSectionError,config.NoOptionError:
-    try:
-        preflag_slist=eval(cfg.get('preflag','sblist'))
-        preflag_antlist=eval(cfg.get('preflag','antlist'))
-    except config.NoSectionError,config.NoOptionError:
-        preflag=False
+# now do preflagging if required and not done above
 
 if preflag:
     report('Preflagging')
-    preflag_ants=None
-    for i,r in enumerate(preflag_slist):
-        sbmin,sbmax=r
-        if sb>=sbmin and sb<=sbmax:
-            preflag_ants=preflag_antlist[i]
-    if preflag_ants is not None:
+    if preflag_ants is not None and engine_patterns is None:
         report('This dataset is in the range to be flagged')
         for ms in filtr:
             ndppp=open('NDPPP-'+sbs+'.in','w')
@@ -255,7 +423,7 @@ if rficonsole:
     report('Running rficonsole')
     open('rficonsole.debug','w').write('Global 5\n')
     for f in filtr:
-        run('rficonsole -j '+str(config.getcpus())+' '+f)
+        run('rficonsole -j '+str(config.getthreads())+' '+f)
 
 t = pt.table(filtercms+'/OBSERVATION', readonly=True, ack=False)
 calname=t[0]['LOFAR_TARGET'][0]
@@ -277,45 +445,68 @@ for l in lines:
     outfile.write(l)
 outfile.close()
 
-calibrated=False
-while not(calibrated):
+# Solve on the calibrator, flagging bad antennas in it and solving
+# again until none are found; the flags are then applied to the target
+# once
+flagged=[]
+iteration=0
+while True:
     run('calibrate-stand-alone -f '+filtercms+' bbs-transfer-'+sbs+'.txt '+calibskymodel)
+    iteration+=1
 
     # We now have a calibrated flux calibrator. Are we flagging?
 
-    if flagbad:
-        flaglist=flagrms.flagrms(filtercms)
-        if flaglist:
-            report('Preparing to flag bad antennas: '+str(flaglist))
-            baseline=''
-            for f in flaglist:
-                baseline+=f+'; '
-            baseline=baseline[:-2]
-            for data in (filtercms,filtertms):
-                ndppp=open('NDPPP-flag-'+sbs+'.in','w')
-                ndppp.write('msin = '+data+'\n'+
-                            'msout =\n'+
-                            'steps = [flag]\nflag.type=preflagger\n'+
-                            'flag.baseline='+baseline+'\n')
-                ndppp.close()
-                run('NDPPP NDPPP-flag-'+sbs+'.in')
-            report('Flagging completed, rerun calibration')
-        else:
-            calibrated=True
-    else:
-        calibrated=True
+    if not(flagbad):
+        break
+    flaglist=flagrms.flagrms(filtercms,exclude=flagged)
+    if not(flaglist):
+        break
+    if iteration>=maxflagiter:
+        warn('Still finding bad antennas after %i solves, not flagging: %s' % (iteration,str(flaglist)))
+        break
+    report('Preparing to flag bad antennas: '+str(flaglist))
+    print 'flagengine.flag_ms(%s,badweight=False,antennas=%s)' % (filtercms,flaglist)
+    if not(dryrun):
+        flagengine.flag_ms(filtercms,badweight=False,antennas=flaglist)
+    flagged+=flaglist
+    report('Flagging completed, rerun calibration')
+
+if flagged and not(notarget):
+    report('Flagging bad antennas in the target: '+str(flagged))
+    print 'flagengine.flag_ms(%s,badweight=False,antennas=%s)' % (filtertms,flagged)
+    if not(dryrun):
+        flagengine.flag_ms(filtertms,badweight=False,antennas=flagged)
+
+if cleanup:
+    # copy the finished data to the output directory in the background
+    publisher=publish.Publisher(processedpath,run,dryrun)
 
 if not(notransfer):
     report('Gain transfer')
     inst=croot+'_SB'+sbs+'.INST'
     run('parmexportcal in='+filtercms+'/instrument out='+inst)
+    if cleanup:
+        # the calibrator is finished with, so copy it out while the
+        # target is calibrated
+        publisher.publish(filtercms,[filtercms,origcms])
     run('calibrate-stand-alone -f --parmdb '+inst+' '+filtertms+' /home/mjh/lofar/text/bbs-blank.txt /home/mjh/lofar/text/sources-dummy.txt')
 
 if cleanup:
     report('Cleaning up')
-    for data in filtr:
-        run('rsync -av --delete --copy-links '+data+' '+processedpath)
-
-    run('rm -r '+croot+'_SB'+sbs+'*')
+    if notransfer:
+        publisher.publish(filtercms,[filtercms,origcms])
     if not(notarget):
-        run('rm -r '+troot+'_SB'+sbs+'*')
+        publisher.publish(filtertms,[filtertms,origtms])
+    failed=publisher.wait()
+    if failed:
+        die('FAILED to copy '+', '.join([p+' ('+e+')' for p,e in failed])+' to '+processedpath)
+    if not(dryrun):
+        index=manifest.Manifest(processedpath)
+        index.record(filtercms)
+        if not(notarget):
+            index.record(filtertms)
+
+    # the publisher has removed the MSs it copied; only the exported
+    # gain table is left
+    if not(notransfer):
+        run('rm -r '+inst)
@@ -5,6 +5,7 @@
 import sys
 import config
 import os.path
+import manifest
 
 die=config.die
 report=config.report
@@ -33,23 +34,18 @@ if os.path.isdir('globaldb'):
 run('mkdir globaldb')
 os.chdir('globaldb')
 
-sb=0
-while sb<366:
-    sbs='%03i' % sb
-    dir='../'+croot+'_SB'+sbs+'_uv.filter.MS'
-    if os.path.isdir(dir):
-        break
-    sb+=1
-else:
+subbands=manifest.Manifest(processedpath).subbands(croot)
+if not(subbands):
     die("Can't find any calibrator files!")
+dir='../'+subbands[min(subbands)]
 
 for table in ['ANTENNA','FIELD','sky','OBSERVATION']:
     run('cp -r '+dir+'/'+table+' .')
 
 
-for i in range(366):
+for i in sorted(subbands):
     sbn='%03i' % i
-    msname='../'+croot+'_SB'+sbn+'_uv.filter.MS/instrument'
+    msname='../'+subbands[i]+'/instrument'
     os.system('ln -s '+msname+' instrument-'+sbn)
 
 report('Importing to hdf5')
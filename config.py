@@ -1,7 +1,15 @@
 #!/usr/bin/python
 
 import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import pipes
+import threading
 import ConfigParser
+import resources
 
 class LocalConfigParser (ConfigParser.SafeConfigParser):
 
@@ -38,22 +46,120 @@ def report(s):
 def warn(s):
     print bcolors.OKBLUE+s+bcolors.ENDC
 
+def io_counters():
+    # I/O of this process plus all its reaped children (Linux only)
+    counters={}
+    try:
+        for l in open('/proc/self/io').readlines():
+            key,value=l.split(':')
+            counters[key.strip()]=int(value)
+    except IOError:
+        pass
+    return counters
+
+# commands being run by runners in this process, each mapped to
+# whether another has overlapped it
+inflight={}
+inflight_lock=threading.Lock()
+
+def start_command():
+    token=object()
+    with inflight_lock:
+        overlapped=len(inflight)>0
+        for t in inflight:
+            inflight[t]=True
+        inflight[token]=overlapped
+    return token
+
+def end_command(token):
+    with inflight_lock:
+        return inflight.pop(token)
+
 class runner:
-    def __init__(self,dryrun):
+
+    """
+    Run shell commands, dying on failure unless told to proceed. If
+    the environment variable PIPELINE_LEDGER names a directory, the
+    wall time, CPU time, peak RSS, I/O and exit status of every
+    command are appended as a line of JSON to a ledger file there, one
+    per job; ledger_summary.py aggregates them. The I/O counts are
+    differences of /proc/self/io, which covers the whole process, so
+    the commands of all runners are counted while they are in flight:
+    if a command overlapped another (as with archive.run_all or the
+    publish.Publisher thread) its entry is marked concurrent and the
+    byte counts are left out. I/O done in this process itself while a
+    command runs is still counted against it. If PIPELINE_NUMA is
+    set, commands are run on the NUMA node holding most of the job's
+    CPUs (see resources.numa_prefix).
+    """
+
+    def __init__(self,dryrun,stage=None,unit=None):
         self.dryrun=dryrun
+        # by default the stage is the script name and the unit its
+        # band/sub-band argument, as in the qsub files
+        if stage is None:
+            stage=os.path.basename(sys.argv[0]).replace('.py','')
+        if unit is None and len(sys.argv)>2:
+            unit=sys.argv[2]
+        self.stage=stage
+        self.unit=unit
+        self.ledger=os.getenv('PIPELINE_LEDGER')
+        if self.ledger:
+            jobid=os.getenv('PBS_JOBID','%s-%i' % (socket.gethostname(),os.getpid()))
+            self.ledger=os.path.join(os.path.abspath(self.ledger),'%s-%s-%s.jsonl' % (stage,unit,jobid))
+        self.prefix=''
+        if os.getenv('PIPELINE_NUMA'):
+            self.prefix=resources.numa_prefix()
+
+    def record(self,s,start,wall,status,rusage,io0,io1,concurrent=False):
+        entry={'stage':self.stage,'unit':self.unit,'command':s,
+               'host':socket.gethostname(),'jobid':os.getenv('PBS_JOBID'),
+               'start':start,'wall':wall,'status':status,
+               'utime':rusage.ru_utime,'stime':rusage.ru_stime,
+               # kilobytes on Linux
+               'maxrss':rusage.ru_maxrss,'concurrent':concurrent}
+        if not(concurrent):
+            for key in ('rchar','wchar','read_bytes','write_bytes'):
+                if key in io0 and key in io1:
+                    entry[key]=io1[key]-io0[key]
+        try:
+            dirname=os.path.dirname(self.ledger)
+            if not(os.path.isdir(dirname)):
+                os.makedirs(dirname)
+            f=open(self.ledger,'a')
+            f.write(json.dumps(entry)+'\n')
+            f.close()
+        except (IOError,OSError),e:
+            warn('Could not write ledger '+self.ledger+': '+str(e))
+
     def run(self,s,proceed=False):
         print s
         if not(self.dryrun):
-            retval=os.system(s)
+            cmd=s
+            if self.prefix:
+                cmd=self.prefix+'sh -c '+pipes.quote(s)
+            if self.ledger:
+                token=start_command()
+                try:
+                    io0=io_counters()
+                    start=time.time()
+                    p=subprocess.Popen(cmd,shell=True)
+                    pid,retval,rusage=os.wait4(p.pid,0)
+                    p.returncode=retval
+                    io1=io_counters()
+                finally:
+                    concurrent=end_command(token)
+                self.record(s,start,time.time()-start,retval,rusage,io0,io1,concurrent)
+            else:
+                retval=os.system(cmd)
             if not(proceed) and retval!=0:
                 die('FAILED to run '+s+': return value is '+str(retval))
             return retval
 
 def getcpus():
-    nodefile=os.getenv('PBS_NODEFILE')
-    if nodefile:
-        lines=len(open(nodefile).readlines())
-        return lines
-    else:
-        import multiprocessing
-        return multiprocessing.cpu_count()
+    # the CPUs this job owns, not the size of the node (see resources.py)
+    return resources.cpus()
+
+def getthreads(limit=None):
+    # the thread count for an external tool: the job's CPUs, at most limit
+    return resources.threads(limit)
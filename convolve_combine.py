@@ -11,47 +11,55 @@ import os.path
 import numpy as np
 import lofar.bdsm as bdsm
 from astropy.io import fits
+import fftconvolve
+import adaptivestack
+import stagecache
+from fftconvolve import convolve_resolution
 
-def convolve_resolution(bmaj1,bmin1,bpa1,bmaj2,bmin2,bpa2):
-
+def feasible(bmaj,bmin,bpa,map_bmaj,map_bmin,map_bpa):
     '''
-    Work out the 'parameters of a Gaussian deconvolved with another
-    Gaussian. In other words, the parameters needed to convolve a map
-    of a given resolution to another, specified resolution. Here
-    bmaj1,bmin1,bpa1 are the desired final resolution -- should be
-    floats. bmaj2, bmin2, bpa2 are the resolution of the map(s) of
-    interest. Position angles are assumed to be in radians. The
-    returned tuple is of the same size as (bmaj2,bmin2,bpa2).
-
-    Unlike the original Fortran code there is no error checking.
-    Errors are signalled by the presence of NaNs in the returned
-    arrays: use np.isnan to check whether the convolution can be
-    performed.
+    Return a boolean array, of the shape of the 1-d trial arrays
+    bmaj,bmin,bpa, which is True where every map resolution can be
+    convolved to the trial resolution, i.e. where convolve_resolution
+    would return no NaNs. The terms depending only on the trial or only
+    on the maps are computed once and combined by broadcasting, in the
+    same order of operations as convolve_resolution.
     '''
+    from numpy import sin,cos,sqrt
 
-#import to assist in direct copy of Fortran
-    from numpy import sin,cos,arctan2,sqrt
+    trial=bmaj[:,np.newaxis],bmin[:,np.newaxis],bpa[:,np.newaxis]
+    maps=map_bmaj,map_bmin,map_bpa
 
-    theta1=bpa1
-    theta2=bpa2
+    def terms(bmaj,bmin,theta):
+        return ((bmaj*cos(theta))**2,(bmin*sin(theta))**2,
+                (bmaj*sin(theta))**2,(bmin*cos(theta))**2,
+                (bmin**2-bmaj**2)*sin(theta)*cos(theta))
 
-    alpha=((bmaj1*cos(theta1))**2 + (bmin1*sin(theta1))**2-
-           (bmaj2*cos(theta2))**2 - (bmin2*sin(theta2))**2)
-    beta=((bmaj1*sin(theta1))**2 + (bmin1*cos(theta1))**2 -
-          (bmaj2*sin(theta2))**2 - (bmin2*cos(theta2))**2)
-    gamma  = 2.0*( (bmin1**2-bmaj1**2)*sin(theta1)*cos(theta1) -
-                   (bmin2**2-bmaj2**2)*sin(theta2)*cos(theta2) )
+    t1,t2,t3,t4,t5=terms(*trial)
+    m1,m2,m3,m4,m5=terms(*maps)
 
-    s = alpha + beta
-    t = sqrt((alpha-beta)**2 + gamma**2)
+    alpha=(t1+t2)-m1-m2
+    beta=(t3+t4)-m3-m4
+    gamma=2.0*(t5-m5)
 
-    bmaj = sqrt(0.5*(s+t))
-    bmin = sqrt(0.5*(s-t))
-    bpa = 0.5 * arctan2(-gamma,alpha-beta)
+    s=alpha+beta
+    with np.errstate(invalid='ignore'):
+        t=sqrt((alpha-beta)**2 + gamma**2)
+        ok=(0.5*(s+t)>=0) & (0.5*(s-t)>=0)
+    return np.all(ok,axis=-1)
 
-    return bmaj,bmin,bpa
+def smallest_feasible(bmaj,bmin,bpa,map_bmaj,map_bmin,map_bpa):
+    '''
+    Evaluate a flattened set of trial resolutions in one go and return
+    the index of the first one with the smallest area, or None.
+    '''
+    ok=feasible(bmaj,bmin,bpa,map_bmaj,map_bmin,map_bpa)
+    if not np.any(ok):
+        return None
+    size=np.where(ok,bmaj*bmin,np.inf)
+    return np.argmin(size)
 
-def find_resolution(files):
+def find_resolution(files,refine=True):
     bmajl=[]
     bminl=[]
     bpal=[]
@@ -73,45 +81,80 @@ def find_resolution(files):
     gridsteps=100
     minb=np.min(map_bmin)/1.1
     maxb=np.max(map_bmaj)*1.5
-    minsize=maxb*maxb*2.0
     bgaxis=np.linspace(minb,maxb,gridsteps)
     bpaxis=np.linspace(-np.pi/2.0,np.pi/2.0,gridsteps)
+
+    # The coarse grid is the same as that of the original loop over
+    # bmaj, bmin<=bmaj and bpa, in the same order, so the first
+    # smallest feasible point is the same. One bmaj row is evaluated
+    # at a time to keep the temporaries small. Points that cannot be
+    # chosen are skipped: the axes of the target beam must be at
+    # least as large as the largest map axes, and anything not
+    # smaller than the best area so far would be rejected anyway.
+    minsize=maxb*maxb*2.0
+    smallest=None
+    tol=1.0-1e-6
     for i in range(gridsteps):
-        bmaj=bgaxis[i]
-        for j in range(0,i+1):
-            bmin=bgaxis[j]
-            for k in range(gridsteps):
-                bpa=bpaxis[k]
-                resbmaj,resbmin,resbpa=convolve_resolution(bmaj,bmin,bpa,map_bmaj,map_bmin,map_bpa)
-                if np.sum(np.isnan(resbmaj))>0 or np.sum(np.isnan(resbmin))>0 or np.sum(np.isnan(resbpa))>0:
-                    continue
-    #            print bmaj,bmin,bpa,resbmaj,resbmin,resbpa
-#                print '.',
-                size=bmaj*bmin
-                if size<minsize:
-                    minsize=size
-                    smallest=(bmaj,bmin,bpa)
+        if bgaxis[i]<np.max(map_bmaj)*tol:
+            continue
+        j=np.arange(i+1)
+        j=j[(bgaxis[j]>=np.max(map_bmin)*tol) & (bgaxis[i]*bgaxis[j]<minsize)]
+        if len(j)==0:
+            continue
+        bmin,bpa=np.meshgrid(bgaxis[j],bpaxis,indexing='ij')
+        bmin=bmin.ravel()
+        bpa=bpa.ravel()
+        bmaj=np.ones_like(bmin)*bgaxis[i]
+        best=smallest_feasible(bmaj,bmin,bpa,map_bmaj,map_bmin,map_bpa)
+        if best is not None and bmaj[best]*bmin[best]<minsize:
+            minsize=bmaj[best]*bmin[best]
+            smallest=(bmaj[best],bmin[best],bpa[best])
+
+    if smallest is None or not refine:
+        return smallest
+
+    # Refine on successively finer local grids around the best point.
+    # The current best point is always on the grid, so this can only
+    # reduce the area.
+    bstep=bgaxis[1]-bgaxis[0]
+    pstep=bpaxis[1]-bpaxis[0]
+    for it in range(4):
+        offsets=np.linspace(-1.0,1.0,21)
+        bmaj,bmin,bpa=np.meshgrid(smallest[0]+bstep*offsets,smallest[1]+bstep*offsets,smallest[2]+pstep*offsets,indexing='ij')
+        bmaj=bmaj.ravel()
+        bmin=bmin.ravel()
+        bpa=bpa.ravel()
+        keep=(bmin<=bmaj) & (bmin>0)
+        best=smallest_feasible(bmaj[keep],bmin[keep],bpa[keep],map_bmaj,map_bmin,map_bpa)
+        if best is not None:
+            bpa_best=bpa[keep][best]
+            # keep the position angle in the range of the coarse grid
+            bpa_best=np.mod(bpa_best+np.pi/2.0,np.pi)-np.pi/2.0
+            smallest=(bmaj[keep][best],bmin[keep][best],bpa_best)
+        bstep/=10.0
+        pstep/=10.0
 
     return smallest
 
-def convolve_all(files,resolution,run):
+def convolve_all(files,resolution,dryrun=False,ncpu=None,cache=None):
     
-    bmaj,bmin,bpa=resolution
-    bpa*=180.0/np.pi
-
     print 'Convolving everything to a resolution of ',resolution
-    rstr=str(bmaj)+','+str(bmin)
 
+    if cache is None:
+        cache=stagecache.StageCache()
+    command='convolve to '+str(resolution)
+    jobs=[]
     for f in files:
         outfile=f[:-5]+'_conv.fits'
-        if not os.path.exists(outfile):
+        if not cache.fresh([outfile],[f],command=command):
             print 'Doing',f,'output to',outfile
-            run('fits op=xyin in='+f+' out=tmp')
-            run('convol map=tmp fwhm='+rstr+' pa='+str(bpa)+' options=final out=tmp_out')
-            run('fits op=xyout in=tmp_out out='+outfile)
-            run('rm -r tmp tmp_out')
+            jobs.append((f,[(outfile,resolution)]))
         else:
             print 'Convolved file',outfile,'already exists'
+    if not(dryrun):
+        fftconvolve.convolve_files(jobs,ncpu)
+        for f,targets in jobs:
+            cache.store([targets[0][0]],[f],command=command)
 
 def findrms(filename,region):
     import pyregion
@@ -155,7 +198,8 @@ if __name__=='__main__':
     processedpath=cfg.get('paths','processed')
     do_makecat=cfg.getoption('combine','makecat',False)
     os.chdir(processedpath)
-    run=config.runner(cfg.getoption('control','dryrun',False)).run
+    dryrun=cfg.getoption('control','dryrun',False)
+    run=config.runner(dryrun).run
 
     try:
         suffix=cfg.get('combine','suffix')
@@ -167,11 +211,21 @@ if __name__=='__main__':
     except config.NoOptionError:
         bandgroups=0
 
+    try:
+        ncpu=int(cfg.get('combine','ncpu'))
+    except config.NoOptionError:
+        # each worker holds a padded complex transform of a full image
+        ncpu=config.getthreads(4)
+
     # this is the suffix for the masked images, default is the default for
     # the imaging step
 
     doblank=cfg.getoption('combine','blank',False)
     doconvolve=cfg.getoption('combine','convolve',True)
+    if cfg.getoption('combine','stack_float64',False):
+        stackdtype=np.float64
+    else:
+        stackdtype=np.float32
     restored=cfg.getoption('combine','restored',False)
     rmsregion=cfg.get('combine','rmsreg')
     if restored:
@@ -208,7 +262,7 @@ if __name__=='__main__':
         resolution=find_resolution(files)
         print resolution
         report('Doing the convolution')
-        convolve_all(files+cfiles,resolution,run)
+        convolve_all(files+cfiles,resolution,dryrun,ncpu,stagecache.StageCache(cfg))
 
     report('Adaptively stacking images to make detection image')
 
@@ -250,50 +304,29 @@ if __name__=='__main__':
 
     for i,r in enumerate(ranges):
     
-        report('Doing the uncorrected detection image (%i)' % i)
+        report('Doing the uncorrected and corrected stacked images (%i)' % i)
         included=[False]*37
-        s=0
-        w=0
         medrms=np.median(rms[r])
         print 'median rms is',medrms
 
         for band in r:
             if (rms[band]<medrms*2.5 and rms[band]>medrms/2.0):
-                print 'Including',iname[band]
-                fitsfile=fits.open(iname[band])
-                image=fitsfile[0].data[0,0]
-                fitsfile.close()
-                s+=image/(rms[band]**2.0)
-                w+=1.0/(rms[band]**2.0)
+                print 'Including',iname[band],cname[band]
                 included[band]=True
 
-        s/=w
-
         # use this to make sure that FITS headers at least roughly match
         # frequency range in use
         middle=r[1+len(r)/2]
         while not(included[middle]):
             middle-=1
-        fitsfile=fits.open(iname[middle])
-        fitsfile[0].data[0,0]=s
-        fitsfile.writeto('adaptive-stack-%i.fits' % i,clobber=True)
-        fitsfile.close()
-
-        report('Doing the corrected stacked image (for fluxes)')
 
-        for band in r:
-            if included[band]:
-                print 'Including',cname[band]
-                fitsfile=fits.open(cname[band])
-                image=fitsfile[0].data[0,0]
-                fitsfile.close()
-                s+=image/(rms[band]**2.0)
-
-        s/=w
-        fitsfile=fits.open(cname[middle])
-        fitsfile[0].data[0,0]=s
-        fitsfile.writeto('adaptive-stack-corr-%i.fits' % i,clobber=True)
-        fitsfile.close()
+        use=[band for band in r if included[band]]
+        adaptivestack.adaptive_stack([(iname[band],cname[band]) for band in use],
+                                     [1.0/(rms[band]**2.0) for band in use],
+                                     'adaptive-stack-%i.fits' % i,
+                                     'adaptive-stack-corr-%i.fits' % i,
+                                     iname[middle],cname[middle],
+                                     dtype=stackdtype)
 
 if do_makecat:
     makecat('adaptive-stack-corr-0.fits')
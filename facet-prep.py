@@ -6,13 +6,7 @@
 import sys
 import config
 import os.path
-import pyrap.tables as pt
-
-def getfreq(ms):
-    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-    freq = t[0]['REF_FREQUENCY']
-    t.close()
-    return freq
+import manifest
 
 die=config.die
 report=config.report
@@ -65,7 +59,7 @@ else:
     run('NDPPP '+ndpppname)
 
     report('Run RFICONSOLE again')
-    run('rficonsole -j 8 '+avems)
+    run('rficonsole -j '+str(config.getthreads())+' '+avems)
 
 report('Phase-only calibration')
 clusteredmodel=troot+'_B'+bs+'_skymodel_clustered.txt'
@@ -74,7 +68,7 @@ if os.path.isfile(clusteredmodel):
     warn('Skymodel already exists, not making it')
 else:
     
-    freq=getfreq(ms)
+    freq=manifest.getfreq(ms)
     skymodel=cfg.get('skymodel','file')
     if not(os.path.isfile(skymodel)):
         die('Skymodel file '+skymodel+' does not exist!')
@@ -89,14 +83,14 @@ else:
 
 if not(os.path.isdir(it_template)):
     report('Making instrument template')
-    run('calibrate-stand-alone --numthreads 8 -f '+avems+' /home/mjh/git/facet-calibration/ap_bbstemplate.parset '+clusteredmodel)
+    run('calibrate-stand-alone --numthreads '+str(config.getthreads())+' -f '+avems+' /home/mjh/git/facet-calibration/ap_bbstemplate.parset '+clusteredmodel)
     run('mv '+avems+'/instrument '+it_template)
 
 
 if not(ave_exists):
 
     report('Doing the phase calibration')
-    run('calibrate-stand-alone --numthreads 8 -f '+avems+' /home/mjh/lofar/text/bbs-phaseonly-first-nocorrect '+clusteredmodel)
+    run('calibrate-stand-alone --numthreads '+str(config.getthreads())+' -f '+avems+' /home/mjh/lofar/text/bbs-phaseonly-first-nocorrect '+clusteredmodel)
 
     report('Applying the beam')
     run('applybeam.py '+avems)
@@ -110,4 +104,4 @@ run('/home/mjh/git/facet-calibration/parmdbcopy_phaseonlyparmdb_to_ap.py '+final
 
 report('Apply calibration')
 
-run('calibrate-stand-alone -v --parmdb-name instrument_ap_smoothed --numthreads 8 '+finalms+' /home/mjh/lofar/text/wendy-apply.txt')
+run('calibrate-stand-alone -v --parmdb-name instrument_ap_smoothed --numthreads '+str(config.getthreads())+' '+finalms+' /home/mjh/lofar/text/wendy-apply.txt')
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+# Convolve FITS images to a lower resolution in-process, replacing the
+# miriad fits/convol/fits round trip. The Gaussian needed to reach each
+# target beam is applied as an analytic transfer function to a real FFT
+# of the image, so several target resolutions can be made from one
+# forward transform.
+
+import os.path
+import sys
+import numpy as np
+from astropy.io import fits
+
+# numpy.fft always transforms in double precision; the padded image is
+# held as float32 and each output is converted back to float32, so
+# only the transform itself is done at double size
+from numpy.fft import rfft2,irfft2
+
+def convolve_resolution(bmaj1,bmin1,bpa1,bmaj2,bmin2,bpa2):
+
+    '''
+    Work out the 'parameters of a Gaussian deconvolved with another
+    Gaussian. In other words, the parameters needed to convolve a map
+    of a given resolution to another, specified resolution. Here
+    bmaj1,bmin1,bpa1 are the desired final resolution -- should be
+    floats. bmaj2, bmin2, bpa2 are the resolution of the map(s) of
+    interest. Position angles are assumed to be in radians. The
+    returned tuple is of the same size as (bmaj2,bmin2,bpa2).
+
+    Unlike the original Fortran code there is no error checking.
+    Errors are signalled by the presence of NaNs in the returned
+    arrays: use np.isnan to check whether the convolution can be
+    performed.
+    '''
+
+#import to assist in direct copy of Fortran
+    from numpy import sin,cos,arctan2,sqrt
+
+    theta1=bpa1
+    theta2=bpa2
+
+    alpha=((bmaj1*cos(theta1))**2 + (bmin1*sin(theta1))**2-
+           (bmaj2*cos(theta2))**2 - (bmin2*sin(theta2))**2)
+    beta=((bmaj1*sin(theta1))**2 + (bmin1*cos(theta1))**2 -
+          (bmaj2*sin(theta2))**2 - (bmin2*cos(theta2))**2)
+    gamma  = 2.0*( (bmin1**2-bmaj1**2)*sin(theta1)*cos(theta1) -
+                   (bmin2**2-bmaj2**2)*sin(theta2)*cos(theta2) )
+
+    s = alpha + beta
+    t = sqrt((alpha-beta)**2 + gamma**2)
+
+    bmaj = sqrt(0.5*(s+t))
+    bmin = sqrt(0.5*(s-t))
+    bpa = 0.5 * arctan2(-gamma,alpha-beta)
+
+    return bmaj,bmin,bpa
+
+gfactor=2.0*np.sqrt(2.0*np.log(2.0))
+
+def beam_cov(bmaj,bmin,bpa,cdelt1,cdelt2):
+
+    '''
+    Return the covariance matrix, in pixels, of a Gaussian with FWHM
+    bmaj, bmin (arcsec) and position angle bpa (radians, north through
+    east). cdelt1, cdelt2 are the signed pixel sizes in arcsec.
+    '''
+
+    smaj=bmaj/gfactor
+    smin=bmin/gfactor
+    # unit vectors along the axes in (east,north)
+    u=np.array([np.sin(bpa),np.cos(bpa)])
+    v=np.array([np.cos(bpa),-np.sin(bpa)])
+    cov=smaj**2.0*np.outer(u,u)+smin**2.0*np.outer(v,v)
+    # x increases with RA (east) when cdelt1>0, y with dec
+    t=np.diag([1.0/cdelt1,1.0/cdelt2])
+    return np.dot(t,np.dot(cov,t))
+
+def gaussian_transfer(ny,nx,cov):
+
+    '''
+    Fourier transform of a unit-integral Gaussian with pixel covariance
+    cov, on the grid returned by rfft2 for an (ny,nx) image.
+    '''
+
+    ky=np.fft.fftfreq(ny)[:,np.newaxis]
+    kx=np.fft.rfftfreq(nx)[np.newaxis,:]
+    q=cov[0,0]*kx**2.0+2.0*cov[0,1]*kx*ky+cov[1,1]*ky**2.0
+    return np.exp(-2.0*np.pi**2.0*q).astype(np.float32)
+
+def goodsize(n):
+
+    '''
+    Smallest integer >= n with no prime factors other than 2, 3 and 5.
+    '''
+
+    while True:
+        m=n
+        for p in (2,3,5):
+            while m%p==0:
+                m//=p
+        if m==1:
+            return n
+        n+=1
+
+def convolve_image(infile,targets):
+
+    '''
+    Convolve infile to each of the resolutions in targets, a list of
+    (outfile,(bmaj,bmin,bpa)) with bmaj, bmin in arcsec and bpa in
+    radians. The output is in Jy/beam for the new beam, as with
+    miriad convol options=final. Blanked pixels stay blanked.
+    '''
+
+    hdu=fits.open(infile)
+    prhd=hdu[0].header
+    cdelt1=3600.0*prhd['CDELT1']
+    cdelt2=3600.0*prhd['CDELT2']
+    obmaj=3600.0*prhd['BMAJ']
+    obmin=3600.0*prhd['BMIN']
+    obpa=prhd['BPA']*np.pi/180.0
+
+    kernels=[]
+    for outfile,(bmaj,bmin,bpa) in targets:
+        kmaj,kmin,kpa=convolve_resolution(bmaj,bmin,bpa,obmaj,obmin,obpa)
+        if np.isnan(kmaj) or np.isnan(kmin) or np.isnan(kpa):
+            raise Exception('Cannot convolve '+infile+' to resolution '+str((bmaj,bmin,bpa)))
+        kernels.append(beam_cov(kmaj,kmin,kpa,cdelt1,cdelt2))
+
+    image=hdu[0].data[0,0]
+    ny,nx=image.shape
+    blank=np.isnan(image)
+
+    # pad by five sigma of the widest kernel to avoid wrap-around
+    margin=int(np.ceil(5.0*np.sqrt(max([np.max(np.linalg.eigvalsh(k)) for k in kernels]+[0.0]))))
+    py=goodsize(ny+2*margin)
+    px=goodsize(nx+2*margin)
+    padded=np.zeros((py,px),dtype=np.float32)
+    padded[:ny,:nx]=np.where(blank,0.0,image)
+    ft=rfft2(padded)
+    del padded
+
+    for (outfile,(bmaj,bmin,bpa)),cov in zip(targets,kernels):
+        print 'Convolving',infile,'to',bmaj,bmin,bpa*180.0/np.pi,'output to',outfile
+        conv=irfft2(ft*gaussian_transfer(py,px,cov),s=(py,px))[:ny,:nx]
+        conv=conv.astype(np.float32)*(bmaj*bmin/(obmaj*obmin))
+        conv[blank]=np.nan
+        hdu[0].data[0,0]=conv
+        prhd['BMAJ']=bmaj/3600.0
+        prhd['BMIN']=bmin/3600.0
+        prhd['BPA']=bpa*180.0/np.pi
+        hdu.writeto(outfile,clobber=True)
+
+    hdu.close()
+
+def convolve_job(job):
+    infile,targets=job
+    convolve_image(infile,targets)
+    return infile
+
+def convolve_files(jobs,ncpu=None):
+
+    '''
+    Run convolve_image over a list of (infile,targets) jobs on a pool of
+    ncpu processes (by default one per available CPU).
+    '''
+
+    if len(jobs)==0:
+        return
+    if ncpu is None:
+        import config
+        ncpu=config.getcpus()
+    ncpu=min(ncpu,len(jobs))
+    if ncpu<2:
+        for j in jobs:
+            convolve_job(j)
+    else:
+        import multiprocessing
+        pool=multiprocessing.Pool(ncpu)
+        for infile in pool.imap_unordered(convolve_job,jobs):
+            print 'Finished',infile
+        pool.close()
+        pool.join()
+
+if __name__=='__main__':
+    try:
+        infile=sys.argv[1]
+        targets=[]
+        for i in range(2,len(sys.argv),2):
+            resolution=float(sys.argv[i+1])
+            targets.append((sys.argv[i],(resolution,resolution,0.0)))
+        if len(targets)==0:
+            raise IndexError
+        convolve_image(infile,targets)
+    except IndexError:
+        print 'Syntax: fftconvolve.py infile outfile resolution/arcsec [outfile resolution/arcsec ...]'
@@ -15,7 +15,7 @@ import numpy
 import sys
 import os
 import pylab as pl
-import glob
+import manifest
 
 
 
@@ -155,17 +155,11 @@ try:
 except:
     bad_sblist=[]
 
-mslist = glob.glob(rootname+'_SB*_uv.filter.MS') # all the calibrator datasets
+products = manifest.Manifest(processedpath)
+subbands = products.subbands(rootname,bad_sblist) # all the calibrator datasets
 
-# no need to touch 
-mslist.sort()    #  don't chnage this line
-badsb = ['SB{sb:03d}'.format(sb=sb) for sb in bad_sblist ]
-
-
-index = 1 # element where the SB number is after splitting the ms names with split('_')
-
-# make the subband list, exclude the badsb and ms without instrument tables
-sblist = [ int(d.split('_')[index].replace('SB','')) for d in mslist if (d.split('_')[index] not in badsb) and (os.path.exists(d + '/instrument'))] 
+# make the subband list, exclude ms without instrument tables
+sblist = [ sb for sb in sorted(subbands) if os.path.exists(subbands[sb] + '/instrument')] 
      
 instlist = [ rootname+'_SB{sb:03d}_uv.filter.MS/instrument'.format(sb=sb) for sb in sblist] 
 mslist   = [ rootname+'_SB{sb:03d}_uv.filter.MS'.format(sb=sb) for sb in sblist] # replaces previous list with bad SB removed
@@ -198,10 +192,7 @@ for iinst,inst in enumerate(instlist):
 
     ms = mslist[iinst] 
     print inst, ms
-    t          = pt.table(ms, readonly=False)
-    freq_tab   = pt.table(ms + '/SPECTRAL_WINDOW')
-    freq       = freq_tab.getcol('REF_FREQUENCY')
-    t.close()
+    freq       = products.frequency(ms)
     #print 'Frequency of MS', freq
 
     freq_per_sb[iinst] = freq
@@ -9,7 +9,7 @@ import time
 import numpy
 import math
 import pyrap.tables
-import pp
+import scipy.optimize
 import scipy.signal
 from pylab import *
 import sys, os, glob, re
@@ -25,6 +25,7 @@ from losoto.h5parm import h5parm, solWriter, solFetcher
 import multiprocessing as mp
 #import lofar.expion.fitting as fitting
 import config
+import windowfilter
 die=config.die
 report=config.report
 warn=config.warn
@@ -46,7 +47,7 @@ globaldbname = 'cal.h5' # input h5 parm file
 t = pt.table('globaldb/OBSERVATION', readonly=True, ack=False)
 calsource=t[0]['LOFAR_TARGET'][0]
 
-ncpus        = 16 # number of CPUs avaulable for parallel fitting
+ncpus        = config.getcpus() # number of CPUs available for parallel fitting
 
 pi = numpy.pi
 c  = 2.99792458e8
@@ -65,79 +66,6 @@ anttab = ionmodel.getAnt('sol000')
 source_id     = 0  # source ID in global_db (usually 0)
 
 
-def median_window_filter(ampl, half_window, threshold):
-    ampl_tot_copy = numpy.copy(ampl)
-    ndata = len(ampl)
-    flags = numpy.zeros(ndata, dtype=bool)
-    sol = numpy.zeros(ndata+2*half_window)
-    sol[half_window:half_window+ndata] = ampl
-
-    for i in range(0, half_window):
-        # Mirror at left edge.
-        idx = min(ndata-1, half_window-i)
-        sol[i] = ampl[idx]
-
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        sol[ndata+half_window+i] = ampl[idx]
-
-    #fix oct 2012
-    median_array  = scipy.signal.medfilt(sol,int(half_window*2.-1))
-
-    sol_flag = numpy.zeros(ndata+2*half_window, dtype=bool)
-    sol_flag_val = numpy.zeros(ndata+2*half_window, dtype=bool)
-
-    for i in range(half_window, half_window + ndata):
-        # Compute median of the absolute distance to the median.
-        window = sol[i-half_window:i+half_window+1]
-        window_flag = sol_flag[i-half_window:i+half_window+1]
-        window_masked = window[~window_flag]
-
-        if len(window_masked) < math.sqrt(len(window)):
-            # Not enough data to get accurate statistics.
-            continue
-
-        median = numpy.median(window_masked)
-        q = 1.4826 * numpy.median(numpy.abs(window_masked - median))
-
-        # Flag sample if it is more than 1.4826 * threshold * the
-        # median distance away from the median.
-        if abs(sol[i] - median) > (threshold * q):
-            sol_flag[i] = True
-
-    mask = sol_flag[half_window:half_window + ndata]
-
-    for i in range(len(mask)):
-        if mask[i]:
-           ampl_tot_copy[i] = median_array[half_window+i] # fixed 2012
-    return ampl_tot_copy
-    
-    
-def running_median(ampl,half_window) :
-
-    ampl_tot_copy = numpy.copy(ampl)
-
-    ndata = len(ampl)
-    flags = numpy.zeros(ndata, dtype=bool)
-    sol = numpy.zeros(ndata+2*half_window)
-    sol[half_window:half_window+ndata] = ampl
-    std = numpy.zeros(len(ampl))
-
-    for i in range(0, half_window):
-        # Mirror at left edge.
-        idx = min(ndata-1, half_window-i)
-        sol[i] = ampl[idx]
-
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        sol[ndata+half_window+i] = ampl[idx]
-    
-    for i in range(len(ampl)):
-      #print i, i+half_window
-      std[i] =  numpy.median(sol[i:i+(2*half_window)])  
-
-    return std
-
 def fit_dTEC_dclock_dFR(phases_rr, phases_ll, amp_rr, amp_ll, freq, distance_station):
       c = 2.99792458e8
       freq_old = numpy.copy(freq)
@@ -190,60 +118,64 @@ def fit_dTEC_dclock_dFR(phases_rr, phases_ll, amp_rr, amp_ll, freq, distance_sta
       
       if len(freq) > 10: 
       
-	# FIND INTIAL GUESS
-	for dTEC in numpy.arange(-1.0,1.0, 0.01):
-	 for dclock in numpy.arange(-200e-9,200e-9,5e-9):
-            phase_model = numpy.mod ( (4.*pi*dclock*freq) - (2.*8.44797245e9*dTEC/freq), 2*pi)  # NOTE THE *2 to use rr+ll instead of 0.5*(rr+ll)
-            phase_data  = numpy.mod (phase, 2*pi)
-	    angle       = pi - numpy.abs(numpy.abs(phase_model - phase_data) - pi)
-	    chi = numpy.sum(angle)
-
-	    if chi < chi_old:
-	      chi_old = chi
-	      fitguess     = [dclock,dTEC]
-	      #print 'Better fit', dclock, dTEC
-
-	fitguess_1 = numpy.copy(fitguess)
-	#print 'iter 1', fitguess
-
-	for dTEC in numpy.arange(fitguess_1[1]-0.02,fitguess_1[1]+0.02, 0.002):
-	 for dclock in numpy.arange(fitguess_1[0]-8e-9,fitguess_1[0]+ 8e-9,1e-9):
+        # FIND INTIAL GUESS
+        # The chi surfaces are evaluated as arrays over (grid, freq), a
+        # block of dTEC values at a time to bound memory, instead of one
+        # phase model per grid point. argmin returns the first minimum in
+        # the order of the old nested loops, so the guesses are the same.
+        def clocktec_chi(dTECs, dclocks, phase_data):
+          chi = numpy.zeros((len(dTECs), len(dclocks)))
+          for i in range(0, len(dTECs), 20):
+            dTEC        = dTECs[i:i+20, numpy.newaxis, numpy.newaxis]
+            dclock      = dclocks[numpy.newaxis, :, numpy.newaxis]
             phase_model = numpy.mod ( (4.*pi*dclock*freq) - (2.*8.44797245e9*dTEC/freq), 2*pi)  # NOTE THE *2 to use rr+ll instead of 0.5*(rr+ll)
-            phase_data  = numpy.mod (phase, 2*pi)
-	    angle       = pi - numpy.abs(numpy.abs(phase_model - phase_data) - pi)
-	    chi = numpy.sum(angle)
-
-	    if chi < chi_old:
-	      chi_old = chi
-	      fitguess     = [dclock,dTEC]
-	      #print 'Better fit', dclock, dTEC
+            angle       = pi - numpy.abs(numpy.abs(phase_model - phase_data) - pi)
+            chi[i:i+20] = numpy.sum(angle, axis=-1)
+          return chi
 
-
-	#print 'iter 2', fitguess
-
-	chi_old = 1e9
-	for dFR in numpy.arange(-0.1,0.1,2e-4):
-          phase_model = numpy.mod (2.*dFR*wav*wav, 2*pi) # notice the factor of 2
-	  phase_data  = numpy.mod (phase_diff, 2*pi)
-          angle       = pi - numpy.abs(numpy.abs(phase_model - phase_data) - pi)
-	  chi = numpy.sum(angle)
-
-	  if chi < chi_old:
-	    chi_old = chi
-	    fitrmguess     = dFR
-	    #print 'Better fit', fitrmguess
-
-	fitrmguess_1 = numpy.copy(fitrmguess)
-	for dFR in numpy.arange(fitrmguess_1-5e-4,fitrmguess_1+5e-4,0.5e-5):
-          phase_model = numpy.mod (2.*dFR*wav*wav, 2*pi) # notice the factor of 2
-	  phase_data  = numpy.mod (phase_diff, 2*pi)
+        def rm_chi(dFRs, phase_data):
+          phase_model = numpy.mod (2.*dFRs[:, numpy.newaxis]*wav*wav, 2*pi) # notice the factor of 2
           angle       = pi - numpy.abs(numpy.abs(phase_model - phase_data) - pi)
-	  chi = numpy.sum(angle)
-
-	  if chi < chi_old:
-	    chi_old = chi
-	    fitrmguess     = dFR
-	    #print 'Better fit', fitrmguess
+          return numpy.sum(angle, axis=-1)
+
+        phase_data = numpy.mod (phase, 2*pi)
+        dTECs      = numpy.arange(-1.0,1.0, 0.01)
+        dclocks    = numpy.arange(-200e-9,200e-9,5e-9)
+        chi        = clocktec_chi(dTECs, dclocks, phase_data)
+        i, j       = numpy.unravel_index(numpy.argmin(chi), chi.shape)
+        if chi[i,j] < chi_old:
+          chi_old  = chi[i,j]
+          fitguess = [dclocks[j],dTECs[i]]
+
+        fitguess_1 = numpy.copy(fitguess)
+        #print 'iter 1', fitguess
+
+        dTECs      = numpy.arange(fitguess_1[1]-0.02,fitguess_1[1]+0.02, 0.002)
+        dclocks    = numpy.arange(fitguess_1[0]-8e-9,fitguess_1[0]+ 8e-9,1e-9)
+        chi        = clocktec_chi(dTECs, dclocks, phase_data)
+        i, j       = numpy.unravel_index(numpy.argmin(chi), chi.shape)
+        if chi[i,j] < chi_old:
+          chi_old  = chi[i,j]
+          fitguess = [dclocks[j],dTECs[i]]
+
+        #print 'iter 2', fitguess
+
+        chi_old    = 1e9
+        phase_data = numpy.mod (phase_diff, 2*pi)
+        dFRs       = numpy.arange(-0.1,0.1,2e-4)
+        chi        = rm_chi(dFRs, phase_data)
+        i          = numpy.argmin(chi)
+        if chi[i] < chi_old:
+          chi_old     = chi[i]
+          fitrmguess  = dFRs[i]
+
+        fitrmguess_1 = numpy.copy(fitrmguess)
+        dFRs       = numpy.arange(fitrmguess_1-5e-4,fitrmguess_1+5e-4,0.5e-5)
+        chi        = rm_chi(dFRs, phase_data)
+        i          = numpy.argmin(chi)
+        if chi[i] < chi_old:
+          chi_old     = chi[i]
+          fitrmguess  = dFRs[i]
 
         # DO THE FITTING 
         # SOLVE Clock-TEC anticorrelation problem on short baselines             
@@ -328,11 +260,6 @@ A[:,0] = amptab.freq[:]*2*pi
 A[:,1] = -8.44797245e9/amptab.freq[:]
 sol = numpy.zeros((len(amptab.ant), 2))
 
-clockfit = 0.*numpy.copy(amptab.time)
-TECfit   = 0.*numpy.copy(amptab.time)
-RMfit   = 0.*numpy.copy(amptab.time)
-phaseoffset = 0.*numpy.copy(amptab.time)
-
 clockarray = numpy.zeros([len(amptab.time),len(amptab.ant)])
 tecarray   = numpy.zeros([len(amptab.time),len(amptab.ant)])
 rmarray    = numpy.zeros([len(amptab.time),len(amptab.ant)])
@@ -342,11 +269,6 @@ print 'REF STATION:', amptab.ant[refantenna_id]
 print '# TIMESLOTS  ', len(amptab.time)
 print '# FREQUENCIES', len(amptab.freq)
 
-ppservers = ()
-# Creates jobserver with ncpus workers
-job_server = pp.Server(ncpus, ppservers=ppservers)
-print "Starting pp with", job_server.get_ncpus(), "workers"
-
 
 phases_all = numpy.copy(phasetab.val)
 #phases_all = numpy.load('../phases_3C196.npy')
@@ -391,52 +313,48 @@ for ss in range(0,len(phasetab.ant[:])):
 #for antenna_id in range(len(ionmodel.stations[:])-N_RS,  len(ionmodel.stations[:])) :
 
 freq       = numpy.copy(phasetab.freq)
+amps_all   = numpy.copy(amptab.val)
 
+distance_station = numpy.zeros(len(phasetab.ant[:]))
 for antenna_id in range(1,  len(phasetab.ant[:])) :
-
-
-
- if antenna_id != refantenna_id:
-   stationspos      =  anttab[phasetab.ant[refantenna_id]] - anttab[phasetab.ant[antenna_id]]
-   distance_station = numpy.sqrt(stationspos[0]**2 + stationspos[1]**2 + stationspos[2]**2)
-   print 'Distance stations to reference station', distance_station/1e3, ' km'
-
-   jobs = []
-
-   for time_id in range(start_time_id,stop_time_id):
-   #for time_id in range(3050,3051):
-     
-          
-     
-     phases_rr = numpy.copy((phases_all[0,source_id,antenna_id,:,time_id] \
-	  -phases_all[0,source_id,refantenna_id,:,time_id])) 
-     phases_ll = numpy.copy((phases_all[1,source_id,antenna_id,:,time_id] \
-	  -phases_all[1,source_id,refantenna_id,:,time_id]))
-
-     # -------- filter bad data: where amplitudes equal 1.0 -----------
-     amp_rr = numpy.copy(amptab.val[0,source_id,antenna_id,:,time_id]) 
-     amp_ll = numpy.copy(amptab.val[0,source_id,antenna_id,:,time_id])
-                 
-
-     jobs.append(job_server.submit(fit_dTEC_dclock_dFR,(phases_rr, phases_ll, amp_rr, amp_ll, freq, distance_station),(), ("numpy","scipy.optimize","matplotlib.pyplot",)))
-     print 'Submitting job #', time_id
-     
-
-   i= 0
-   for job in jobs:
-     fitresult = job()
-
-     clockfit[start_time_id+i]  = fitresult[0]
-     TECfit[start_time_id+i]    = fitresult[1]
-     RMfit[start_time_id+i]     = fitresult[3]
-     phaseoffset[start_time_id+i]  =  fitresult[2]
-
-     clockarray[start_time_id+i,antenna_id] = fitresult[0]
-     tecarray[start_time_id+i,antenna_id]   = fitresult[1]
-     rmarray[start_time_id+i,antenna_id]    = fitresult[3]
-     phaseoffsetarray[start_time_id+i,antenna_id] = fitresult[2] 
-     print 'TIME_ID', start_time_id+i, 'FIT (dclock, dTEC, offset, dRM)', fitresult
-     i = i + 1
+  if antenna_id != refantenna_id:
+    stationspos      =  anttab[phasetab.ant[refantenna_id]] - anttab[phasetab.ant[antenna_id]]
+    distance_station[antenna_id] = numpy.sqrt(stationspos[0]**2 + stationspos[1]**2 + stationspos[2]**2)
+    print 'Distance', phasetab.ant[antenna_id], 'to reference station', distance_station[antenna_id]/1e3, ' km'
+
+def fit_task(task):
+  # runs in a forked worker: phases_all, amps_all, freq and
+  # distance_station are inherited from the parent, so only the
+  # (antenna, time) pair and the fit result cross the pipe
+  antenna_id, time_id = task
+  phases_rr = (phases_all[0,source_id,antenna_id,:,time_id] \
+               -phases_all[0,source_id,refantenna_id,:,time_id])
+  phases_ll = (phases_all[1,source_id,antenna_id,:,time_id] \
+               -phases_all[1,source_id,refantenna_id,:,time_id])
+
+  # -------- filter bad data: where amplitudes equal 1.0 -----------
+  amp_rr = numpy.copy(amps_all[0,source_id,antenna_id,:,time_id])
+  amp_ll = numpy.copy(amps_all[0,source_id,antenna_id,:,time_id])
+
+  return antenna_id, time_id, fit_dTEC_dclock_dFR(phases_rr, phases_ll, amp_rr, amp_ll, freq, distance_station[antenna_id])
+
+# one flat list of (antenna, time) fits, so that all workers stay busy
+# across antenna boundaries
+tasks = [(antenna_id, time_id) for antenna_id in range(1, len(phasetab.ant[:])) \
+         if antenna_id != refantenna_id \
+         for time_id in range(start_time_id,stop_time_id)]
+print 'Fitting', len(tasks), 'antenna/time slots with', ncpus, 'workers'
+
+pool = mp.Pool(ncpus)
+chunksize = max(1, len(tasks)/(4*ncpus))
+for antenna_id, time_id, fitresult in pool.imap_unordered(fit_task, tasks, chunksize):
+  clockarray[time_id,antenna_id] = fitresult[0]
+  tecarray[time_id,antenna_id]   = fitresult[1]
+  rmarray[time_id,antenna_id]    = fitresult[3]
+  phaseoffsetarray[time_id,antenna_id] = fitresult[2]
+  print 'ANTENNA', phasetab.ant[antenna_id], 'TIME_ID', time_id, 'FIT (dclock, dTEC, offset, dRM)', fitresult
+pool.close()
+pool.join()
 
 
 
@@ -447,28 +365,20 @@ numpy.save('fitted_data_dTEC_'   + calsource + '_1st.npy', tecarray)
 
 
 
-for antenna_id in range(0, len(amptab.ant[:])):
-   print 'Cleaning up Clock and TEC values for: ', amptab.ant[antenna_id]
-   clockfit = clockarray[:,antenna_id]
-   TECfit   = tecarray[:,antenna_id]
- 
-   clockfit = median_window_filter(clockfit, 7, 5)
-   TECfit   = median_window_filter(TECfit, 5, 5)
+# clean up the clock and TEC solutions of all antennas at once
+print 'Cleaning up Clock and TEC values'
+clockarray = windowfilter.median_window_filter(clockarray, 7, 5)
+tecarray   = windowfilter.median_window_filter(tecarray, 5, 5)
 
-   clockfit = median_window_filter(clockfit, 5, 3)
-   TECfit   = median_window_filter(TECfit, 5, 3)
-   
-   clockfit = median_window_filter(clockfit, 3, 3)
-   TECfit   = median_window_filter(TECfit, 3, 3)
+clockarray = windowfilter.median_window_filter(clockarray, 5, 3)
+tecarray   = windowfilter.median_window_filter(tecarray, 5, 3)
 
-   clockfit = running_median(clockfit, 3)
-   TECfit = running_median(TECfit, 3)
+clockarray = windowfilter.median_window_filter(clockarray, 3, 3)
+tecarray   = windowfilter.median_window_filter(tecarray, 3, 3)
+
+clockarray = windowfilter.running_median(clockarray, 3)
+tecarray   = windowfilter.running_median(tecarray, 3)
 
-   
-   clockarray[:,antenna_id] = clockfit
-   tecarray[:,antenna_id]   = TECfit
-   #matplotlib.pyplot.plot(clockarray[:,antenna_id])
-   
 
 os.system('rm -f ' + 'fitted_data_dclock_' + calsource + '_1st.sm.npy')
 os.system('rm -f ' + 'fitted_data_dTEC_'   + calsource + '_1st.sm.npy')
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+# Apply the pre-calibration flagging rules of calib.py in a single pass
+# over a MeasurementSet: each block of rows is read once, every rule is
+# applied in memory and FLAG is written back in place.
+
+import fnmatch
+import pyrap.tables as pt
+import numpy as np
+
+# number of visibilities (rows x channels x correlations) read at once
+BLOCKSIZE=1<<24
+
+def antenna_names(msname):
+    t=pt.table(msname+'/ANTENNA',readonly=True,ack=False)
+    names=list(t.getcol('NAME'))
+    t.close()
+    return names
+
+def antenna_patterns(spec,names=None):
+
+    '''
+    Turn an NDPPP preflagger baseline string that just lists antennas,
+    e.g. '[CS013HBA*, RS509HBA]', into a list of patterns. Returns None
+    for anything more complicated (baseline pairs, brace lists,
+    negation), or, if the antenna names are given, if any pattern
+    matches none of them: such strings must still be given to NDPPP.
+    '''
+
+    spec=spec.strip()
+    if spec.startswith('[') and spec.endswith(']'):
+        spec=spec[1:-1]
+    for c in '&!^;[]{}':
+        if c in spec:
+            return None
+    patterns=[s.strip() for s in spec.split(',') if s.strip()]
+    if not patterns:
+        return None
+    if names is not None:
+        for p in patterns:
+            if not(np.any(select_antennas(names,[p]))):
+                return None
+    return patterns
+
+def select_antennas(names,patterns):
+    return np.array([any(fnmatch.fnmatchcase(n,p) for p in patterns) for n in names],dtype=bool)
+
+def flag_ms(msname,badweight=True,clip=None,ears=0,antennas=None,blocksize=BLOCKSIZE):
+
+    '''
+    Flag msname in place, in one pass, with any of these rules:
+
+    badweight: rows with any WEIGHT_SPECTRUM above 1 (not autocorrelations)
+    clip: cross-correlation visibilities with |DATA| above this value
+    ears: this many channels at each edge of the band
+    antennas: baselines with an antenna matching one of these patterns
+
+    Returns a dictionary giving the number of visibilities newly
+    flagged by each rule (in the order above, so each is counted once)
+    and the total.
+    '''
+
+    names=antenna_names(msname)
+    if antennas:
+        badant=select_antennas(names,antennas)
+    else:
+        badant=None
+
+    counts={'badweight':0,'clip':0,'ears':0,'antennas':0,'total':0}
+    t=pt.table(msname,readonly=False,ack=False)
+    nrows=t.nrows()
+    if nrows==0:
+        t.close()
+        return counts
+    nchan,ncorr=t.getcell('FLAG',0).shape
+    step=max(1,blocksize//(nchan*ncorr))
+    if ears>0:
+        earmask=np.zeros((nchan,1),dtype=bool)
+        earmask[:ears]=True
+        earmask[nchan-ears:]=True
+    for start in range(0,nrows,step):
+        nr=min(step,nrows-start)
+        flag=t.getcol('FLAG',start,nr)
+        a1=t.getcol('ANTENNA1',start,nr)
+        a2=t.getcol('ANTENNA2',start,nr)
+        cross=(a1!=a2)
+        new=np.copy(flag)
+        if badweight:
+            w=t.getcol('WEIGHT_SPECTRUM',start,nr)
+            rows=cross & np.any((w>1).reshape(nr,-1),axis=1)
+            before=np.sum(new)
+            new[rows]=True
+            counts['badweight']+=int(np.sum(new)-before)
+        if clip is not None:
+            data=t.getcol('DATA',start,nr)
+            before=np.sum(new)
+            new|=(np.abs(data)>clip) & cross[:,np.newaxis,np.newaxis]
+            counts['clip']+=int(np.sum(new)-before)
+            del data
+        if ears>0:
+            before=np.sum(new)
+            new|=earmask
+            counts['ears']+=int(np.sum(new)-before)
+        if badant is not None:
+            before=np.sum(new)
+            new[badant[a1] | badant[a2]]=True
+            counts['antennas']+=int(np.sum(new)-before)
+        changed=int(np.sum(new)-np.sum(flag))
+        if changed:
+            t.putcol('FLAG',new,start,nr)
+            counts['total']+=changed
+    t.close()
+    return counts
@@ -5,7 +5,47 @@
 import pyrap.tables as pt
 import numpy as np
 
-def flagrms(rootname,threshold=9):
+def antenna_stats(t,an,chunksize=100000):
+
+    '''
+    Stream the main table once in blocks of chunksize rows and return
+    per-antenna mean and standard deviation of the unflagged |XX| and
+    |YY| of CORRECTED_DATA. Each row contributes to the sums of both
+    its antennas (autocorrelations only once), which is equivalent to
+    selecting ANTENNA1=i or ANTENNA2=i for each antenna in turn.
+    '''
+
+    # accumulators: count, sum, sum of squares, for XX and YY
+    acc=np.zeros((2,3,an))
+    nrows=t.nrows()
+    for start in range(0,nrows,chunksize):
+        nr=min(chunksize,nrows-start)
+        a1=t.getcol('ANTENNA1',start,nr)
+        a2=t.getcol('ANTENNA2',start,nr)
+        data=t.getcol('CORRECTED_DATA',start,nr)
+        flag=t.getcol('FLAG',start,nr)
+        cross=(a1!=a2)
+        for p,corr in enumerate((0,3)):
+            good=np.logical_not(flag[:,:,corr])
+            amp=np.where(good,np.abs(data[:,:,corr]),0.0)
+            rowstats=(np.sum(good,axis=1),np.sum(amp,axis=1),np.sum(amp**2.0,axis=1))
+            for k,v in enumerate(rowstats):
+                acc[p,k]+=np.bincount(a1,weights=v,minlength=an)[:an]
+                acc[p,k]+=np.bincount(a2[cross],weights=v[cross],minlength=an)[:an]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean=acc[:,1]/acc[:,0]
+        std=np.sqrt(np.maximum(acc[:,2]/acc[:,0]-mean**2.0,0.0))
+    return mean[0],mean[1],std[0],std[1]
+
+def flagrms(rootname,threshold=9,chunksize=100000,exclude=[]):
+
+    '''
+    Return the names of antennas whose mean amplitude times rms,
+    relative to the median over antennas, exceeds threshold. Antennas
+    in exclude (already flagged) are neither returned nor used for the
+    medians, and neither are antennas with no unflagged data.
+    '''
 
     t = pt.table(rootname+'/ANTENNA', readonly=True, ack=False)
 #antennaname=pt.tablecolumn(t,'NAME')
@@ -15,37 +55,25 @@ def flagrms(rootname,threshold=9):
     print 'There are',an,'antennas'
 
     t=pt.table(rootname, readonly=True, ack=False)
-    xxm=np.zeros(an)
-    yym=np.zeros(an)
-    xxrms=np.zeros(an)
-    yyrms=np.zeros(an)
+    xxm,yym,xxrms,yyrms=antenna_stats(t,an,chunksize)
+    t.close()
     for i,ant in enumerate(antennaname):
-
-        newt=pt.taql('select CORRECTED_DATA,FLAG from $t where ANTENNA1=$i or ANTENNA2=$i')
-        channels,corrs=np.shape(newt[0]['CORRECTED_DATA'])
-
-        xx=newt.getcol('CORRECTED_DATA')[:,:,0]
-        yy=newt.getcol('CORRECTED_DATA')[:,:,3]
-        fxx=np.logical_not(newt.getcol('FLAG'))[:,:,0]
-        fyy=np.logical_not(newt.getcol('FLAG'))[:,:,3]
-        axx=np.abs(xx)
-        ayy=np.abs(yy)
-        xxm[i]=abs(np.mean(axx[fxx]))
-        yym[i]=abs(np.mean(ayy[fyy]))
-        xxrms[i]=np.std(axx[fxx])
-        yyrms[i]=np.std(ayy[fyy])
         print i,ant,xxm[i],yym[i],xxrms[i],yyrms[i]
 
     fsum=(xxm+yym)/2.0
     rmsum=(xxrms+yyrms)/2.0
-    fmed=np.median(fsum)
-    rmmed=np.median(rmsum)
+    use=np.isfinite(fsum) & np.isfinite(rmsum) & np.array([a not in exclude for a in antennaname])
+    if not(np.any(use)):
+        return []
+    fmed=np.median(fsum[use])
+    rmmed=np.median(rmsum[use])
     badness=fsum*rmsum/rmmed/fmed
     flaglist=[]
     for i,ant in enumerate(antennaname):
+        if not(use[i]):
+            continue
         print i,antennaname[i],fsum[i]/fmed,rmsum[i]/rmmed,badness[i],'Flag' if (badness[i]>threshold) else ''
         if badness[i]>threshold:
             flaglist.append(antennaname[i])
 
     return flaglist
-
@@ -5,16 +5,13 @@
 import os
 import sys
 import config
+import stagecache
+import msview
+import wscan
 import os.path
-import pyrap.tables as pt
+import manifest
 import numpy as np
 
-def getfreq(ms):
-    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-    freq = t[0]['REF_FREQUENCY']
-    t.close()
-    return freq
-
 def do_image(run,ms,suffix,npix,cellsize,padding,niter,threshold,uvmin,uvmax,wmax,robust,mask=None,operation='mfclark'):
     imgname=ms.replace('.MS','_'+suffix)
     os.system('rm -r '+imgname+'*')
@@ -66,7 +63,10 @@ if corrected:
     column='CORRECTED_DATA'
 else:
     column='DATA'
-run=config.runner(cfg.getoption('control','dryrun',False)).run
+dryrun=cfg.getoption('control','dryrun',False)
+run=config.runner(dryrun).run
+# select with casacore rather than copying with NDPPP
+usemsview=cfg.getoption('control','msviews',True)
 npix=cfg.get('imaging','npix')
 cellsize=cfg.get('imaging','cellsize')
 padding=cfg.get('imaging','padding')
@@ -80,6 +80,9 @@ try:
 except:
     uvmax=None
 robust=cfg.get('imaging','robust')
+# measure wmax from the data, and optionally adjust npix and padding to suit
+usewscan=cfg.getoption('imaging','wscan',True)
+wscanresize=cfg.getoption('imaging','wscan_resize',False)
 suffix=cfg.get('imaging','suffix')
 
 bs='%02i' % band
@@ -87,7 +90,7 @@ ms=troot+'_B'+bs+'_concat.MS'
 ims=troot+'_B'+bs+'_'+suffix+'.MS'
 
 if uvmax:
-    freq=getfreq(ms)
+    freq=manifest.getfreq(ms)
     uvmax*=np.sqrt(150e6/freq)
     uvmaxs='%.1f' % uvmax
     wmax=(3.0e8/freq)*uvmax*1.0e3
@@ -97,23 +100,68 @@ else:
     uvmaxs=None
     wmax=120000
 
+cache=stagecache.StageCache(cfg)
+
 if applybeam:
-    if os.path.isdir(ims):
+    parset='msin=['+ms+']\nmsin.datacolumn = '+column+'\nmsin.baseline = [CR]S*&\nmsout = '+ims+'\nsteps = []\n'
+    if usemsview:
+        # applybeam.py adds CORRECTED_DATA, so this has to be a real table
+        parset=msview.describe(ms,column)
+    if cache.fresh([ims],[ms],command=parset+'applybeam.py'):
         warn('Imaging MS exists, not copying it again')
     else:
+        if os.path.isdir(ims):
+            warn('Imaging MS is out of date, removing it')
+            run('rm -r '+ims)
         report('Copying file '+ms)
 
-        file=open('NDPPP-temp-'+bs,'w')
-        file.write('msin=['+ms+']\nmsin.datacolumn = '+column+'\nmsin.baseline = [CR]S*&\nmsout = '+ims+'\nsteps = []\n')
-        file.close()
+        if usemsview:
+            print parset
+            if not(dryrun):
+                msview.materialise(ms,ims,column)
+        else:
+            file=open('NDPPP-temp-'+bs,'w')
+            file.write(parset)
+            file.close()
 
-        run('NDPPP NDPPP-temp-'+bs)
+            run('NDPPP NDPPP-temp-'+bs)
 
         report('Applying beam')
         run('applybeam.py '+ims)
+        cache.store([ims],[ms],command=parset+'applybeam.py')
 else:
     ims=ms
 
+if domask:
+    imgname=ims.replace('.MS','_img_masked')
+else:
+    imgname=ims.replace('.MS','_img')
+products=[imgname+'.restored.fits',imgname+'.restored.corr.fits']
+if cache.enabled and cache.fresh(products,[ims],['imaging'],'image.py'):
+    report('Images are up to date, not re-imaging')
+    sys.exit(0)
+
+if usewscan and not(dryrun):
+    report('Scanning w range of '+ims)
+    if applybeam:
+        result=wscan.cached_scan(ims,uvmin,uvmaxs)
+    else:
+        # imaging the band MS itself, so make the selection here
+        result=wscan.cached_scan(ims,uvmin,uvmaxs,'[CR]S*&')
+    print wscan.describe(result)
+    if result['rows']==0:
+        warn('No data in the uv range, keeping wmax='+str(int(wmax)))
+    else:
+        measured,fftnpix,fftpadding=wscan.suggest(result,npix,padding)
+        # never keep data that the uv cut would have dropped before
+        wmax=min(wmax,measured)
+        print 'Using wmax',wmax
+        if wscanresize:
+            npix,padding=fftnpix,fftpadding
+            print 'Using npix',npix,'padding',padding
+        elif (fftnpix,wscan.grid_size(fftnpix,fftpadding))!=(npix,wscan.grid_size(npix,padding)):
+            print 'Suggest npix',fftnpix,'padding',fftpadding
+
 if domask:
     report('Doing initial unmasked image')
     do_image(run,ims,'img',npix,cellsize,padding,maskiter,threshold,uvmin,uvmaxs,wmax,robust,mask=None)
@@ -135,3 +183,8 @@ else:
 
 run('/home/mjh/lofar/bin/tofits.py '+imgname+'.restored')
 run('/home/mjh/lofar/bin/tofits.py '+imgname+'.restored.corr')
+cache.store(products,[ims],['imaging'],'image.py')
+if not(dryrun):
+    index=manifest.Manifest(processedpath)
+    for p in products:
+        index.record(p)
@@ -49,4 +49,4 @@ run('cp -r '+calibms+' '+killms)
 report('Apply phase calibration')
 run('calibrate-stand-alone -n --parmdb '+concatms+'/instrument '+killms+' ~/lofar/text/bbs-apply-phaseonly')
 report('Run killms')
-run('/home/tasse/killMS/killMS/killMS.py --ms='+killms+' --SkyModel='+skymodel+' --NCPU=16 --TChunk=2')
+run('/home/tasse/killMS/killMS/killMS.py --ms='+killms+' --SkyModel='+skymodel+' --NCPU='+str(config.getthreads())+' --TChunk=2')
@@ -5,6 +5,9 @@
 import sys
 import os.path
 import config
+import stagecache
+import msview
+import manifest
 
 die=config.die
 report=config.report
@@ -26,6 +29,8 @@ cfg=config.LocalConfigParser()
 cfg.read(filename)
 dryrun=cfg.getoption('control','dryrun',False)
 run=config.runner(dryrun).run
+# select with casacore rather than copying with NDPPP
+usemsview=cfg.getoption('control','msviews',True)
 
 path=cfg.get('paths','processed')
 troot=cfg.get('files','target')
@@ -50,24 +55,47 @@ orig=troot+'_B'+bs+'_concat.MS'
 if not(os.path.isdir(orig)):
     die('Cannot find original MS '+orig)
 copy=troot+'_B'+bs+'_killMS.MS'
+cache=stagecache.StageCache(cfg)
+killmscmd='/home/tasse/killMS_Pack/killMS2/killMS.py /home/mjh/lofar/text/KillMS.cfg --MSName='+copy+' --SkyModel='+skymodelname+' --NCPU='+ncpu+' --TChunk='+tchunk+' --dt='+dt+' --InCol=DATA --OutCol=CORRECTED_DATA --invert=1 --DoBar=0 --UVMinMax=1,100'
+solutions=copy+'_killMS.CohJones.sols.npz'
+if cache.enabled and cache.fresh([solutions],[orig,skymodelname],command=killmscmd):
+    report('killMS solutions are up to date, not re-running')
+    sys.exit(0)
+
 report('Copying data to '+copy)
-if os.path.isdir(copy):
+parset='msin=['+orig+']\nmsin.datacolumn = CORRECTED_DATA\nmsin.baseline = [CR]S*&\nmsout = '+copy+'\nsteps = []\n'
+if usemsview:
+    # killMS adds and writes columns, so this has to be a real table
+    parset=msview.describe(orig,'CORRECTED_DATA')
+if cache.fresh([copy],[orig],command=parset):
     warn('Copy already exists, not overwriting it!')
 else:
+    if os.path.isdir(copy):
+        warn('Copy is out of date, removing it')
+        run('rm -r '+copy)
     report('Copying file '+orig)
 
-    file=open('NDPPP-temp-'+bs,'w')
-    file.write('msin=['+orig+']\nmsin.datacolumn = CORRECTED_DATA\nmsin.baseline = [CR]S*&\nmsout = '+copy+'\nsteps = []\n')
-    file.close()
+    if usemsview:
+        print parset
+        if not(dryrun):
+            msview.materialise(orig,copy,'CORRECTED_DATA')
+    else:
+        file=open('NDPPP-temp-'+bs,'w')
+        file.write(parset)
+        file.close()
 
-    run('NDPPP NDPPP-temp-'+bs)
+        run('NDPPP NDPPP-temp-'+bs)
+    cache.store([copy],[orig],command=parset)
 
 report('Add CASA imaging columns')
 run('/home/tasse/killMS2/MSTools.py --ms='+copy+' --Operation=CasaCols --TChunk=1')
 report('Run killms')
-run('/home/tasse/killMS_Pack/killMS2/killMS.py /home/mjh/lofar/text/KillMS.cfg --MSName='+copy+' --SkyModel='+skymodelname+' --NCPU='+ncpu+' --TChunk='+tchunk+' --dt='+dt+' --InCol=DATA --OutCol=CORRECTED_DATA --invert=1 --DoBar=0 --UVMinMax=1,100')
+run(killmscmd)
 #run('/home/mjh/killMS2/killMS.py --ms='+copy+' --SkyModel='+skymodelname+' --NCPU='+ncpu+' --TChunk='+tchunk+' --InCol=DATA --OutCol=CORRECTED_DATA --DoBar=0 --UVMinMax=1,100')
 run('mv '+copy+'/killMS.CohJones.sols.npz '+copy+'_killMS.CohJones.sols.npz')
+cache.store([solutions],[orig,skymodelname],command=killmscmd)
+if not(dryrun):
+    manifest.Manifest(path).record(solutions)
 
 # Remove anything left behind, whether killms lived or not
 run('/home/mjh/lofar/surveys-pipeline/tidy-shm.sh')
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Summarise the command ledgers written by config.runner when
+# PIPELINE_LEDGER is set, e.g. across all the jobs of an array run:
+#
+# ledger_summary.py /path/to/ledger [more ledger dirs or files]
+#
+# Totals are given per stage and per program within each stage, most
+# expensive first. Commands that ran alongside others in the same job
+# have no I/O counts; the conc column says how many there were.
+
+import os
+import sys
+import glob
+import json
+
+def read_ledgers(paths):
+    entries=[]
+    for p in paths:
+        if os.path.isdir(p):
+            files=sorted(glob.glob(os.path.join(p,'*.jsonl')))
+        else:
+            files=[p]
+        for f in files:
+            for l in open(f).readlines():
+                l=l.strip()
+                if l:
+                    try:
+                        entries.append(json.loads(l))
+                    except ValueError:
+                        print 'Skipping bad line in',f
+    return entries
+
+def program(command):
+    # the executable name, without path, of a shell command
+    bits=command.split()
+    if len(bits)==0:
+        return ''
+    name=os.path.basename(bits[0])
+    if name in ('python','python2','python2.7') and len(bits)>1:
+        name=os.path.basename(bits[1])
+    return name
+
+def aggregate(entries,key):
+    totals={}
+    for e in entries:
+        k=key(e)
+        t=totals.setdefault(k,{'n':0,'units':set(),'wall':0.0,'cpu':0.0,'maxrss':0,
+                                'read':0,'written':0,'concurrent':0,'failed':0})
+        t['n']+=1
+        t['units'].add(e.get('unit'))
+        t['wall']+=e['wall']
+        t['cpu']+=e['utime']+e['stime']
+        t['maxrss']=max(t['maxrss'],e['maxrss'])
+        t['read']+=e.get('read_bytes',0)
+        t['written']+=e.get('write_bytes',0)
+        if e.get('concurrent'):
+            t['concurrent']+=1
+        if e['status']!=0:
+            t['failed']+=1
+    return totals
+
+def report_table(title,totals):
+    print title
+    print '%-45s %6s %6s %10s %10s %6s %9s %9s %6s %6s' % ('','cmds','units','wall h','cpu h','cpu/w','rss GB','io GB','conc','fail')
+    for k,t in sorted(totals.items(),key=lambda i:-i[1]['wall']):
+        if isinstance(k,tuple):
+            name=' / '.join([str(x) for x in k])
+        else:
+            name=str(k)
+        if t['wall']>0:
+            eff=t['cpu']/t['wall']
+        else:
+            eff=0.0
+        print '%-45s %6i %6i %10.2f %10.2f %6.1f %9.2f %9.2f %6i %6i' % (
+            name[:45],t['n'],len(t['units']),t['wall']/3600.0,t['cpu']/3600.0,eff,
+            t['maxrss']/1048576.0,(t['read']+t['written'])/1e9,t['concurrent'],t['failed'])
+    print
+
+if __name__=='__main__':
+
+    if len(sys.argv)<2:
+        print 'Usage: ledger_summary.py ledger_dir_or_file [...]'
+        sys.exit(1)
+
+    entries=read_ledgers(sys.argv[1:])
+    print 'Read',len(entries),'ledger entries'
+    print
+    report_table('By stage',aggregate(entries,lambda e:e['stage']))
+    report_table('By stage and program',aggregate(entries,lambda e:(e['stage'],program(e['command']))))
@@ -0,0 +1,572 @@
+#!/usr/bin/python
+
+# A small stand-in for a Torque server, to run the .qsub files on a
+# machine or allocation without one. Jobs are kept in a spool
+# directory ($LOCALPBS_SPOOL, default ~/.localpbs) and run by a server
+# process on the local host:
+#
+# localpbs.py server [ncpu] [memGB]   run jobs as they become ready
+# localpbs.py run [ncpu] [memGB]      the same, exiting when all are done
+# localpbs.py qsub [-t 0-36[%4]] [-v CONFIG=...] [-N name] [-l ...]
+#                  [-W depend=afterok:ID[:ID...]] script.qsub
+# localpbs.py qstat [-t] [ID]
+# localpbs.py qdel ID
+#
+# The job script gets PBS_JOBID, PBS_JOBNAME, PBS_ARRAYID,
+# PBS_NODEFILE, PBS_O_WORKDIR and the -v variables, and is started
+# with its #PBS -S shell, its #! line or $SHELL. The CPUs (nodes=1:ppn)
+# and memory (pmem times ppn, or mem) asked for in the script or with
+# -l are reserved while it runs. The job is pinned to CPUs of its own
+# with taskset, if installed, and killed if the resident memory of its
+# processes goes over what it asked for or it runs past its walltime:
+# SIGTERM first, then SIGKILL if it is still there GRACE seconds later.
+#
+# afterok on an array job from an array job is per element: element i
+# starts as soon as element i of the other job has succeeded, so e.g.
+#
+# K=`localpbs.py qsub -t 0-36 -v CONFIG=$PWD/my.cfg killms.qsub`
+# localpbs.py qsub -t 0-36 -v CONFIG=$PWD/my.cfg -W depend=afterok:$K subtract_image.qsub
+#
+# chains each band's subtraction onto its own killMS run. Use
+# afterokarray to wait for the whole of an array instead.
+
+import os
+import sys
+import time
+import json
+import fcntl
+import signal
+import socket
+import getopt
+import subprocess
+import resources
+
+# seconds between SIGTERM and SIGKILL for a job being killed
+GRACE=30
+
+def spooldir():
+    d=os.getenv('LOCALPBS_SPOOL',os.path.expanduser('~/.localpbs'))
+    for sub in ('jobs','qdel'):
+        if not(os.path.isdir(os.path.join(d,sub))):
+            os.makedirs(os.path.join(d,sub))
+    return d
+
+def jobfile(spool,n):
+    return os.path.join(spool,'jobs','%i.json' % n)
+
+def save(spool,job):
+    name=jobfile(spool,job['number'])
+    f=open(name+'.tmp','w')
+    json.dump(job,f)
+    f.close()
+    os.rename(name+'.tmp',name)
+
+def load_jobs(spool):
+    jobs={}
+    d=os.path.join(spool,'jobs')
+    for name in os.listdir(d):
+        if name.endswith('.json'):
+            try:
+                job=json.load(open(os.path.join(d,name)))
+            except ValueError:
+                continue
+            jobs[job['number']]=job
+    return jobs
+
+def next_number(spool):
+    f=open(os.path.join(spool,'nextid'),'a+')
+    fcntl.flock(f,fcntl.LOCK_EX)
+    f.seek(0)
+    s=f.read().strip()
+    if s:
+        n=int(s)
+    else:
+        n=0
+    f.seek(0)
+    f.truncate()
+    f.write('%i\n' % (n+1))
+    f.close()
+    return n
+
+def jobid(job):
+    if job['array'] is None:
+        return '%i.local' % job['number']
+    else:
+        return '%i[].local' % job['number']
+
+def job_number(s):
+    # accept 12, 12.local, 12[].local or 12[3].local
+    return int(s.split('.')[0].split('[')[0])
+
+def parse_range(s):
+    # Torque array syntax, e.g. 0-36 or 0-10,12%4 (at most 4 at once)
+    slots=None
+    if '%' in s:
+        s,slots=s.split('%')
+        slots=int(slots)
+    numbers=[]
+    for r in s.split(','):
+        if '-' in r:
+            first,last=r.split('-')
+            numbers+=range(int(first),int(last)+1)
+        else:
+            numbers.append(int(r))
+    return numbers,slots
+
+def parse_size(s):
+    # Torque sizes, e.g. 2600mb or 3gb, in GB
+    s=s.lower()
+    for suffix,scale in (('tb',1024.0),('gb',1.0),('mb',1.0/1024),('kb',1.0/1048576),('b',1.0/1073741824)):
+        if s.endswith(suffix):
+            return float(s[:-len(suffix)])*scale
+    return float(s)/1073741824
+
+def parse_walltime(s):
+    seconds=0
+    for bit in s.split(':'):
+        seconds=seconds*60+int(bit)
+    return seconds
+
+def group_rss(pgids):
+    '''
+    Return a dictionary of process group to the resident memory, in
+    GB, of all its processes, for the process groups in pgids.
+    '''
+    pagesize=os.sysconf('SC_PAGE_SIZE')
+    rss=dict((p,0) for p in pgids)
+    for name in os.listdir('/proc'):
+        if not(name.isdigit()):
+            continue
+        try:
+            stat=open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue
+        # the command name may contain spaces, so split after it
+        fields=stat[stat.rindex(')')+2:].split()
+        pgid=int(fields[2])
+        if pgid in rss:
+            rss[pgid]+=int(fields[21])*pagesize
+    return dict((p,r/1073741824.0) for p,r in rss.items())
+
+def find_program(name):
+    for p in os.getenv('PATH','').split(':'):
+        if os.access(os.path.join(p,name),os.X_OK):
+            return os.path.join(p,name)
+    return None
+
+def parse_resources(job,spec):
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        key,value=item.split('=',1)
+        if key=='nodes':
+            for bit in value.split(':'):
+                if bit.startswith('ppn='):
+                    job['cpus']=int(bit[4:])
+        elif key=='pmem':
+            job['pmem']=parse_size(value)
+        elif key=='mem':
+            job['mem']=parse_size(value)
+        elif key=='walltime':
+            job['walltime']=parse_walltime(value)
+
+def directives(script):
+    '''
+    Return the shell of a job script (from #PBS -S or #!, if any) and
+    the arguments of its #PBS lines, which come before the first
+    command.
+    '''
+    shell=None
+    args=[]
+    for l in open(script).readlines():
+        l=l.strip()
+        if l.startswith('#!') and shell is None:
+            shell=l[2:].split()[0]
+        elif l.startswith('#PBS'):
+            bits=l.split()[1:]
+            if bits[:1]==['-S'] and len(bits)>1:
+                shell=bits[1]
+            else:
+                args+=bits
+        elif l and not(l.startswith('#')):
+            break
+    return shell,args
+
+def qsub(spool,argv):
+    '''
+    Queue a job, with options as for Torque's qsub. The #PBS lines of
+    the script are read first, so the command line overrides them.
+    Returns the job id.
+    '''
+    opts,args=getopt.getopt(argv,'t:v:N:W:l:q:k:j:S:V')
+    if len(args)!=1:
+        raise getopt.GetoptError('need exactly one job script')
+    script=os.path.abspath(args[0])
+    shell,pbsargs=directives(script)
+    pbsopts,junk=getopt.getopt(pbsargs,'t:v:N:W:l:q:k:j:S:V')
+
+    job={'script':script,'shell':shell or os.getenv('SHELL','/bin/sh'),
+         'name':os.path.basename(script),'array':None,'slots':None,'vars':{},
+         'deps':[],'cpus':1,'pmem':None,'mem':None,'walltime':None,
+         'workdir':os.getcwd(),'submitted':time.time()}
+    for o,a in pbsopts+opts:
+        if o=='-t':
+            job['array'],job['slots']=parse_range(a)
+        elif o=='-v':
+            for v in a.split(','):
+                if '=' in v:
+                    key,value=v.split('=',1)
+                else:
+                    key,value=v,os.getenv(v,'')
+                job['vars'][key]=value
+        elif o=='-N':
+            job['name']=a
+        elif o=='-S':
+            job['shell']=a
+        elif o=='-l':
+            parse_resources(job,a)
+        elif o=='-W' and a.startswith('depend='):
+            for d in a[7:].split(','):
+                bits=d.split(':')
+                if bits[0] not in ('afterok','afterokarray'):
+                    raise getopt.GetoptError('unsupported dependency '+bits[0])
+                for b in bits[1:]:
+                    job['deps'].append([bits[0],b])
+    if job['mem'] is not None:
+        job['memory']=job['mem']
+    elif job['pmem'] is not None:
+        job['memory']=job['pmem']*job['cpus']
+    else:
+        job['memory']=0.0
+
+    jobs=load_jobs(spool)
+    deps=[]
+    for kind,d in job['deps']:
+        n=job_number(d)
+        if n not in jobs:
+            raise getopt.GetoptError('unknown job '+d)
+        if '[' in d and not(d.split('[')[1].startswith(']')):
+            element=d.split('[')[1].split(']')[0]
+        else:
+            element=None
+        deps.append({'kind':kind,'job':n,'element':element})
+    job['deps']=deps
+
+    if job['array'] is None:
+        keys=['']
+    else:
+        keys=[str(i) for i in job['array']]
+    job['elements']=dict((k,{'state':'Q','status':None,'start':None,'end':None}) for k in keys)
+    job['number']=next_number(spool)
+    save(spool,job)
+    return jobid(job)
+
+def dep_state(jobs,dep,key):
+    '''
+    Return 'ok', 'failed' or 'wait' for dependency dep of element key.
+    '''
+    other=jobs.get(dep['job'])
+    if other is None:
+        return 'failed'
+    if dep['element'] is not None:
+        wanted=[dep['element']]
+    elif dep['kind']=='afterok' and other['array'] is not None and key!='':
+        # per element; elements the other job does not have need not wait
+        wanted=[key] if key in other['elements'] else []
+    else:
+        wanted=other['elements'].keys()
+    result='ok'
+    for w in wanted:
+        e=other['elements'].get(w)
+        if e is None or (e['state']=='C' and e['status']!=0):
+            return 'failed'
+        if e['state']!='C':
+            result='wait'
+    return result
+
+class Server:
+
+    """
+    Run the queued jobs in the spool on this host, within ncpu CPUs
+    and memory GB.
+    """
+
+    def __init__(self,spool,ncpu,memory):
+        self.spool=spool
+        self.ncpu=ncpu
+        self.memory=memory
+        self.host=socket.gethostname()
+        self.running={}
+        # pid to the time it was sent SIGTERM
+        self.killing={}
+        # the CPUs jobs are pinned to, if they can be
+        self.taskset=find_program('taskset')
+        cpus=resources.affinity()
+        if self.taskset is None:
+            print 'taskset not found, jobs will not be pinned to CPUs'
+            self.cpulist=None
+        elif cpus is None or len(cpus)<ncpu:
+            print 'Fewer than %i CPUs available, jobs will not be pinned to CPUs' % ncpu
+            self.cpulist=None
+        else:
+            self.cpulist=cpus[:ncpu]
+        self.jobs=load_jobs(spool)
+        # anything left running by an earlier server is lost
+        for job in self.jobs.values():
+            changed=False
+            for e in job['elements'].values():
+                if e['state']=='R':
+                    e['state']='C'
+                    e['status']=-1
+                    e['end']=time.time()
+                    changed=True
+            if changed:
+                save(spool,job)
+
+    def refresh(self):
+        # pick up newly submitted jobs
+        for n,job in load_jobs(self.spool).items():
+            if n not in self.jobs:
+                self.jobs[n]=job
+
+    def qdel_requests(self):
+        d=os.path.join(self.spool,'qdel')
+        for name in os.listdir(d):
+            os.unlink(os.path.join(d,name))
+            n=int(name)
+            job=self.jobs.get(n)
+            if job is None:
+                continue
+            for key,e in job['elements'].items():
+                if e['state']=='Q':
+                    e['state']='C'
+                    e['status']=-2
+                    e['end']=time.time()
+                elif e['state']=='R':
+                    self.kill(n,key,'qdel')
+            save(self.spool,job)
+
+    def kill(self,n,key,reason):
+        for pid,(m,k,p,cpus,mem,cpuset) in self.running.items():
+            if (m,k)==(n,key) and pid not in self.killing:
+                print 'Killing %i[%s]: %s' % (n,key,reason)
+                self.killing[pid]=time.time()
+                try:
+                    os.killpg(pid,signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def start(self,job,key,cpuset):
+        name=job['name']
+        jid=jobid(job).replace('[]','[%s]' % key) if key!='' else jobid(job)
+        nodefile=os.path.join(self.spool,'nodefile-%i-%s' % (job['number'],key))
+        f=open(nodefile,'w')
+        for i in range(min(job['cpus'],self.ncpu)):
+            f.write(self.host+'\n')
+        f.close()
+        env=dict(os.environ)
+        env.update({'PBS_JOBID':jid,'PBS_JOBNAME':name,'PBS_NODEFILE':nodefile,
+                    'PBS_O_WORKDIR':job['workdir'],'PBS_O_HOST':self.host,
+                    'PBS_QUEUE':'local','PBS_O_QUEUE':'local',
+                    'OMP_NUM_THREADS':str(min(job['cpus'],self.ncpu))})
+        if key!='':
+            env['PBS_ARRAYID']=key
+            suffix='-'+key
+        else:
+            suffix=''
+        env.update(job['vars'])
+        out=open(os.path.join(job['workdir'],'%s.o%i%s' % (name,job['number'],suffix)),'w')
+        err=open(os.path.join(job['workdir'],'%s.e%i%s' % (name,job['number'],suffix)),'w')
+        command=[job['shell'],job['script']]
+        if cpuset:
+            # taskset execs the shell, so the pid is still the job's
+            command=[self.taskset,'-c',','.join([str(c) for c in cpuset])]+command
+        p=subprocess.Popen(command,cwd=job['workdir'],env=env,
+                           stdout=out,stderr=err,preexec_fn=os.setsid)
+        out.close()
+        err.close()
+        return p
+
+    def schedule(self):
+        '''
+        Start every queued element whose dependencies are met and that
+        fits in the free CPUs and memory, in order of submission.
+        Returns True if anything changed.
+        '''
+        changed=False
+        freecpu=self.ncpu-sum([r[3] for r in self.running.values()])
+        freemem=self.memory-sum([r[4] for r in self.running.values()])
+        if self.cpulist is not None:
+            used=set([c for r in self.running.values() for c in r[5]])
+            freelist=[c for c in self.cpulist if c not in used]
+        for n in sorted(self.jobs):
+            job=self.jobs[n]
+            cpus=min(job['cpus'],self.ncpu)
+            mem=min(job['memory'],self.memory)
+            nrunning=len([r for r in self.running.values() if r[0]==n])
+            keys=sorted(job['elements'],key=lambda k:int(k) if k else 0)
+            for key in keys:
+                e=job['elements'][key]
+                if e['state']!='Q':
+                    continue
+                states=[dep_state(self.jobs,d,key) for d in job['deps']]
+                if 'failed' in states:
+                    e['state']='C'
+                    e['status']=-3
+                    e['end']=time.time()
+                    changed=True
+                    save(self.spool,job)
+                    continue
+                if 'wait' in states:
+                    continue
+                if job['slots'] is not None and nrunning>=job['slots']:
+                    continue
+                if cpus>freecpu or mem>freemem:
+                    continue
+                if self.cpulist is not None:
+                    cpuset=freelist[:cpus]
+                    freelist=freelist[cpus:]
+                else:
+                    cpuset=[]
+                p=self.start(job,key,cpuset)
+                self.running[p.pid]=(n,key,p,cpus,mem,cpuset)
+                e['state']='R'
+                e['start']=time.time()
+                freecpu-=cpus
+                freemem-=mem
+                nrunning+=1
+                changed=True
+                save(self.spool,job)
+        return changed
+
+    def reap(self):
+        changed=False
+        now=time.time()
+        rss=group_rss(self.running.keys())
+        for pid,(n,key,p,cpus,mem,cpuset) in self.running.items():
+            job=self.jobs[n]
+            e=job['elements'][key]
+            status=p.poll()
+            if status is None:
+                if pid in self.killing:
+                    if now-self.killing[pid]>GRACE:
+                        try:
+                            os.killpg(pid,signal.SIGKILL)
+                        except OSError:
+                            pass
+                elif job['walltime'] is not None and now-e['start']>job['walltime']:
+                    self.kill(n,key,'walltime exceeded')
+                elif job['memory']>0 and rss.get(pid,0)>job['memory']:
+                    self.kill(n,key,'memory %.1f GB exceeds %.1f GB' % (rss[pid],job['memory']))
+                continue
+            del self.running[pid]
+            self.killing.pop(pid,None)
+            e['state']='C'
+            e['status']=status
+            e['end']=now
+            save(self.spool,job)
+            try:
+                os.unlink(os.path.join(self.spool,'nodefile-%i-%s' % (n,key)))
+            except OSError:
+                pass
+            changed=True
+        return changed
+
+    def idle(self):
+        return not(self.running) and not(any(e['state']=='Q' for job in self.jobs.values() for e in job['elements'].values()))
+
+    def serve(self,once=False):
+        # a finishing job interrupts the sleep below, so that whatever
+        # depends on it starts straight away
+        signal.signal(signal.SIGCHLD,lambda signum,frame:None)
+        while True:
+            self.refresh()
+            self.qdel_requests()
+            changed=self.reap()
+            changed=self.schedule() or changed
+            if once and self.idle():
+                break
+            if not(changed):
+                time.sleep(1)
+
+def element_counts(job):
+    counts={'Q':0,'R':0,'C':0,'F':0}
+    for e in job['elements'].values():
+        if e['state']=='C' and e['status']!=0:
+            counts['F']+=1
+        else:
+            counts[e['state']]+=1
+    return counts
+
+def qstat(spool,argv):
+    opts,args=getopt.getopt(argv,'t')
+    elements=('-t','') in opts
+    jobs=load_jobs(spool)
+    if args:
+        wanted=[job_number(a) for a in args]
+    else:
+        wanted=sorted(jobs)
+    print '%-16s %-24s %5s %5s %5s %5s %5s' % ('Job ID','Name','S','Q','R','C','F')
+    for n in wanted:
+        if n not in jobs:
+            print 'Unknown job',n
+            continue
+        job=jobs[n]
+        c=element_counts(job)
+        if c['R']:
+            state='R'
+        elif c['Q']:
+            if any(dep_state(jobs,d,'')=='wait' for d in job['deps']):
+                state='H'
+            else:
+                state='Q'
+        else:
+            state='C'
+        print '%-16s %-24s %5s %5i %5i %5i %5i' % (jobid(job),job['name'][:24],state,c['Q'],c['R'],c['C'],c['F'])
+        if elements and job['array'] is not None:
+            for key in sorted(job['elements'],key=int):
+                e=job['elements'][key]
+                if e['state']=='C' and e['start'] is not None:
+                    extra='exit %s after %.0f s' % (e['status'],e['end']-e['start'])
+                elif e['state']=='C':
+                    extra='not run (status %s)' % e['status']
+                elif e['state']=='R':
+                    extra='running for %.0f s' % (time.time()-e['start'])
+                else:
+                    extra=''
+                print '  %-14s %-24s %5s %s' % ('%i[%s]' % (n,key),'',e['state'],extra)
+
+if __name__=='__main__':
+
+    if len(sys.argv)<2:
+        print 'Usage: localpbs.py server|run|qsub|qstat|qdel [options]'
+        sys.exit(1)
+
+    spool=spooldir()
+    command=sys.argv[1]
+    argv=sys.argv[2:]
+    try:
+        if command in ('server','run'):
+            if len(argv)>0:
+                ncpu=int(argv[0])
+            else:
+                ncpu=resources.cpus()
+            if len(argv)>1:
+                memory=float(argv[1])
+            else:
+                memory=resources.memory()/1073741824.0
+            print 'Running jobs from',spool,'on %i CPUs and %.0f GB' % (ncpu,memory)
+            Server(spool,ncpu,memory).serve(once=(command=='run'))
+        elif command=='qsub':
+            print qsub(spool,argv)
+        elif command=='qstat':
+            qstat(spool,argv)
+        elif command=='qdel':
+            for a in argv:
+                open(os.path.join(spool,'qdel','%i' % job_number(a)),'w').close()
+        else:
+            print 'Unknown command',command
+            sys.exit(1)
+    except getopt.GetoptError,e:
+        print 'localpbs.py '+command+':',e
+        sys.exit(1)
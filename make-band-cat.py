@@ -6,6 +6,8 @@ import sys
 import os.path
 import lofar.bdsm as bdsm
 import config
+import stagecache
+import manifest
 import re
 from astropy.io import fits
 
@@ -13,18 +15,22 @@ die=config.die
 report=config.report
 warn=config.warn
 
-def docat(infile):
+def docat(infile,cache=None):
     print 'Making catalogue for',infile
     txtout=infile+'.catalog'
     fitsout=infile+'.catalog.fits'
     smout=infile+'.skymodel'
-    if os.path.isfile(smout):
+    if cache is None:
+        cache=stagecache.StageCache()
+    command='process_image thresh_pix=5 fix_to_beam=True rms_box=(55,12) adaptive_rms_box=True adaptive_thresh=150 rms_box_bright=(80,20) mean_map=zero'
+    if cache.fresh([smout],[infile],command=command):
         print 'Catalogue already exists!'
     else:
         img=bdsm.process_image(infile,thresh_pix=5,fix_to_beam=True,rms_box=(55,12), adaptive_rms_box=True, adaptive_thresh=150, rms_box_bright=(80,20),mean_map='zero')
         img.write_catalog(outfile=txtout,clobber='True',format='ascii')
         img.write_catalog(outfile=smout,clobber='True',format='bbs',catalog_type='gaul')
         img.write_catalog(outfile=fitsout,clobber='True',format='fits',catalog_type='gaul')
+        cache.store([smout],[infile],command=command)
                       
 if len(sys.argv)<2:
     die('Need a filename for config file')
@@ -74,7 +80,13 @@ print 'Flux to cut model at is',flux,'Jy'
 fitsfile.close()
 
 if not(dryrun):
-    docat(filename+'.restored.fits')
+    docat(filename+'.restored.fits',stagecache.StageCache(cfg))
+    index=manifest.Manifest(path)
+    # tofits.py may have made the images here
+    index.record(filename+'.restored.fits')
+    index.record(filename+'.restored.corr.fits')
+    index.record(filename+'.restored.fits.catalog.fits')
+    index.record(filename+'.restored.fits.skymodel')
 
 catfile=filename+'.restored.fits.skymodel'
 
@@ -121,3 +133,5 @@ if not(dryrun):
     infile.close()
 
 run('/home/tasse/killMS2/MakeModel.py --SkyModel='+outname+' --NCluster=30 --DoPlot=0 --CMethod=1')
+if not(dryrun):
+    index.record(outname+'.npy')
@@ -3,6 +3,7 @@
 import sys
 import os,os.path
 import config
+import manifest
 die=config.die
 report=config.report
 warn=config.warn
@@ -23,15 +24,10 @@ processedpath=cfg.get('paths','processed')
 os.chdir(processedpath)
 run=config.runner(cfg.getoption('control','dryrun',False)).run
 
-sb=0
-while sb<366:
-    sbs='%03i' % sb
-    dir=troot+'_SB'+sbs+'_uv.filter.MS'
-    if os.path.isdir(dir):
-        break
-    sb+=1
-else:
+subbands=manifest.Manifest(processedpath).subbands(troot)
+if not(subbands):
     die("Can't find any target files!")
+dir=subbands[min(subbands)]
 
 run('calibrate-stand-alone --replace-parmdb '+dir+' /home/mjh/lofar/text/make-template-bbs.txt ~/lofar/text/sources-calibrate.txt')
 run('mv '+dir+'/instrument instrument_template_caltransfer')
@@ -4,18 +4,48 @@ import sys
 import config
 import os.path
 import pyrap.tables as pt
+import multiprocessing as mp
+
+# number of visibilities copied at once
+BLOCKSIZE=1<<24
+
+# columns that are not wanted in the output
+DROP=['DATA','MODEL_DATA','IMAGING_WEIGHT','CORRECTED_DATA']
 
 def ctod(infile,outfile):
+
+    '''
+    Make outfile, a copy of infile with its CORRECTED_DATA as DATA
+    and without the other data columns. Only the columns that are kept
+    are copied: the metadata columns and subtables by a deep copy of a
+    column selection, and CORRECTED_DATA block by block.
+    '''
+
     print 'copy',infile,'CORRECTED_DATA to',outfile,'DATA'
 
-    pt.tablecopy(infile,outfile,deep=True)
+    t=pt.table(infile,ack=False)
+    keep=[c for c in t.colnames() if c not in DROP]
+    sel=t.query(columns=','.join(keep))
+    sel.copy(outfile,deep=True)
+    sel.close()
 
-    out_t=pt.table(outfile,readonly=False)
-    out_t.removecols('DATA')
-    out_t.removecols('MODEL_DATA')
-    out_t.removecols('IMAGING_WEIGHT')
-    out_t.renamecol('CORRECTED_DATA','DATA')
+    desc=t.getcoldesc('CORRECTED_DATA')
+    dminfo=t.getdminfo('CORRECTED_DATA')
+    dminfo['NAME']='DATA_dm'
+    out_t=pt.table(outfile,readonly=False,ack=False)
+    out_t.addcols(pt.maketabdesc(pt.makecoldesc('DATA',desc)),dminfo)
+    nrows=t.nrows()
+    if nrows>0:
+        shape=t.getcell('CORRECTED_DATA',0).shape
+        step=max(1,BLOCKSIZE/(shape[0]*shape[1]))
+        for start in range(0,nrows,step):
+            nr=min(step,nrows-start)
+            out_t.putcol('DATA',t.getcol('CORRECTED_DATA',start,nr),start,nr)
     out_t.done()
+    t.close()
+
+def ctod_task(files):
+    ctod(*files)
 
 die=config.die
 report=config.report
@@ -44,7 +74,8 @@ cfg.read(filename)
 troot=cfg.get('files','target')
 processedpath=cfg.get('paths','processed')
 os.chdir(processedpath)
-run=config.runner(cfg.getoption('control','dryrun',False)).run
+dryrun=cfg.getoption('control','dryrun',False)
+run=config.runner(dryrun).run
 
 # Now make the bands in the specified range and prepare for imaging
 
@@ -57,14 +88,21 @@ for band in range(bb,be+1):
     if sbend>366:
         sbend=366
     flist=''
+    copies=[]
     for sb in range(sbst,sbend):
         print 'Sub-band',sb
         sbs='%03i' % sb
         infile=troot+'_SB'+sbs+'_uv.killms.MS'
         outfile=troot+'_SB'+sbs+'_uv.killed.MS'
         if os.path.isdir(infile):
-            ctod(infile,outfile)
+            copies.append((infile,outfile))
             flist+='"'+outfile+'",'
+    # the sub-bands of a band are copied in parallel
+    if copies and not(dryrun):
+        pool=mp.Pool(max(1,min(len(copies),config.getcpus())))
+        pool.map(ctod_task,copies)
+        pool.close()
+        pool.join()
     report('Concatenating band')
     outfile=troot+'_B'+bs+'_ckilled.MS'
     file=open('NDPPP-concat-killed.in','w')
@@ -3,7 +3,7 @@
 import sys
 import config
 import os.path
-import pyrap.tables as pt
+import manifest
 
 die=config.die
 report=config.report
@@ -32,12 +32,16 @@ cfg.read(filename)
 troot=cfg.get('files','target')
 processedpath=cfg.get('paths','processed')
 os.chdir(processedpath)
-run=config.runner(cfg.getoption('control','dryrun',False)).run
+dryrun=cfg.getoption('control','dryrun',False)
+run=config.runner(dryrun).run
 try:
     bad_sblist=eval(cfg.get('calibration','badsblist'))
 except:
     bad_sblist=[]
 
+index=manifest.Manifest(processedpath,dryrun)
+subbands=index.subbands(troot,bad_sblist)
+
 # Now make the bands in the specified range
 
 for band in range(bb,be+1):
@@ -49,10 +53,8 @@ for band in range(bb,be+1):
         sbend=366
     flist=''
     for sb in range(sbst,sbend):
-        sbs='%03i' % sb
-        infile=troot+'_SB'+sbs+'_uv.filter.MS'
-        if os.path.isdir(infile) and sb not in bad_sblist:
-            flist+='"'+infile+'",'
+        if sb in subbands:
+            flist+='"'+subbands[sb]+'",'
         else:
             flist+='"",'
     report('Concatenating band')
@@ -62,3 +64,4 @@ for band in range(bb,be+1):
     file.write('msin=['+flist[:-1]+']\nmsin.datacolumn = CORRECTED_DATA\nmsout = '+outfile+'\nsteps = []\nmsin.orderms = False\nmsin.missingdata = True\n')
     file.close()
     run('NDPPP '+filename)
+    index.record(outfile)
@@ -7,8 +7,11 @@ import os.path
 import numpy as np
 import lofar.bdsm as bdsm
 from astropy.io import fits
+import fftconvolve
+import adaptivestack
+import stagecache
 
-def convolve_all(files,run):
+def convolve_all(files,dryrun=False,ncpu=None,cache=None):
     
     resolution=0
     for f in files:
@@ -20,18 +23,22 @@ def convolve_all(files,run):
 
     resolution*=1.01
     print 'Convolving everything with circular beam of',resolution,'arcsec'
-    rstr=str(resolution)+','+str(resolution)
 
+    if cache is None:
+        cache=stagecache.StageCache()
+    command='convolve to '+str(resolution)
+    jobs=[]
     for f in files:
         outfile=f[:-5]+'_conv.fits'
-        if not os.path.exists(outfile):
+        if not cache.fresh([outfile],[f],command=command):
             print 'Doing',f,'output to',outfile
-            run('fits op=xyin in='+f+' out=tmp')
-            run('convol map=tmp fwhm='+rstr+' options=final out=tmp_out')
-            run('fits op=xyout in=tmp_out out='+outfile)
-            run('rm -r tmp tmp_out')
+            jobs.append((f,[(outfile,(resolution,resolution,0.0))]))
         else:
             print 'Convolved file',outfile,'already exists'
+    if not(dryrun):
+        fftconvolve.convolve_files(jobs,ncpu)
+        for f,targets in jobs:
+            cache.store([targets[0][0]],[f],command=command)
 
 def findrms(filename,region):
     import pyregion
@@ -72,7 +79,8 @@ cfg.read(filename)
 troot=cfg.get('files','target')
 processedpath=cfg.get('paths','processed')
 os.chdir(processedpath)
-run=config.runner(cfg.getoption('control','dryrun',False)).run
+dryrun=cfg.getoption('control','dryrun',False)
+run=config.runner(dryrun).run
 
 try:
     suffix=cfg.get('catalog','suffix')
@@ -84,7 +92,16 @@ except config.NoOptionError:
 
 doblank=cfg.getoption('catalog','blank',False)
 doconvolve=cfg.getoption('catalog','convolve',True)
+if cfg.getoption('catalog','stack_float64',False):
+    stackdtype=np.float64
+else:
+    stackdtype=np.float32
 rmsregion=cfg.get('catalog','rmsreg')
+try:
+    ncpu=int(cfg.get('catalog','ncpu'))
+except config.NoOptionError:
+    # each worker holds a padded complex transform of a full image
+    ncpu=config.getthreads(4)
 
 if doblank:
     report('Blanking all maps')
@@ -110,7 +127,7 @@ if doconvolve:
             files.append(cimagename)
 
     print files
-    convolve_all(files,run)
+    convolve_all(files,dryrun,ncpu,stagecache.StageCache(cfg))
 
 report('Adaptively stacking images to make detection image')
 
@@ -136,46 +153,22 @@ for band in range(37):
 medrms=np.median(rms)
 print 'median rms is',np.median(rms)
 
-i=0
-s=0
-w=0
 included=[]
 
-report('Doing the uncorrected detection image')
+report('Doing the uncorrected detection image and the corrected stacked image (for fluxes)')
 
 for band in range(37):
     if (rms[band]<medrms*2.5 and rms[band]>medrms/2.0):
         included.append(True)
-        print 'Including',iname[band]
-        fitsfile=fits.open(iname[band])
-        image=fitsfile[0].data[0,0]
-        fitsfile.close()
-        s+=image/(rms[band]**2.0)
-        w+=1.0/(rms[band]**2.0)
+        print 'Including',iname[band],cname[band]
     else:
         included.append(False)
 
-s/=w
-fitsfile=fits.open(iname[0])
-fitsfile[0].data[0,0]=s
-fitsfile.writeto('adaptive-stack.fits',clobber=True)
-fitsfile.close()
-
-report('Doing the corrected stacked image (for fluxes)')
-
-for band in range(37):
-    if included[band]:
-        print 'Including',cname[band]
-        fitsfile=fits.open(cname[band])
-        image=fitsfile[0].data[0,0]
-        fitsfile.close()
-        s+=image/(rms[band]**2.0)
-
-s/=w
-fitsfile=fits.open(cname[0])
-fitsfile[0].data[0,0]=s
-fitsfile.writeto('adaptive-stack-corr.fits',clobber=True)
-fitsfile.close()
+use=[band for band in range(37) if included[band]]
+adaptivestack.adaptive_stack([(iname[band],cname[band]) for band in use],
+                             [1.0/(rms[band]**2.0) for band in use],
+                             'adaptive-stack.fits','adaptive-stack-corr.fits',
+                             iname[0],cname[0],dtype=stackdtype)
 
 # Now start making the catalogues
 
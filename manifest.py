@@ -0,0 +1,330 @@
+#!/usr/bin/python
+
+# Index of the products in the processed directory, so that stages can
+# find out which sub-bands, bands, images and catalogues exist, and
+# their frequencies, from one small file rather than by probing 366
+# file names (or opening SPECTRAL_WINDOW) on a shared file system.
+#
+# The index is <processed>/manifest.json, one entry per product giving
+# its kind, root name, sub-band or band, frequency, time range, number
+# of rows, beam and size. Stages add their outputs with record() as
+# they publish them; updates are made under a lock on
+# <processed>/manifest.lock and the file is replaced by a rename, so
+# readers never need the lock. If there is no index yet it is built
+# from a single listing of the directory. To rebuild it, reading the
+# metadata of everything:
+#
+# manifest.py example.cfg
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import config
+
+MANIFEST='manifest.json'
+LOCK='manifest.lock'
+
+# product kinds, recognised from the names the pipeline uses
+PATTERNS=[('subband',re.compile(r'^(?P<root>.+)_SB(?P<subband>\d{3})_uv\.filter\.MS$')),
+          ('band',re.compile(r'^(?P<root>.+)_B(?P<band>\d{2})_.*\.MS$')),
+          ('catalogue',re.compile(r'^(?P<root>.+)_B(?P<band>\d{2})_.*\.catalog(\.fits)?$')),
+          ('skymodel',re.compile(r'^(?P<root>.+)_B(?P<band>\d{2})_.*\.skymodel(\.filtered)?(\.npy)?$')),
+          ('image',re.compile(r'^(?P<root>.+)_B(?P<band>\d{2})_.*\.fits$')),
+          ('solutions',re.compile(r'^(?P<root>.+)_B(?P<band>\d{2})_.*\.sols\.npz$'))]
+
+def parse_name(name):
+    '''
+    Return (kind,root,subband,band) for a product name, or None if it
+    is not one the pipeline makes.
+    '''
+    for kind,r in PATTERNS:
+        m=r.match(name)
+        if m:
+            d=m.groupdict()
+            sb=d.get('subband')
+            band=d.get('band')
+            if sb is not None:
+                sb=int(sb)
+                band=sb//10
+            elif band is not None:
+                band=int(band)
+            return kind,d['root'],sb,band
+    return None
+
+def tree_size(path):
+    if not(os.path.isdir(path)):
+        return os.path.getsize(path)
+    size=0
+    for root,dirs,files in os.walk(path):
+        for n in files:
+            try:
+                size+=os.path.getsize(os.path.join(root,n))
+            except OSError:
+                pass
+    return size
+
+def ms_metadata(ms):
+    # the first and last rows give the time range of a time-ordered MS
+    # without reading the TIME column
+    import pyrap.tables as pt
+    info={}
+    t=pt.table(ms+'/SPECTRAL_WINDOW',readonly=True,ack=False)
+    info['freq']=float(t[0]['REF_FREQUENCY'])
+    t.close()
+    t=pt.table(ms,readonly=True,ack=False)
+    info['nrows']=t.nrows()
+    if info['nrows']>0:
+        info['tstart']=float(t.getcell('TIME',0))
+        info['tend']=float(t.getcell('TIME',info['nrows']-1))
+    t.close()
+    t=pt.table(ms+'/FIELD',readonly=True,ack=False)
+    ra,dec=t.getcell('PHASE_DIR',0)[0]
+    t.close()
+    info['beam']={'ra':float(ra),'dec':float(dec)}
+    return info
+
+def fits_metadata(image):
+    from astropy.io import fits
+    info={}
+    h=fits.getheader(image)
+    for key in ['RESTFRQ','RESTFREQ']:
+        if key in h:
+            info['freq']=float(h[key])
+            break
+    if 'BMAJ' in h:
+        info['beam']={'bmaj':float(h['BMAJ']),'bmin':float(h['BMIN']),'bpa':float(h.get('BPA',0))}
+    return info
+
+def describe(path,metadata=True):
+
+    '''
+    Return a manifest entry for the product at path. With metadata
+    False only what can be had from the name and a stat is filled in.
+    '''
+
+    name=os.path.basename(path.rstrip('/'))
+    entry={'path':name,'kind':None,'root':None,'subband':None,'band':None,
+           'freq':None,'tstart':None,'tend':None,'nrows':None,'beam':None,
+           'size':None,'mtime':None}
+    p=parse_name(name)
+    if p is not None:
+        entry['kind'],entry['root'],entry['subband'],entry['band']=p
+    st=os.stat(path)
+    entry['mtime']=st.st_mtime
+    if metadata:
+        entry['size']=tree_size(path)
+        if name.endswith('.MS'):
+            entry.update(ms_metadata(path))
+        elif name.endswith('.fits') and entry['kind']=='image':
+            entry.update(fits_metadata(path))
+    return entry
+
+class Manifest:
+
+    """
+    The product index of a processed directory. Queries use the copy
+    loaded on first use, re-read only if the file has changed since.
+    In a dry run nothing is written.
+    """
+
+    def __init__(self,processedpath,dryrun=False):
+        self.path=processedpath
+        self.dryrun=dryrun
+        self.filename=os.path.join(processedpath,MANIFEST)
+        self.entries=None
+        self.stamp=None
+
+    def read(self):
+        try:
+            st=os.stat(self.filename)
+        except OSError:
+            return None
+        if self.entries is not None and self.stamp==(st.st_mtime,st.st_size):
+            return self.entries
+        try:
+            entries=json.load(open(self.filename))['products']
+        except (IOError,ValueError):
+            return None
+        self.entries=entries
+        self.stamp=(st.st_mtime,st.st_size)
+        return entries
+
+    def load(self):
+        entries=self.read()
+        if entries is None:
+            if self.entries is None:
+                # no index yet: one directory listing, no metadata
+                self.entries=self.scan()
+            entries=self.entries
+        return entries
+
+    def update(self,changes):
+        '''
+        Apply changes, a function taking and modifying the dictionary
+        of entries, to the index under the lock and write it back.
+        '''
+        if self.dryrun:
+            entries=dict(self.load())
+            changes(entries)
+            self.entries=entries
+            return
+        lock=open(os.path.join(self.path,LOCK),'a')
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            entries=self.read()
+            if entries is None:
+                entries=self.scan()
+            entries=dict(entries)
+            changes(entries)
+            tmp=self.filename+'.%i.tmp' % os.getpid()
+            f=open(tmp,'w')
+            json.dump({'time':time.time(),'products':entries},f,sort_keys=True)
+            f.close()
+            os.rename(tmp,self.filename)
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+            lock.close()
+        self.entries=entries
+        self.stamp=None
+
+    def scan(self,metadata=False):
+        '''
+        Return entries for the products found by a listing of the
+        processed directory, keeping what is already known about those
+        that have not changed.
+        '''
+        old=self.entries or {}
+        entries={}
+        for name in os.listdir(self.path):
+            if name.startswith('.') or parse_name(name) is None:
+                continue
+            full=os.path.join(self.path,name)
+            e=old.get(name)
+            try:
+                if e is not None and e['mtime']==os.stat(full).st_mtime and (e['freq'] is not None or not(metadata)):
+                    entries[name]=e
+                else:
+                    entries[name]=describe(full,metadata)
+            except OSError:
+                continue
+        return entries
+
+    def rebuild(self,metadata=True):
+        # replace the index with what is actually on disk
+        entries=self.scan(metadata)
+        def replace(old):
+            old.clear()
+            old.update(entries)
+        self.update(replace)
+        return entries
+
+    def record(self,product,**extra):
+        '''
+        Add or replace the entry for product, which must be in the
+        processed directory, reading its metadata. Keyword arguments
+        override what is worked out from the product.
+        '''
+        if self.dryrun:
+            return
+        entry=describe(os.path.join(self.path,os.path.basename(product.rstrip('/'))))
+        entry.update(extra)
+        def add(entries):
+            entries[entry['path']]=entry
+        self.update(add)
+
+    def forget(self,product):
+        name=os.path.basename(product.rstrip('/'))
+        def remove(entries):
+            entries.pop(name,None)
+        self.update(remove)
+
+    def exists(self,product,check=False):
+        '''
+        Return True if product is in the index and, if check is True,
+        still on disk: a stat for indexed products only.
+        '''
+        name=os.path.basename(product.rstrip('/'))
+        if name not in self.load():
+            return False
+        return not(check) or os.path.exists(os.path.join(self.path,name))
+
+    def find(self,kind=None,root=None,subband=None,band=None):
+        '''
+        Return the entries matching all the arguments given, sorted by
+        band, sub-band and name.
+        '''
+        found=[]
+        for e in self.load().values():
+            if kind is not None and e['kind']!=kind:
+                continue
+            if root is not None and e['root']!=root:
+                continue
+            if subband is not None and e['subband']!=subband:
+                continue
+            if band is not None and e['band']!=band:
+                continue
+            found.append(e)
+        found.sort(key=lambda e:(e['band'] is None,e['band'],e['subband'] is None,e['subband'],e['path']))
+        return found
+
+    def subbands(self,root,bad=[],check=True):
+        '''
+        Return a dictionary of sub-band number to file name for the
+        filtered sub-band MSs of root, leaving out those in bad and, if
+        check is True, any that have been removed since they were
+        indexed (one stat for each indexed sub-band).
+        '''
+        found={}
+        for e in self.find('subband',root):
+            if e['subband'] in bad:
+                continue
+            if check and not(os.path.isdir(os.path.join(self.path,e['path']))):
+                continue
+            found[e['subband']]=e['path']
+        return found
+
+    def frequency(self,ms):
+        '''
+        Return the reference frequency of ms from the index, reading it
+        from the MS (and recording it, if ms is a product) if need be.
+        '''
+        name=os.path.basename(ms.rstrip('/'))
+        e=self.load().get(name)
+        if e is not None and e['freq'] is not None:
+            return e['freq']
+        freq=ms_metadata(ms)['freq']
+        if os.path.abspath(os.path.dirname(os.path.abspath(ms.rstrip('/'))))==os.path.abspath(self.path) and parse_name(name) is not None:
+            self.record(ms)
+        return freq
+
+def getfreq(ms,processedpath=None):
+    # drop-in replacement for the getfreq() of the imaging scripts
+    if processedpath is None:
+        processedpath=os.path.dirname(os.path.abspath(ms.rstrip('/')))
+    return Manifest(processedpath).frequency(ms)
+
+if __name__=='__main__':
+
+    die=config.die
+    report=config.report
+    warn=config.warn
+
+    if len(sys.argv)<2:
+        die('Need a filename for config file')
+
+    filename=sys.argv[1]
+    if not(os.path.isfile(filename)):
+        die('Config file does not exist')
+
+    cfg=config.LocalConfigParser()
+    cfg.read(filename)
+
+    m=Manifest(cfg.get('paths','processed'))
+    m.read()
+    report('Scanning '+m.path)
+    entries=m.rebuild()
+    for kind in ['subband','band','image','catalogue','skymodel','solutions']:
+        print '%-10s %i' % (kind,len([e for e in entries.values() if e['kind']==kind]))
@@ -2,9 +2,86 @@
 # code to merge the catalogues using the adaptive-stack catalogue as a guide
 
 from astropy.table import Table
+from scipy.spatial import cKDTree
 import os.path
 import numpy as np
 
+def search_radius(err,limit=-2):
+
+    '''
+    Return the largest separation at which a match with position error
+    err (E_RA**2+E_DEC**2) can still have a likelihood above limit. The
+    flux term of the likelihood is never positive, so the position term
+    log(d/err)-d**2/(2*err) alone must exceed limit. Writing d=x*sqrt(err)
+    this needs x**2/2-log(x) < limit'=-limit-0.5*log(err), and the
+    largest such x is found by bisection for all rows at once.
+    '''
+
+    err=np.asarray(err,dtype=float)
+    err=err[np.isfinite(err) & (err>0)]
+    if len(err)==0:
+        return 0.0
+    k=-limit-0.5*np.log(err)
+    lo=np.ones_like(k)
+    hi=2.0*np.sqrt(np.maximum(k,1.0))+2.0
+    for i in range(100):
+        mid=0.5*(lo+hi)
+        inside=0.5*mid**2.0-np.log(mid)<k
+        lo=np.where(inside,mid,lo)
+        hi=np.where(inside,hi,mid)
+    # no match is possible at all where k is below the minimum of 0.5
+    d=np.where(k>0.5,hi*np.sqrt(err),0.0)
+    return np.max(d)*(1.0+1e-6)
+
+def crossmatch(master,m,limit=-2):
+
+    '''
+    Find the counterpart in band table m of every row of master, in
+    master row order, using the same likelihood and greedy assignment as
+    the original row-by-row loop: each master row takes the unused band
+    row with the highest likelihood, if that is above limit. Candidates
+    come from a k-d tree in the (RA,DEC) plane, which is the metric the
+    likelihood uses. Returns, for each master row, the index of the
+    matched row in m or -1, and sets m['used'].
+    '''
+
+    match=-np.ones(len(master),dtype=int)
+    if len(m)==0:
+        return match
+    err=m['E_RA']**2.0+m['E_DEC']**2.0
+    radius=search_radius(err,limit)
+    tree=cKDTree(np.column_stack((m['RA'],m['DEC'])))
+    cand=tree.query_ball_point(np.column_stack((master['RA'],master['DEC'])),radius)
+    lens=np.array([len(c) for c in cand])
+    if np.sum(lens)==0:
+        return match
+    mi=np.repeat(np.arange(len(master)),lens)
+    bj=np.concatenate([np.array(c,dtype=int) for c in cand if len(c)>0])
+
+    err=np.asarray(err)[bj]
+    flux=np.asarray(m['Total_flux'])[bj]
+    dra=np.asarray(m['RA'])[bj]-np.asarray(master['RA'])[mi]
+    ddec=np.asarray(m['DEC'])[bj]-np.asarray(master['DEC'])[mi]
+    dist2=dra**2.0+ddec**2.0
+    dist=np.sqrt(dist2)
+    dflux=(flux-np.asarray(master['Total_flux'])[mi])**2.0
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rayleigh=np.log(dist/err)-dist2/(2*err)-dflux/(2*0.05*flux**2.0)
+
+    good=rayleigh>limit
+    mi=mi[good]
+    bj=bj[good]
+    rayleigh=rayleigh[good]
+    # master rows in order, best likelihood first, lowest band row on ties
+    order=np.lexsort((bj,-rayleigh,mi))
+    used=np.array(m['used'])
+    for i,j in zip(mi[order],bj[order]):
+        if match[i]<0 and not used[j]:
+            match[i]=j
+            used[j]=True
+    m['used']=used
+    return match
+
 print 'reading master catalogue'
 
 master = Table.read('adaptive-stack-corr.fits.catalog', format='ascii.commented_header', header_start=-1)
@@ -41,34 +118,19 @@ for fr in clist:
     master['s'+fr]=np.nan
     master['e'+fr]=np.nan
 
-# Now go through the master catalogue looking for counterparts
-
-for r in master:
-    ra=r['RA']
-    dec=r['DEC']
-    flux=r['Total_flux']
-    print 'Checking for counterpart to Gaussian',r['Gaus_id'],ra,dec,flux
-    cs=0
-    for m,fr in zip(tlist,clist):
-        err=m['E_RA']**2.0+m['E_DEC']**2.0
-        dra=m['RA']-ra
-        ddec=m['DEC']-dec
-        dist2=dra**2.0+ddec**2.0
-        dist=np.sqrt(dist2)
-        derr=dist/np.sqrt(err)
-        dflux=(m['Total_flux']-flux)**2.0
-        rayleigh=np.log(dist/err)-dist2/(2*err)-dflux/(2*0.05*m['Total_flux']**2.0)
-        rayleigh[m['used']]=-999999
-        minindex=np.argmax(rayleigh)
-        if rayleigh[minindex]>-2:
-#            print rayleigh[minindex],derr[minindex],m['Total_flux'][minindex]
-            cs+=1
-            r['s'+fr]=m['Total_flux'][minindex]
-            r['e'+fr]=m['E_Total_flux'][minindex]
-            m['used'][minindex]=True
-    print 'Total counterparts',cs
-    r['counterparts']=cs
-    
+# Now go through the band catalogues looking for counterparts to all
+# the master Gaussians at once
+
+counterparts=np.zeros(len(master),dtype=int)
+for m,fr in zip(tlist,clist):
+    print 'Crossmatching band',fr
+    match=crossmatch(master,m)
+    found=match>=0
+    master['s'+fr][found]=m['Total_flux'][match[found]]
+    master['e'+fr][found]=m['E_Total_flux'][match[found]]
+    counterparts+=found
+master['counterparts']=counterparts
+print 'Total counterparts',np.sum(counterparts)
 
 master.write('master-table.dat',format='ascii.commented_header')
 for i,m in enumerate(tlist):
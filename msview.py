@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+# Baseline and column selections of a band MS, made with casacore
+# rather than an NDPPP run with no steps. Everything that uses the
+# selections (applybeam.py, MSTools.py, killMS) adds columns, which a
+# reference table cannot take, so materialise() writes a real table
+# with the selected rows, the metadata and the one data column wanted:
+# the same copy NDPPP made, without starting NDPPP for it.
+
+import os
+import fnmatch
+import pyrap.tables as pt
+
+# the visibility columns, of which only the selected one is kept
+DATACOLUMNS=['DATA','CORRECTED_DATA','MODEL_DATA','IMAGING_WEIGHT']
+
+def baseline_selection(ms,baselines):
+
+    '''
+    Return a TaQL condition selecting the rows of ms in the NDPPP
+    baseline selection baselines, which must be of the form used by
+    the pipeline: a station pattern followed by & (cross-correlations
+    only), && (with autocorrelations) or &&& (autocorrelations only),
+    e.g. '[CR]S*&'.
+    '''
+
+    pattern=baselines.rstrip('&')
+    amps=len(baselines)-len(pattern)
+    if amps not in (1,2,3) or '&' in pattern or ';' in pattern or '!' in pattern:
+        raise ValueError('Cannot handle baseline selection '+baselines)
+    t=pt.table(ms+'/ANTENNA',readonly=True,ack=False)
+    names=t.getcol('NAME')
+    t.close()
+    ids=[str(i) for i,n in enumerate(names) if fnmatch.fnmatchcase(n,pattern)]
+    where='ANTENNA1 IN ['+','.join(ids)+'] AND ANTENNA2 IN ['+','.join(ids)+']'
+    if amps==1:
+        where+=' AND ANTENNA1!=ANTENNA2'
+    elif amps==3:
+        where+=' AND ANTENNA1==ANTENNA2'
+    return where
+
+def select(ms,column='DATA',baselines='[CR]S*&'):
+
+    '''
+    Return a reference table of ms with the rows in baselines, the
+    non-visibility columns and column renamed to DATA.
+    '''
+
+    t=pt.table(ms,ack=False)
+    columns=[c for c in t.colnames() if c not in DATACOLUMNS]
+    if column=='DATA':
+        columns.append('DATA')
+    else:
+        columns.append(column+' AS DATA')
+    sel=t.query(baseline_selection(ms,baselines),columns=','.join(columns))
+    t.close()
+    return sel
+
+def materialise(ms,name,column='DATA',baselines='[CR]S*&'):
+    # a real table holding just the selected rows and columns
+    sel=select(ms,column,baselines)
+    sel.copy(name,deep=True)
+    sel.close()
+
+def describe(ms,column='DATA',baselines='[CR]S*&'):
+    # for the stage cache and the logs
+    return 'msview '+os.path.abspath(ms)+' '+column+' '+baselines
@@ -3,6 +3,7 @@
 #check up on the status of a pipeline run using the config files.
 
 import config
+import manifest
 import os
 import sys
 
@@ -39,10 +40,17 @@ if __name__=='__main__':
     suffixes=['concat.MS','concat.MS/instrument',imagesuffix+add+'.restored.fits',imagesuffix+add+'.restored.fits.skymodel.filtered.npy','killMS.MS_killMS.CohJones.sols.npz',subimagesuffix+add+'.restored.fits',subimagesuffix+add+'.restored.sr.fits']
     descriptions=['concatenated data','calibrated concatenated data','original FITS image','killMS sky model','killMS solution','subtracted image','restored image']
 
+    index=manifest.Manifest(processedpath)
+
     for band in range(37):
         for s,t in zip(suffixes,descriptions):
             filename=troot+bs(band)+'_'+s
-            if not(os.path.exists(filename)):
+            if '/' in filename:
+                # parts of a product are not indexed
+                found=index.exists(filename.split('/')[0]) and os.path.exists(filename)
+            else:
+                found=index.exists(filename,check=True)
+            if not(found):
                 print 'Band',band,t,'does not exist'
                 break
         else:
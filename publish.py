@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# Copy finished products to the processed directory in the background,
+# so that the job can get on with something else in the meantime. Each
+# product is copied to a hidden .partial directory next to its final
+# name, checked against the original, renamed into place and only then
+# removed from the work area.
+
+import os
+import shutil
+import threading
+import Queue
+
+def listing(path):
+    '''
+    Return a dictionary of relative path to size for all files under
+    path, following symbolic links as rsync --copy-links does.
+    '''
+    files={}
+    if os.path.isfile(path):
+        return {'':os.path.getsize(path)}
+    for root,dirs,names in os.walk(path,followlinks=True):
+        for n in names:
+            full=os.path.join(root,n)
+            files[os.path.relpath(full,path)]=os.path.getsize(full)
+    return files
+
+class Publisher:
+
+    """
+    Background transfer agent. publish() queues a product and returns
+    at once unless maxqueue products are already waiting; wait() blocks
+    until everything queued has been dealt with, stops the agent and
+    returns a list of (product,error) for those that failed.
+    """
+
+    def __init__(self,destdir,run,dryrun=False,maxqueue=2):
+        self.destdir=destdir
+        self.run=run
+        self.dryrun=dryrun
+        self.queue=Queue.Queue(maxqueue)
+        self.failed=[]
+        self.thread=threading.Thread(target=self.worker)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def publish(self,product,cleanup=[]):
+        '''
+        Queue product (a file or directory) for copying to destdir, and
+        the paths in cleanup for removal once the copy is verified.
+        '''
+        self.queue.put((product,cleanup))
+
+    def wait(self):
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        return self.failed
+
+    def worker(self):
+        while True:
+            item=self.queue.get()
+            if item is None:
+                break
+            product,cleanup=item
+            try:
+                error=self.transfer(product)
+                if error is None:
+                    for c in cleanup:
+                        self.run('rm -r '+c,proceed=True)
+                else:
+                    self.failed.append((product,error))
+            except Exception,e:
+                self.failed.append((product,str(e)))
+            self.queue.task_done()
+
+    def transfer(self,product):
+        '''
+        Copy, check and rename one product. Returns None on success or
+        a description of the problem.
+        '''
+        name=os.path.basename(product.rstrip('/'))
+        final=os.path.join(self.destdir,name)
+        partial=os.path.join(self.destdir,'.'+name+'.partial')
+        if os.path.isdir(product):
+            src=product.rstrip('/')+'/'
+            dest=partial+'/'
+        else:
+            src=product
+            dest=partial
+        if self.run('rsync -a --delete --copy-links '+src+' '+dest,proceed=True):
+            return 'rsync failed'
+        if self.dryrun:
+            return None
+        if listing(product)!=listing(partial):
+            return 'copy in '+partial+' does not match '+product
+        if os.path.lexists(final):
+            # replace an earlier copy, as rsync --delete used to
+            old=final+'.old-%i' % os.getpid()
+            os.rename(final,old)
+            os.rename(partial,final)
+            if os.path.isdir(old) and not(os.path.islink(old)):
+                shutil.rmtree(old)
+            else:
+                os.unlink(old)
+        else:
+            os.rename(partial,final)
+        return None
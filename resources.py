@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+# Work out the CPUs and memory that this job may actually use, from
+# the PBS node file, the CPU affinity mask and any cgroup (v1 or v2)
+# CPU quota and memory limit, rather than assuming the whole node.
+# Run this file to print what it finds.
+
+import os
+import math
+import socket
+import multiprocessing
+
+def parse_cpulist(s):
+    # e.g. '0-3,8,10-11' as used in /proc and /sys
+    cpus=[]
+    for r in s.strip().split(','):
+        if r=='':
+            continue
+        if '-' in r:
+            first,last=r.split('-')
+            cpus+=range(int(first),int(last)+1)
+        else:
+            cpus.append(int(r))
+    return cpus
+
+def read(path):
+    try:
+        return open(path).read().strip()
+    except IOError:
+        return None
+
+def affinity():
+    '''
+    Return the list of CPUs this process may run on, or None if not
+    known.
+    '''
+    try:
+        lines=open('/proc/self/status').readlines()
+    except IOError:
+        return None
+    for l in lines:
+        if l.startswith('Cpus_allowed_list:'):
+            return parse_cpulist(l.split(':')[1])
+    return None
+
+def cgroup_dirs():
+    '''
+    Return a list of (controllers,directory) for the cgroups of this
+    process, innermost first for each hierarchy. controllers is '' for
+    the unified (v2) hierarchy.
+    '''
+    try:
+        lines=open('/proc/self/cgroup').readlines()
+    except IOError:
+        return []
+    mounts={}
+    try:
+        for l in open('/proc/self/mounts').readlines():
+            bits=l.split()
+            if bits[2]=='cgroup2':
+                mounts['']=bits[1]
+            elif bits[2]=='cgroup':
+                for c in bits[3].split(','):
+                    mounts[c]=bits[1]
+    except IOError:
+        return []
+    dirs=[]
+    for l in lines:
+        hid,controllers,path=l.strip().split(':',2)
+        if controllers=='':
+            root=mounts.get('')
+        else:
+            root=mounts.get(controllers.split(',')[0])
+        if root is None:
+            continue
+        # the limits of parent groups apply too
+        while True:
+            d=os.path.join(root,path.lstrip('/'))
+            if os.path.isdir(d):
+                dirs.append((controllers,d))
+            if path in ('/',''):
+                break
+            path=os.path.dirname(path)
+    return dirs
+
+def cpu_quota():
+    '''
+    Return the CPU quota of this process's cgroups as a number of CPUs,
+    or None if there is none.
+    '''
+    quota=None
+    for controllers,d in cgroup_dirs():
+        q=None
+        if controllers=='':
+            s=read(os.path.join(d,'cpu.max'))
+            if s is not None and not(s.startswith('max')):
+                bits=s.split()
+                q=float(bits[0])/float(bits[1])
+        elif 'cpu' in controllers.split(','):
+            s=read(os.path.join(d,'cpu.cfs_quota_us'))
+            p=read(os.path.join(d,'cpu.cfs_period_us'))
+            if s is not None and p is not None and int(s)>0:
+                q=float(s)/float(p)
+        if q is not None and (quota is None or q<quota):
+            quota=q
+    return quota
+
+def memory_limit():
+    '''
+    Return the memory limit of this process's cgroups in bytes, or
+    None if there is none.
+    '''
+    limit=None
+    for controllers,d in cgroup_dirs():
+        m=None
+        if controllers=='':
+            s=read(os.path.join(d,'memory.max'))
+            if s is not None and s!='max':
+                m=int(s)
+        elif 'memory' in controllers.split(','):
+            s=read(os.path.join(d,'memory.limit_in_bytes'))
+            # 'unlimited' is a very large number in v1
+            if s is not None and int(s)<(1<<60):
+                m=int(s)
+        if m is not None and (limit is None or m<limit):
+            limit=m
+    return limit
+
+def pbs_cpus():
+    '''
+    Return the number of CPUs given to this job on this host by PBS,
+    or None if not running under PBS.
+    '''
+    nodefile=os.getenv('PBS_NODEFILE')
+    if not nodefile:
+        return None
+    lines=[l.strip() for l in open(nodefile).readlines() if l.strip()]
+    host=socket.gethostname().split('.')[0]
+    mine=[l for l in lines if l.split('.')[0]==host]
+    if mine:
+        return len(mine)
+    else:
+        return len(lines)
+
+def cpus():
+    '''
+    Return the number of CPUs this job can use: the smallest of the
+    PBS allocation, the affinity mask and the cgroup quota.
+    '''
+    counts=[]
+    n=pbs_cpus()
+    if n is not None:
+        counts.append(n)
+    a=affinity()
+    if a:
+        counts.append(len(a))
+    q=cpu_quota()
+    if q is not None:
+        counts.append(int(math.ceil(q)))
+    if counts:
+        return max(1,min(counts))
+    else:
+        return multiprocessing.cpu_count()
+
+def threads(limit=None):
+    '''
+    Return the number of threads to give an external tool: all the
+    CPUs of the job, or at most limit.
+    '''
+    n=cpus()
+    if limit is not None:
+        n=min(n,limit)
+    return n
+
+def memory():
+    '''
+    Return the memory this job can use in bytes: the physical memory
+    or the cgroup limit, whichever is smaller.
+    '''
+    total=None
+    try:
+        for l in open('/proc/meminfo').readlines():
+            if l.startswith('MemTotal:'):
+                total=int(l.split()[1])*1024
+    except IOError:
+        pass
+    limit=memory_limit()
+    if total is None:
+        return limit
+    if limit is not None:
+        return min(total,limit)
+    return total
+
+def numa_nodes():
+    '''
+    Return a dictionary of NUMA node number to the list of CPUs of the
+    node that this process may run on.
+    '''
+    nodes={}
+    base='/sys/devices/system/node'
+    if not(os.path.isdir(base)):
+        return nodes
+    allowed=affinity()
+    for name in os.listdir(base):
+        if name.startswith('node') and name[4:].isdigit():
+            s=read(os.path.join(base,name,'cpulist'))
+            if s is None:
+                continue
+            c=parse_cpulist(s)
+            if allowed is not None:
+                c=[x for x in c if x in allowed]
+            if c:
+                nodes[int(name[4:])]=c
+    return nodes
+
+def numa_prefix():
+    '''
+    Return a numactl command prefix for a tool run by this job, or '' if
+    there is nothing to gain (one NUMA node, or no numactl). If the
+    job's CPUs are all on one node the tool and its memory are kept
+    there; if they span several, memory is interleaved across them.
+    '''
+    base='/sys/devices/system/node'
+    if not(os.path.isdir(base)) or len([n for n in os.listdir(base) if n.startswith('node') and n[4:].isdigit()])<2:
+        return ''
+    if not(any(os.access(os.path.join(p,'numactl'),os.X_OK) for p in os.getenv('PATH','').split(':'))):
+        return ''
+    nodes=sorted(numa_nodes())
+    if len(nodes)==1:
+        return 'numactl --cpunodebind=%i --preferred=%i ' % (nodes[0],nodes[0])
+    elif len(nodes)>1:
+        return 'numactl --interleave=%s ' % ','.join([str(n) for n in nodes])
+    return ''
+
+if __name__=='__main__':
+
+    print 'PBS CPUs:',pbs_cpus()
+    a=affinity()
+    print 'Affinity:',a is not None and len(a) or None,'CPUs'
+    print 'cgroup CPU quota:',cpu_quota()
+    m=memory_limit()
+    print 'cgroup memory limit:',m is not None and '%.1f GB' % (m/1073741824.0) or None
+    print 'NUMA nodes:',dict((n,len(c)) for n,c in numa_nodes().items())
+    print
+    print 'CPUs for this job:',cpus()
+    print 'Memory for this job: %.1f GB' % (memory()/1073741824.0)
+    print 'NUMA prefix:',repr(numa_prefix())
@@ -6,49 +6,128 @@ from astropy.io import fits
 from astropy.wcs import WCS
 import sys
 import numpy as np
-import numexpr as ne
 import os.path
 import config
+import fftconvolve
+import manifest
 
-def gaussian(xsize,ysize,x0,y0,sx,sy,pa):
-    X, Y = np.meshgrid(np.arange(0,xsize,1.0), np.arange(0,ysize,1.0))
-    pa*=np.pi/180.0
+# number of stamp pixels computed at once
+BLOCKSIZE=1<<22
+
+def column(m,i):
+    # sky models are record arrays (killMS) or plain 2-d arrays
+    if m.dtype.names:
+        return np.asarray(m[m.dtype.names[i]],dtype=float)
+    else:
+        return np.asarray(m[:,i],dtype=float)
+
+def gaussian_coeffs(sx,sy,pa):
+    '''
+    Return (a,b,c) such that the Gaussian with standard deviations
+    sx,sy (pixels) and position angle pa (degrees) is
+    exp(-(a*dx**2+2*b*dx*dy+c*dy**2)).
+    '''
+    pa=pa*np.pi/180.0
     a=0.5*((np.cos(pa)/sx)**2.0+(np.sin(pa)/sy)**2.0)
     b=0.25*((-np.sin(2*pa)/sx**2.0)+(np.sin(2*pa)/sy**2.0))
     c=0.5*((np.sin(pa)/sx)**2.0+(np.cos(pa)/sy)**2.0)
-    
-    return ne.evaluate('exp(-(a*(X-x0)**2.0+2*b*(X-x0)*(Y-y0)+c*(Y-y0)**2.0))')
-
-def restore_gaussian(image,norm,x,y,bmaj,bmin,bpa,guard,verbose=False):
-    # deal with real image co-ords
-    yd,xd=np.shape(image)
-    if x is int:
-        xp=x
-        x=x+0.5
-        yp=y
-        y=y+0.5
+    return a,b,c
+
+def render(images,weights,x,y,coeffs,radius):
+    '''
+    Add a Gaussian with coefficients coeffs (see gaussian_coeffs),
+    centred on each pixel position x,y and truncated at the
+    corresponding radius (pixels), to each of images, with amplitudes
+    given by the matching row of weights. All the images are updated
+    in the same pass.
+
+    With the centre at xp+fx, yp+fy, the Gaussian at pixel offset i,j
+    from xp,yp factorises into a stamp depending only on i,j, which is
+    shared by all components of the same radius, and terms in i and j
+    alone depending on the sub-pixel offset fx,fy. So the stamps of
+    many components are computed at once without any WCS or meshgrid
+    work per component.
+    '''
+    a,b,c=coeffs
+    ny,nx=images[0].shape
+    xp=np.floor(x).astype(int)
+    yp=np.floor(y).astype(int)
+    fx=x-xp
+    fy=y-yp
+    norm=np.exp(-(a*fx**2.0+2.0*b*fx*fy+c*fy**2.0))
+    u=2.0*(a*fx+b*fy)
+    v=2.0*(b*fx+c*fy)
+    for r in np.unique(radius):
+        i=np.arange(-r,r+2,dtype=float)
+        base=np.exp(-(a*i[np.newaxis,:]**2.0+2.0*b*i[np.newaxis,:]*i[:,np.newaxis]+c*i[:,np.newaxis]**2.0))
+        members=np.nonzero(radius==r)[0]
+        step=max(1,BLOCKSIZE//base.size)
+        for s in range(0,len(members),step):
+            k=members[s:s+step]
+            stamps=(base[np.newaxis,:,:]*norm[k,np.newaxis,np.newaxis]*
+                    np.exp(np.outer(v[k],i))[:,:,np.newaxis]*
+                    np.exp(np.outer(u[k],i))[:,np.newaxis,:])
+            for n,kk in enumerate(k):
+                x0=xp[kk]-r
+                y0=yp[kk]-r
+                xmin=max(x0,0)
+                ymin=max(y0,0)
+                xmax=min(x0+len(i),nx)
+                ymax=min(y0+len(i),ny)
+                if xmin>=xmax or ymin>=ymax:
+                    continue
+                stamp=stamps[n,ymin-y0:ymax-y0,xmin-x0:xmax-x0]
+                for image,weight in zip(images,weights):
+                    image[ymin:ymax,xmin:xmax]+=weight[kk]*stamp
+
+def restore_fft(images,weights,x,y,coeffs):
+    '''
+    Restore a dense model by FFT. Each component is first gridded with
+    a small circular Gaussian of unit integral, which represents its
+    sub-pixel position accurately, and the model images are then
+    convolved with the rest of the restoring beam, so that the result
+    is the restoring beam centred on each component.
+    '''
+    a,b,c=coeffs
+    cov=np.linalg.inv(2.0*np.array([[a,b],[b,c]]))
+    smin=np.sqrt(np.min(np.linalg.eigvalsh(cov)))
+    # the gridding kernel must be narrower than the beam, but well
+    # enough sampled that the two convolutions commute with sampling
+    sgrid=min(1.0,0.5*smin)
+    rgrid=int(np.ceil(6.0*sgrid))
+    rest=cov-sgrid**2.0*np.identity(2)
+    ny,nx=images[0].shape
+    margin=rgrid+2+int(np.ceil(5.0*np.sqrt(np.max(np.linalg.eigvalsh(rest)))))
+    py=fftconvolve.goodsize(ny+2*margin)
+    px=fftconvolve.goodsize(nx+2*margin)
+    transfer=fftconvolve.gaussian_transfer(py,px,rest)
+    # peak-normalised beam from unit-integral gridding kernel
+    scale=np.sqrt(np.linalg.det(cov))/sgrid**2.0
+    gcoeffs=gaussian_coeffs(sgrid,sgrid,0.0)
+    radius=np.ones(len(x),dtype=int)*rgrid
+    for image,weight in zip(images,weights):
+        model=np.zeros((py,px))
+        render([model],[weight*scale],x+margin,y+margin,gcoeffs,radius)
+        model=fftconvolve.irfft2(fftconvolve.rfft2(model)*transfer,s=(py,px))
+        image+=model[margin:margin+ny,margin:margin+nx]
+
+def restore_components(images,weights,x,y,bmaj,bmin,bpa,radius,denselimit=8.0):
+    '''
+    Add the restoring beam (standard deviations bmaj,bmin in pixels,
+    position angle bpa in degrees, as in gaussian_coeffs) to images
+    for every component at pixel position x,y, with the amplitudes in
+    the corresponding row of weights. Stamps are truncated at the
+    given radius. If the stamps would cover more than denselimit times
+    the image area the model is restored by FFT instead.
+    '''
+    coeffs=gaussian_coeffs(bmin,bmaj,bpa)
+    ny,nx=images[0].shape
+    work=np.sum((2.0*radius+2.0)**2.0)
+    if work>denselimit*nx*ny:
+        report('Dense model, restoring by FFT')
+        restore_fft(images,weights,x,y,coeffs)
     else:
-        xp=int(np.trunc(x))
-        yp=int(np.trunc(y))
-    if verbose:
-       print x,y,xp,yp,norm
-    if xp<0 or yp<0 or xp>xd-1 or yp>yd-1:
-       raise Exception('position out of range')
-    xmin=xp-guard
-    xmax=xp+guard
-    ymin=yp-guard
-    ymax=yp+guard
-    if xmin<0:
-        xmin=0
-    if ymin<0:
-        ymin=0
-    if xmax>=xd:
-        xmax=xd-1
-    if ymax>=yd:
-        ymax=yd-1
-    x0=x-xmin
-    y0=y-ymin
-    image[ymin:ymax,xmin:xmax]+=norm*gaussian(xmax-xmin,ymax-ymin,x0,y0,bmaj,bmin,bpa)
+        render(images,weights,x,y,coeffs,radius)
 
 gfactor=2.0*np.sqrt(2.0*np.log(2.0))
 
@@ -104,7 +183,6 @@ rhdu=fits.open(imgname+'.corr.fits')
 
 f=hdu[0].data[0,0]
 rf=rhdu[0].data[0,0]
-ratio=rf/f
 prhd=hdu[0].header
 bmaj=prhd.get('BMAJ')
 bmin=prhd.get('BMIN')
@@ -114,7 +192,7 @@ cd1=-w.wcs.cdelt[0]
 cd2=w.wcs.cdelt[1]
 if (cd1!=cd2):
     raise Exception('Pixels are not square')
-(maxx,maxy)=f.shape
+(maxy,maxx)=f.shape
 print 'File',fitsfile
 print 'BMAJ',bmaj,'BMIN',bmin,'BPA',bpa
 print 'Pixel size',cd1
@@ -128,27 +206,55 @@ bpa=-bpa
 print 'Gaussian axes in pixels',bmaj,bmin
 guard=2*int(bmaj*5)
 
+try:
+    cutoff=float(cfg.get('restore','cutoff'))
+except (config.NoOptionError,config.NoSectionError):
+    cutoff=1e-6
+
+try:
+    denselimit=float(cfg.get('restore','denselimit'))
+except (config.NoOptionError,config.NoSectionError):
+    denselimit=8.0
+
 # do the actual restoring
 
 report('Restoring '+str(len(m))+' Gaussians')
 
-for c in m:
-    flux=c[3]
-    ra=c[1]*180.0/np.pi
-    dec=c[2]*180.0/np.pi
-    imc=w.wcs_world2pix([(ra,dec,0,0)],0)
-    x=imc[0][0]
-    y=imc[0][1]
-    print ra,dec,flux,x,y
-    if x<0 or y<0 or x>=maxx or y>=maxy:
-        print '... skipping, off image'
-    elif np.isnan(f[int(y),int(x)]):
-        print '... skipping, image blanked at this location'
-    else:
-        restore_gaussian(f,flux,x,y,bmin,bmaj,bpa,guard)
-        restore_gaussian(rf,ratio[int(y),int(x)]*flux,x,y,bmin,bmaj,bpa,guard)
-#        f+=flux*g
-#        rf+=ratio*flux*g
+# all the component positions in one WCS call
+ra=column(m,1)*180.0/np.pi
+dec=column(m,2)*180.0/np.pi
+flux=column(m,3)
+zeros=np.zeros_like(ra)
+imc=w.wcs_world2pix(np.column_stack((ra,dec,zeros,zeros)),0)
+x=imc[:,0]
+y=imc[:,1]
+
+keep=(x>=0) & (y>=0) & (x<maxx) & (y<maxy)
+print len(m)-np.sum(keep),'components are off the image'
+xi=np.where(keep,x,0).astype(int)
+yi=np.where(keep,y,0).astype(int)
+keep&=~np.isnan(f[yi,xi])
+x=x[keep]
+y=y[keep]
+flux=flux[keep]
+xi=xi[keep]
+yi=yi[keep]
+print len(x),'components on unblanked parts of the image'
+
+# the correction is only needed at the component pixels
+ratio=rf[yi,xi]/f[yi,xi]
+
+# truncate each Gaussian where it falls below the cutoff in either
+# image, but never beyond the original fixed guard radius
+with np.errstate(divide='ignore',invalid='ignore'):
+    peak=np.fmax(np.abs(flux),np.abs(flux*ratio))
+    radius=bmaj*np.sqrt(2.0*np.log(np.maximum(peak/cutoff,1.0)))
+radius=np.clip(np.ceil(np.nan_to_num(radius)),1,max(guard,1)).astype(int)
+
+restore_components([f,rf],[flux,ratio*flux],x,y,bmaj,bmin,bpa,radius,denselimit)
     
 hdu.writeto(imgname+'.sr.fits',clobber=True)
 rhdu.writeto(imgname+'.corr.sr.fits',clobber=True)
+index=manifest.Manifest(path)
+index.record(imgname+'.sr.fits')
+index.record(imgname+'.corr.sr.fits')
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+
+# Run the whole pipeline on the local machine, as an alternative to
+# chaining qsub -t arrays by hand. The stages are expanded into a graph
+# of (stage, sub-band or band) tasks, and each task is started as soon
+# as the tasks it depends on have finished, as long as there are CPUs
+# and memory free for it. So e.g. band 3 can be imaged while other
+# bands are still being concatenated.
+
+import os
+import sys
+import socket
+import time
+import subprocess
+import config
+import resources
+import worker
+
+# name, script, one task per 'subband'/'band' or a single 'global'
+# task, CPUs and total memory in GB per task. The resources follow the
+# qsub files (ppn and ppn*pmem) where they give them.
+STAGES=[('calib','calib.py','subband',8,4),
+        ('makeband','makeband.py','band',1,2),
+        ('apply-nvss-skymodel','apply-nvss-skymodel.py','band',1,10),
+        ('image','image.py','band',16,48),
+        ('make-band-cat','make-band-cat.py','band',8,8),
+        ('killms','killms.py','band',8,21),
+        ('subtract_image','subtract_image.py','band',16,48),
+        ('restore','restore.py','band',1,2),
+        ('convolve_combine','convolve_combine.py','global',4,16)]
+
+NSB=367
+NBANDS=37
+
+# the stage scripts live alongside this one
+SCRIPTDIR=os.path.dirname(os.path.abspath(__file__))
+
+def bs(band):
+    return '_B%02i' % band
+
+def band_subbands(band):
+    # as in makeband.py
+    return range(band*10,min(band*10+10,366))
+
+def task_argument(stage,number):
+    # calib.py takes a plain number as a block of sub-bands if
+    # subbandsperjob is set, so name the one sub-band explicitly
+    if stage=='calib':
+        return '%i-%i' % (number,number)
+    return str(number)
+
+class Task:
+    def __init__(self,stage,number,script,cpus,memory,output,deps):
+        self.stage=stage
+        self.number=number
+        self.script=script
+        self.cpus=cpus
+        self.memory=memory
+        self.output=output
+        self.deps=deps
+        self.state='waiting'
+
+    def name(self):
+        if self.number is None:
+            return self.stage
+        else:
+            return '%s-%i' % (self.stage,self.number)
+
+def outputs(cfg):
+
+    '''
+    Return a function giving the file whose existence shows that task
+    (stage,number) has completed, as checked by pipeline_supervisor.py.
+    '''
+
+    troot=cfg.get('files','target')
+    imagesuffix=cfg.get('imaging','suffix')
+    subimagesuffix=cfg.get('subtracted_image','suffix')
+    if cfg.getoption('imaging','domask',True):
+        add='_img_masked'
+    else:
+        add='_img'
+    if cfg.getoption('subtracted_image','domask',True):
+        subadd='_img_masked'
+    else:
+        subadd='_img'
+
+    def output(stage,n):
+        if stage=='calib':
+            return troot+'_SB%03i_uv.filter.MS' % n
+        elif stage=='makeband':
+            return troot+bs(n)+'_concat.MS'
+        elif stage=='apply-nvss-skymodel':
+            return troot+bs(n)+'_concat.MS/instrument'
+        elif stage=='image':
+            return troot+bs(n)+'_'+imagesuffix+add+'.restored.corr.fits'
+        elif stage=='make-band-cat':
+            return troot+bs(n)+'_'+imagesuffix+'_img.restored.fits.skymodel.filtered.npy'
+        elif stage=='killms':
+            return troot+bs(n)+'_killMS.MS_killMS.CohJones.sols.npz'
+        elif stage=='subtract_image':
+            return troot+bs(n)+'_'+subimagesuffix+subadd+'.restored.corr.fits'
+        elif stage=='restore':
+            return troot+bs(n)+'_'+subimagesuffix+'_img.restored.corr.sr.fits'
+        elif stage=='convolve_combine':
+            return 'adaptive-stack-0.fits'
+
+    return output
+
+def build_graph(cfg,stages):
+
+    '''
+    Make the tasks for all the stages, in pipeline order. Every task
+    depends on the task(s) of the previous stage that make its inputs.
+    Tasks of stages that are not selected are still created, so that
+    their outputs can be checked, but are never run.
+    '''
+
+    output=outputs(cfg)
+    restore=cfg.getoption('subtracted_image','restore',True)
+    tasks={}
+    order=[]
+    previous=None
+    for stage,script,unit,cpus,memory in STAGES:
+        if stage=='restore' and not(restore):
+            continue
+        if unit=='subband':
+            numbers=range(NSB)
+        elif unit=='band':
+            numbers=range(NBANDS)
+        else:
+            numbers=[None]
+        for n in numbers:
+            if previous is None:
+                deps=[]
+            elif unit=='global':
+                deps=[k for k in order if k[0]==previous]
+            elif previous=='calib':
+                deps=[(previous,sb) for sb in band_subbands(n)]
+            else:
+                deps=[(previous,n)]
+            t=Task(stage,n,script,cpus,memory,output(stage,n),deps)
+            if os.path.exists(t.output):
+                t.state='done'
+            elif stage not in stages:
+                t.state='missing'
+            tasks[(stage,n)]=t
+            order.append((stage,n))
+        previous=stage
+    return tasks,order
+
+def total_memory():
+    # in GB, allowing for any cgroup limit on this job
+    m=resources.memory()
+    if m is None:
+        return 0.0
+    return m/1073741824.0
+
+def start(t,configfile,cpus,logdir,forked=False):
+
+    '''
+    Start task t, returning its pid and Popen object. If forked is True
+    the task runs in a fork of this process (see worker.py) rather than
+    a new Python, and there is no Popen object.
+    '''
+
+    host=socket.gethostname()
+    nodefile=os.path.join(logdir,'nodefile-'+t.name())
+    f=open(nodefile,'w')
+    for i in range(cpus):
+        f.write(host+'\n')
+    f.close()
+    # the stage scripts size themselves with config.getcpus(), which
+    # reads PBS_NODEFILE, so give them a node file of their own
+    env=dict(os.environ)
+    env['PBS_NODEFILE']=nodefile
+    env['OMP_NUM_THREADS']=str(cpus)
+    # record every command run by the task (see config.runner)
+    env.setdefault('PIPELINE_LEDGER',os.path.join(logdir,'ledger'))
+    script=os.path.join(SCRIPTDIR,t.script)
+    args=[configfile]
+    if t.number is not None:
+        env['PBS_ARRAYID']=str(t.number)
+        args.append(task_argument(t.stage,t.number))
+    logfile=os.path.join(logdir,t.name()+'.log')
+    if forked:
+        return worker.fork_script(script,args,logfile,env),None
+    log=open(logfile,'w')
+    p=subprocess.Popen([sys.executable,script]+args,stdout=log,stderr=subprocess.STDOUT,env=env)
+    log.close()
+    return p.pid,p
+
+def run_graph(tasks,order,configfile,ncpu,memory,logdir,limits={},dryrun=False,forked=False):
+
+    '''
+    Run the waiting tasks, each as soon as its dependencies are done
+    and its CPUs and memory (capped at the totals) are free. At most
+    limits[stage] tasks of a stage run at once, if given. Later stages
+    are preferred so that bands are finished as early as possible.
+    Returns the list of tasks that failed or could not be run.
+    '''
+
+    rank=dict((s[0],i) for i,s in enumerate(STAGES))
+    running={}
+    freecpu=ncpu
+    freemem=memory
+    count=dict((s[0],0) for s in STAGES)
+    while True:
+        waiting=[k for k in order if tasks[k].state=='waiting']
+        ready=[]
+        for k in waiting:
+            t=tasks[k]
+            states=[tasks[d].state for d in t.deps]
+            if any(s in ('failed','blocked','missing') for s in states):
+                t.state='blocked'
+                config.warn('Not running '+t.name()+': inputs will not be made')
+            elif all(s=='done' for s in states):
+                ready.append(t)
+        ready.sort(key=lambda t:(-rank[t.stage],t.number))
+        for t in ready:
+            cpus=min(t.cpus,ncpu)
+            mem=min(t.memory,memory)
+            if cpus>freecpu or mem>freemem:
+                continue
+            if t.stage in limits and count[t.stage]>=limits[t.stage]:
+                continue
+            config.report('Starting '+t.name()+' with %i CPUs' % cpus)
+            pid,p=start(t,configfile,cpus,logdir,forked)
+            running[pid]=(t,p,cpus,mem,time.time())
+            t.state='running'
+            freecpu-=cpus
+            freemem-=mem
+            count[t.stage]+=1
+        if not(running):
+            # anything still waiting now can never be started
+            for k in order:
+                t=tasks[k]
+                if t.state=='waiting':
+                    t.state='blocked'
+                    config.warn('Not running '+t.name()+': it could not be scheduled')
+            break
+        pid,status=os.wait()
+        if pid not in running:
+            continue
+        t,p,cpus,mem,started=running.pop(pid)
+        if p is not None:
+            p.returncode=status
+        freecpu+=cpus
+        freemem+=mem
+        count[t.stage]-=1
+        if status!=0:
+            t.state='failed'
+            config.warn(t.name()+' FAILED, see '+os.path.join(logdir,t.name()+'.log'))
+        else:
+            t.state='done'
+            if not(dryrun) and not(os.path.exists(t.output)):
+                config.warn(t.name()+' finished but '+t.output+' does not exist')
+            config.report('Finished %s in %.1f s' % (t.name(),time.time()-started))
+
+    return [tasks[k] for k in order if tasks[k].state in ('failed','blocked')]
+
+if __name__=='__main__':
+
+    die=config.die
+    report=config.report
+    warn=config.warn
+
+    if len(sys.argv)<2:
+        die('Need a filename for config file')
+
+    filename=os.path.abspath(sys.argv[1])
+    if not(os.path.isfile(filename)):
+        die('Config file does not exist')
+
+    cfg=config.LocalConfigParser()
+    cfg.read(filename)
+
+    processedpath=cfg.get('paths','processed')
+    dryrun=cfg.getoption('control','dryrun',False)
+    os.chdir(processedpath)
+
+    try:
+        stages=[s.strip() for s in cfg.get('pipeline','stages').split(',')]
+    except (config.NoOptionError,config.NoSectionError):
+        stages=[s[0] for s in STAGES]
+    for s in stages:
+        if s not in [st[0] for st in STAGES]:
+            die('Unknown stage '+s)
+
+    try:
+        ncpu=int(cfg.get('pipeline','ncpu'))
+    except (config.NoOptionError,config.NoSectionError):
+        ncpu=config.getcpus()
+
+    try:
+        memory=float(cfg.get('pipeline','memory'))
+    except (config.NoOptionError,config.NoSectionError):
+        memory=total_memory()
+
+    try:
+        logdir=cfg.get('pipeline','logdir')
+    except (config.NoOptionError,config.NoSectionError):
+        logdir=os.path.join(processedpath,'logs')
+    if not(os.path.isdir(logdir)):
+        os.makedirs(logdir)
+
+    # optional per-stage caps on the number of concurrent tasks, e.g.
+    # image_max=2
+    limits={}
+    for s in stages:
+        try:
+            limits[s]=int(cfg.get('pipeline',s+'_max'))
+        except (config.NoOptionError,config.NoSectionError):
+            continue
+        if limits[s]<1:
+            die(s+'_max must be at least 1; leave '+s+' out of stages to skip it')
+
+    # import the scientific modules once and fork the tasks from this
+    # process, instead of starting a new Python for each
+    try:
+        forked=cfg.getboolean('pipeline','worker')
+    except (config.NoOptionError,config.NoSectionError):
+        forked=False
+    if forked:
+        report('Pre-imported '+', '.join(worker.preimport()))
+
+    tasks,order=build_graph(cfg,stages)
+    todo=[k for k in order if tasks[k].state=='waiting']
+    report('Running %i tasks on %i CPUs and %.0f GB' % (len(todo),ncpu,memory))
+
+    bad=run_graph(tasks,order,filename,ncpu,memory,logdir,limits,dryrun,forked)
+    if bad:
+        for t in bad:
+            warn(t.name()+' '+t.state)
+        die('%i tasks failed or could not be run' % len(bad))
+    report('All tasks done')
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+
+# Content-addressed record of how each pipeline product was made, so
+# that reruns can skip work whose inputs, config and command line have
+# not changed, and redo work whose inputs have. Enable it with
+#
+# [control]
+# stagecache=True
+#
+# Records live in <processed>/.stagecache, one JSON file per group of
+# products. Run this file on a config file to list stale products:
+#
+# stagecache.py example.cfg
+
+import os
+import sys
+import json
+import time
+import hashlib
+import config
+
+BUFSIZE=1024*1024
+
+def file_hash(path):
+    h=hashlib.sha1()
+    f=open(path,'rb')
+    while True:
+        data=f.read(BUFSIZE)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+def table_file(name):
+    # of a casacore table, only the description (table.dat) and the
+    # data (table.f*) count: table.lock is rewritten just by opening
+    # the table, and table.info holds nothing the products depend on
+    if name.startswith('table.'):
+        return name=='table.dat' or name.startswith('table.f')
+    return True
+
+def tree_hash(path):
+    # MeasurementSets are too big to read: hash the names, sizes and
+    # modification times of everything in the tree instead
+    h=hashlib.sha1()
+    for root,dirs,files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not(table_file(name)):
+                continue
+            full=os.path.join(root,name)
+            try:
+                st=os.stat(full)
+            except OSError:
+                continue
+            h.update('%s %i %.6f\n' % (os.path.relpath(full,path),st.st_size,st.st_mtime))
+    return h.hexdigest()
+
+def describe(path,previous=None):
+
+    '''
+    Return a dictionary describing input path. File contents are
+    hashed, unless previous (an earlier description) shows the size
+    and modification time to be unchanged, in which case its hash is
+    reused.
+    '''
+
+    entry={'path':path}
+    if not(os.path.exists(path)):
+        entry['hash']='missing'
+        return entry
+    st=os.stat(path)
+    entry['size']=st.st_size
+    entry['mtime']=st.st_mtime
+    if os.path.isdir(path):
+        entry['hash']=tree_hash(path)
+    elif previous is not None and previous.get('size')==st.st_size and previous.get('mtime')==st.st_mtime:
+        entry['hash']=previous['hash']
+    else:
+        entry['hash']=file_hash(path)
+    return entry
+
+class StageCache:
+
+    """
+    Decide whether products are up to date. With the cache disabled
+    (the default, or cfg=None) a product is up to date if it exists,
+    which is what the scripts have always done. With it enabled the
+    products must also have been recorded, by store(), as made from
+    inputs with the same content, the same values in the given config
+    sections and the same command.
+    """
+
+    def __init__(self,cfg=None):
+        self.cfg=cfg
+        if cfg is None:
+            self.enabled=False
+        else:
+            self.enabled=cfg.getoption('control','stagecache',False)
+            # nothing is made in a dry run, so nothing is recorded
+            self.dryrun=cfg.getoption('control','dryrun',False)
+            self.cachedir=os.path.join(cfg.get('paths','processed'),'.stagecache')
+
+    def config_values(self,sections):
+        values={}
+        for s in sections:
+            try:
+                values[s]=sorted(self.cfg.items(s,raw=True))
+            except config.NoSectionError:
+                values[s]=[]
+        return values
+
+    def recordname(self,products):
+        name=hashlib.sha1('\n'.join(sorted([os.path.abspath(p) for p in products]))).hexdigest()
+        return os.path.join(self.cachedir,name+'.json')
+
+    def load(self,products):
+        try:
+            return json.load(open(self.recordname(products)))
+        except (IOError,ValueError):
+            return None
+
+    def key(self,inputs,values,command):
+        return hashlib.sha1(json.dumps([[i['hash'] for i in inputs],values,command],sort_keys=True)).hexdigest()
+
+    def fresh(self,products,inputs,sections=[],command=''):
+        if not(all([os.path.exists(p) for p in products])):
+            return False
+        if not(self.enabled):
+            return True
+        record=self.load(products)
+        if record is None:
+            return False
+        previous=dict((i['path'],i) for i in record['inputs'])
+        described=[describe(os.path.abspath(p),previous.get(os.path.abspath(p))) for p in inputs]
+        return self.key(described,self.config_values(sections),command)==record['key']
+
+    def store(self,products,inputs,sections=[],command=''):
+        if not(self.enabled) or self.dryrun:
+            return
+        if not(os.path.isdir(self.cachedir)):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                # another job may have made it
+                pass
+        record=self.load(products)
+        previous={}
+        if record is not None:
+            previous=dict((i['path'],i) for i in record['inputs'])
+        described=[describe(os.path.abspath(p),previous.get(os.path.abspath(p))) for p in inputs]
+        values=self.config_values(sections)
+        record={'products':[os.path.abspath(p) for p in products],
+                'inputs':described,'config':values,'command':command,
+                'key':self.key(described,values,command),'time':time.time()}
+        name=self.recordname(products)
+        f=open(name+'.tmp','w')
+        json.dump(record,f)
+        f.close()
+        os.rename(name+'.tmp',name)
+
+    def status(self):
+
+        '''
+        Return a list of (products,reasons) for every recorded group of
+        products that is out of date. A group is also out of date if
+        any of its inputs is a product of an out-of-date group, so
+        everything downstream of a change is listed.
+        '''
+
+        records=[]
+        if os.path.isdir(self.cachedir):
+            for name in sorted(os.listdir(self.cachedir)):
+                if name.endswith('.json'):
+                    try:
+                        records.append(json.load(open(os.path.join(self.cachedir,name))))
+                    except ValueError:
+                        pass
+        stale={}
+        for r in records:
+            reasons=[]
+            for p in r['products']:
+                if not(os.path.exists(p)):
+                    reasons.append('missing '+p)
+            for i in r['inputs']:
+                if describe(i['path'],i)['hash']!=i['hash']:
+                    reasons.append('input changed: '+i['path'])
+            values=self.config_values(r['config'].keys())
+            for s in r['config']:
+                if [list(v) for v in values[s]]!=[list(v) for v in r['config'][s]]:
+                    reasons.append('config section ['+s+'] changed')
+            if reasons:
+                stale[tuple(r['products'])]=reasons
+        # propagate downstream until nothing changes
+        changed=True
+        while changed:
+            changed=False
+            staleproducts=set(p for ps in stale for p in ps)
+            for r in records:
+                ps=tuple(r['products'])
+                if ps in stale:
+                    continue
+                upstream=[i['path'] for i in r['inputs'] if i['path'] in staleproducts]
+                if upstream:
+                    stale[ps]=['upstream product out of date: '+u for u in upstream]
+                    changed=True
+        return [(list(ps),stale[ps]) for ps in sorted(stale)]
+
+if __name__=='__main__':
+
+    die=config.die
+    report=config.report
+    warn=config.warn
+
+    if len(sys.argv)<2:
+        die('Need a filename for config file')
+
+    filename=sys.argv[1]
+    if not(os.path.isfile(filename)):
+        die('Config file does not exist')
+
+    cfg=config.LocalConfigParser()
+    cfg.read(filename)
+
+    cache=StageCache(cfg)
+    if not(cache.enabled):
+        warn('stagecache is not enabled in the [control] section')
+    stale=cache.status()
+    for products,reasons in stale:
+        warn(', '.join([os.path.basename(p) for p in products]))
+        for r in reasons:
+            print '   ',r
+    report('%i product groups out of date' % len(stale))
@@ -4,16 +4,12 @@
 
 import sys
 import config
+import msview
+import wscan
 import os.path
-import pyrap.tables as pt
+import manifest
 import numpy as np
 
-def getfreq(ms):
-    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-    freq = t[0]['REF_FREQUENCY']
-    t.close()
-    return freq
-
 def do_image(run,ms,suffix,npix,cellsize,padding,niter,threshold,uvmin,uvmax,wmax,robust,mask=None):
     imgname=ms.replace('.MS','_'+suffix)
     c='awimager ms='+ms
@@ -55,7 +51,10 @@ troot=cfg.get('files','target')
 processedpath=cfg.get('paths','processed')
 os.chdir(processedpath)
 domask=cfg.getoption('subtracted_image','domask',True)
-run=config.runner(cfg.getoption('control','dryrun',False)).run
+dryrun=cfg.getoption('control','dryrun',False)
+run=config.runner(dryrun).run
+# select with casacore rather than copying with NDPPP
+usemsview=cfg.getoption('control','msviews',True)
 npix=cfg.get('subtracted_image','npix')
 cellsize=cfg.get('subtracted_image','cellsize')
 padding=cfg.get('subtracted_image','padding')
@@ -67,6 +66,9 @@ try:
 except:
     uvmax=None
 robust=cfg.get('subtracted_image','robust')
+# measure wmax from the data, and optionally adjust npix and padding to suit
+usewscan=cfg.getoption('subtracted_image','wscan',True)
+wscanresize=cfg.getoption('subtracted_image','wscan_resize',False)
 suffix=cfg.get('subtracted_image','suffix')
 cleanup=cfg.getoption('subtracted_image','cleanup',False)
 if domask:
@@ -81,7 +83,7 @@ if not(os.path.isfile(ms+'_Sols.pickle')) and not(os.path.isfile(ms+'_killMS.Coh
     die('Solutions don\'t exist, killms did not run?')
 
 if uvmax:
-    freq=getfreq(ms)
+    freq=manifest.getfreq(ms)
     uvmax*=np.sqrt(150e6/freq)
     uvmaxs='%.1f' % uvmax
     wmax=(3.0e8/freq)*uvmax*1.0e3
@@ -96,15 +98,38 @@ if os.path.isdir(ims):
 else:
     report('Copying file '+ms)
 
-    file=open('NDPPP-temp-'+bs,'w')
-    file.write('msin=['+ms+']\nmsin.datacolumn = CORRECTED_DATA\nmsin.baseline = [CR]S*&\nmsout = '+ims+'\nsteps = []\n')
-    file.close()
+    if usemsview:
+        # applybeam.py adds CORRECTED_DATA, so this has to be a real table
+        print msview.describe(ms,'CORRECTED_DATA')
+        if not(dryrun):
+            msview.materialise(ms,ims,'CORRECTED_DATA')
+    else:
+        file=open('NDPPP-temp-'+bs,'w')
+        file.write('msin=['+ms+']\nmsin.datacolumn = CORRECTED_DATA\nmsin.baseline = [CR]S*&\nmsout = '+ims+'\nsteps = []\n')
+        file.close()
 
-    run('NDPPP NDPPP-temp-'+bs)
+        run('NDPPP NDPPP-temp-'+bs)
 
     report('Applying beam')
     run('applybeam.py '+ims)
 
+if usewscan and not(dryrun):
+    report('Scanning w range of '+ims)
+    result=wscan.cached_scan(ims,uvmin,uvmaxs)
+    print wscan.describe(result)
+    if result['rows']==0:
+        warn('No data in the uv range, keeping wmax='+str(int(wmax)))
+    else:
+        measured,fftnpix,fftpadding=wscan.suggest(result,npix,padding)
+        # never keep data that the uv cut would have dropped before
+        wmax=min(wmax,measured)
+        print 'Using wmax',wmax
+        if wscanresize:
+            npix,padding=fftnpix,fftpadding
+            print 'Using npix',npix,'padding',padding
+        elif (fftnpix,wscan.grid_size(fftnpix,fftpadding))!=(npix,wscan.grid_size(npix,padding)):
+            print 'Suggest npix',fftnpix,'padding',fftpadding
+
 if domask:
     report('Doing initial unmasked image')
     do_image(run,ims,'img',npix,cellsize,padding,maskiter,threshold,uvmin,uvmaxs,wmax,robust,mask=None)
@@ -126,6 +151,12 @@ else:
 
 run('/home/mjh/lofar/bin/tofits.py '+imgname+'.restored')
 run('/home/mjh/lofar/bin/tofits.py '+imgname+'.restored.corr')
+if not(dryrun):
+    index=manifest.Manifest(processedpath)
+    index.record(imgname+'.restored.fits')
+    index.record(imgname+'.restored.corr.fits')
 
 if cleanup:
     run('rm -r '+ims)
+    if os.path.isfile(ims+'.wscan.json'):
+        run('rm '+ims+'.wscan.json')
@@ -0,0 +1,23 @@
+#!/usr/bin/python
+
+# Check which preflagger baseline strings flagengine.py takes over from
+# NDPPP: anything it cannot fully parse must come back as None
+
+import flagengine
+
+names=['CS001HBA0','CS001HBA1','CS002HBA0','RS106HBA','RS509HBA']
+
+for spec,result in [('[CS001HBA*, RS509HBA]',['CS001HBA*','RS509HBA']),
+                    ('CS002HBA0',['CS002HBA0']),
+                    ('[[CS001*,RS*]]',None),
+                    ('[[CS001*,RS*],[CS002*,RS*]]',None),
+                    ('[{CS001,CS002}HBA*]',None),
+                    ('[CS001HBA*,RS*]',['CS001HBA*','RS*']),
+                    ('[!CS001HBA*]',None),
+                    ('[CS001HBA*,DE601*]',None),
+                    ('[]',None)]:
+    patterns=flagengine.antenna_patterns(spec,names)
+    print spec,'->',patterns
+    assert patterns==result,spec
+
+print 'All OK'
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+# Sliding-window median filters for solution tables, used by
+# fit_clocktec_initialguess_losoto.py (amplitudes_losoto.py had its own
+# copies but never called them, so they were simply removed). The
+# filters work along the first (time) axis of 1-d or n-d arrays, so
+# e.g. a whole (time x antenna) table is cleaned in one call. The
+# edges are mirrored in the same way as the original per-sample loops.
+
+import numpy as np
+
+# number of window elements gathered at once
+BLOCKSIZE=1<<22
+
+def mirror(ampl,half_window):
+
+    '''
+    Return ampl (ndata x ncol) padded with half_window mirrored samples
+    at each end of the first axis.
+    '''
+
+    ndata=ampl.shape[0]
+    i=np.arange(half_window)
+    left=np.minimum(ndata-1,half_window-i)
+    right=np.maximum(0,ndata-2-i)
+    return np.concatenate((ampl[left],ampl,ampl[right])).astype(float)
+
+def gather(sol,rows,cols,width):
+
+    '''
+    Return the windows sol[rows[k]:rows[k]+width,cols[k]] as a
+    (len(rows) x width) array.
+    '''
+
+    return sol[rows[:,np.newaxis]+np.arange(width),cols[:,np.newaxis]]
+
+def masked_median(w,mask):
+
+    '''
+    Median along the last axis of w, ignoring elements where mask is
+    True. Gives the same values as numpy.median of the selected
+    elements, including NaN for windows that contain a NaN.
+    '''
+
+    n=np.sum(~mask,axis=-1)
+    s=np.sort(np.where(mask,np.inf,w),axis=-1)
+    lo=np.maximum((n-1)//2,0)
+    hi=np.maximum(n//2,0)
+    k=np.arange(len(s))
+    with np.errstate(invalid='ignore'):
+        med=0.5*(s[k,lo]+s[k,hi])
+    nans=np.any(np.isnan(w) & ~mask,axis=-1)
+    med[nans]=np.nan
+    return med
+
+def positions(ndata,ncol,select=None):
+
+    '''
+    Return (rows,cols) index arrays for all positions of an ndata x ncol
+    table, or for those where select is True.
+    '''
+
+    if select is None:
+        rows,cols=np.divmod(np.arange(ndata*ncol),ncol)
+    else:
+        rows,cols=np.nonzero(select)
+    return rows,cols
+
+def flag_outliers(sol,flags,rows,cols,half_window,threshold):
+
+    '''
+    Decide, for each position (rows[k],cols[k]) of the data, whether it
+    is more than threshold robust standard deviations from the median
+    of its window. As in the original sequential loop only the flags of
+    the earlier samples in the window are taken into account.
+    '''
+
+    width=2*half_window+1
+    earlier=np.arange(width)<half_window
+    result=np.zeros(len(rows),dtype=bool)
+    step=max(1,BLOCKSIZE//width)
+    for b in range(0,len(rows),step):
+        r=rows[b:b+step]
+        c=cols[b:b+step]
+        window=gather(sol,r,c,width)
+        mask=gather(flags,r,c,width) & earlier
+        median=masked_median(window,mask)
+        q=1.4826*masked_median(np.abs(window-median[:,np.newaxis]),mask)
+        # not enough data to get accurate statistics
+        enough=np.sum(~mask,axis=-1)>=np.sqrt(width)
+        with np.errstate(invalid='ignore'):
+            result[b:b+step]=enough & (np.abs(sol[r+half_window,c]-median)>threshold*q)
+    return result
+
+def median_window_filter(ampl,half_window,threshold):
+
+    '''
+    Replace samples that are more than 1.4826*threshold times the median
+    absolute deviation from the median of the 2*half_window+1 samples
+    around them by the median of the 2*half_window-1 samples around
+    them. A sample flagged in this way is left out of the statistics of
+    the later samples whose windows contain it, exactly as in the
+    original sample-by-sample loop; this is resolved by re-evaluating
+    only the samples whose earlier neighbours changed state until
+    nothing changes.
+    '''
+
+    ampl=np.asarray(ampl)
+    result=np.copy(ampl)
+    shape=ampl.shape
+    ndata=shape[0]
+    ncol=int(np.prod(shape[1:]))
+    sol=mirror(ampl.reshape(ndata,ncol),half_window)
+
+    # flags in padded coordinates; the mirrored samples are never flagged
+    flags=np.zeros(sol.shape,dtype=bool)
+    rows,cols=positions(ndata,ncol)
+    while len(rows)>0:
+        new=flag_outliers(sol,flags,rows,cols,half_window,threshold)
+        changed=np.zeros((ndata,ncol),dtype=bool)
+        changed[rows,cols]=(new!=flags[rows+half_window,cols])
+        flags[rows+half_window,cols]=new
+        # samples with a changed flag among their half_window
+        # predecessors must be evaluated again
+        count=np.concatenate((np.zeros((1,ncol),dtype=int),np.cumsum(changed,axis=0)))
+        start=np.maximum(np.arange(ndata)-half_window,0)
+        rows,cols=positions(ndata,ncol,(count[np.arange(ndata)]-count[start])>0)
+
+    rows,cols=np.nonzero(flags[half_window:half_window+ndata])
+    if len(rows)>0:
+        width=2*half_window-1
+        window=gather(sol,rows+1,cols,width)
+        replace=masked_median(window,np.zeros(window.shape,dtype=bool))
+        result.reshape(ndata,ncol)[rows,cols]=replace
+    return result
+
+def running_median(ampl,half_window):
+
+    '''
+    Return the median of the 2*half_window samples starting half_window
+    samples before each sample, along the first axis of ampl.
+    '''
+
+    ampl=np.asarray(ampl)
+    shape=ampl.shape
+    ndata=shape[0]
+    ncol=int(np.prod(shape[1:]))
+    sol=mirror(ampl.reshape(ndata,ncol),half_window)
+    width=2*half_window
+    rows,cols=positions(ndata,ncol)
+    std=np.zeros(ndata*ncol)
+    step=max(1,BLOCKSIZE//width)
+    for b in range(0,len(rows),step):
+        std[b:b+step]=np.median(gather(sol,rows[b:b+step],cols[b:b+step],width),axis=-1)
+    return std.reshape(shape)
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# Run many pipeline tasks from one Python process, so that pyrap,
+# astropy, lofar.bdsm, losoto etc. are imported (and their files read
+# over NFS) once rather than once per job. Each task runs its stage
+# script's main code in a child forked from the worker, which shares
+# the imported modules but cannot leave changed state (working
+# directory, globals, open files) behind for the next task.
+#
+# worker.py example.cfg calib:0-9 makeband:0 cutskymodel.py:model.txt,0.3
+#
+# A task is stage:numbers (a stage as in run_pipeline.py, with a
+# comma-separated list or range of sub-band/band numbers), or
+# script.py:args for any other script (comma-separated arguments, no
+# config file is added). With no tasks given they are read from
+# standard input, one per line. The time taken by each task is
+# reported, and appended to <logdir>/worker-timing.jsonl.
+
+import os
+import sys
+import time
+import json
+import runpy
+import traceback
+import config
+
+# the modules the stage scripts spend their start-up time importing;
+# pylab is left out as some scripts choose their own backend first
+PREIMPORT=['numpy','scipy','scipy.signal','scipy.ndimage','scipy.optimize',
+           'pyrap.tables','astropy.io.fits','astropy.wcs','astropy.table',
+           'numexpr','lofar.parmdb','lofar.bdsm','losoto.h5parm','tables',
+           'matplotlib']
+
+SCRIPTDIR=os.path.dirname(os.path.abspath(__file__))
+
+def preimport(modules=PREIMPORT):
+    '''
+    Import the given modules, ignoring any that are not installed.
+    Returns the list of those that were imported.
+    '''
+    loaded=[]
+    for m in modules:
+        try:
+            __import__(m)
+        except ImportError:
+            continue
+        loaded.append(m)
+    return loaded
+
+def run_script(script,args):
+    '''
+    Run script as if it had been started as 'script args', in this
+    process. Returns the exit status.
+    '''
+    sys.argv=[script]+list(args)
+    try:
+        runpy.run_path(script,run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        elif isinstance(e.code,int):
+            return e.code
+        else:
+            print e.code
+            return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def fork_script(script,args,logfile=None,env=None):
+    '''
+    Run script with args in a child of this process, with output to
+    logfile and os.environ updated from env if given. Returns the pid
+    of the child, to be waited for with os.wait or os.waitpid.
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid=os.fork()
+    if pid>0:
+        return pid
+    status=1
+    try:
+        if env is not None:
+            os.environ.update(env)
+        if logfile is not None:
+            fd=os.open(logfile,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0644)
+            os.dup2(fd,1)
+            os.dup2(fd,2)
+            os.close(fd)
+        status=run_script(script,args)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def parse_task(task,configfile):
+    '''
+    Return a list of (name,script,args) for a task description.
+    '''
+    import run_pipeline
+    if ':' in task:
+        what,rest=task.split(':',1)
+    else:
+        what,rest=task,''
+    scripts=dict((s[0],s[1]) for s in run_pipeline.STAGES)
+    if what in scripts:
+        script=os.path.join(SCRIPTDIR,scripts[what])
+        if rest=='':
+            return [(what,script,[configfile])]
+        numbers=[]
+        for r in rest.split(','):
+            if '-' in r:
+                first,last=r.split('-')
+                numbers+=range(int(first),int(last)+1)
+            else:
+                numbers.append(int(r))
+        return [('%s-%i' % (what,n),script,[configfile,run_pipeline.task_argument(what,n)]) for n in numbers]
+    else:
+        if not(os.path.isabs(what)) and not(os.path.exists(what)):
+            what=os.path.join(SCRIPTDIR,what)
+        if not(os.path.isfile(what)):
+            config.die('Unknown stage or script '+what)
+        args=[a for a in rest.split(',') if a!='']
+        return [(os.path.basename(what).replace('.py',''),what,args)]
+
+if __name__=='__main__':
+
+    die=config.die
+    report=config.report
+    warn=config.warn
+
+    if len(sys.argv)<2:
+        die('Need a filename for config file')
+
+    filename=os.path.abspath(sys.argv[1])
+    if not(os.path.isfile(filename)):
+        die('Config file does not exist')
+
+    cfg=config.LocalConfigParser()
+    cfg.read(filename)
+
+    processedpath=cfg.get('paths','processed')
+    try:
+        logdir=cfg.get('pipeline','logdir')
+    except (config.NoOptionError,config.NoSectionError):
+        logdir=os.path.join(processedpath,'logs')
+    if not(os.path.isdir(logdir)):
+        os.makedirs(logdir)
+
+    if len(sys.argv)>2:
+        descriptions=sys.argv[2:]
+    else:
+        descriptions=[l.strip() for l in sys.stdin.readlines() if l.strip()]
+    tasks=[]
+    for d in descriptions:
+        tasks+=parse_task(d,filename)
+
+    t0=time.time()
+    loaded=preimport()
+    report('Imported %s in %.1f s' % (', '.join(loaded),time.time()-t0))
+
+    timing=open(os.path.join(logdir,'worker-timing.jsonl'),'a')
+    failed=[]
+    for name,script,args in tasks:
+        os.chdir(processedpath)
+        start=time.time()
+        pid=fork_script(script,args,os.path.join(logdir,name+'.log'))
+        pid,status=os.waitpid(pid,0)
+        wall=time.time()-start
+        if status!=0:
+            failed.append(name)
+            warn('%s FAILED after %.2f s, see %s' % (name,wall,os.path.join(logdir,name+'.log')))
+        else:
+            report('%s done in %.2f s' % (name,wall))
+        timing.write(json.dumps({'task':name,'script':script,'args':args,'start':start,
+                                 'wall':wall,'status':status})+'\n')
+        timing.flush()
+    timing.close()
+
+    if failed:
+        die('%i tasks failed: %s' % (len(failed),', '.join(failed)))
+    report('All %i tasks done in %.1f s' % (len(tasks),time.time()-t0))
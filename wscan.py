@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# Measure the w range of an imaging MS, so that awimager is given the
+# wmax the data actually need rather than one worked out from the uv
+# cut (or a fixed 120 km). The UVW column is read once, in blocks,
+# keeping only unflagged cross-correlation rows that have some channel
+# inside the uv range to be imaged and, if the MS has not already been
+# cut down to them, are in the imaging baseline selection. The result, with a histogram of |w|
+# in wavelengths, is kept in <ms>.wscan.json so that a rerun on the
+# same MS and uv range does not read the MS again. Run this file on an
+# MS to print the scan:
+#
+# wscan.py MS [uvmin [uvmax [baselines]]]
+
+import os
+import sys
+import json
+import math
+import pyrap.tables as pt
+import numpy as np
+import msview
+
+C=299792458.0
+# rows read at once
+BLOCKSIZE=1<<20
+# width of the histogram bins, wavelengths
+WBIN=100.0
+
+def stamp(ms):
+    # enough to tell if the imaging MS has been remade
+    t=pt.table(ms,readonly=True,ack=False)
+    nrows=t.nrows()
+    if nrows>0:
+        times=[float(t.getcell('TIME',0)),float(t.getcell('TIME',nrows-1))]
+    else:
+        times=[]
+    t.close()
+    return {'nrows':nrows,'times':times}
+
+def scan(ms,uvmin=None,uvmax=None,baselines=None,blocksize=BLOCKSIZE):
+
+    '''
+    Scan the UVW column of ms. uvmin and uvmax are the uv range in
+    kilolambda, as given to awimager; baselines, if given, is a
+    baseline selection as used by msview.py. Returns a dictionary with the
+    largest |w| in metres (wmax, which is what awimager's wmax cuts
+    on) and in wavelengths (wmax_lambda), the largest uv distance in
+    wavelengths, the number of rows used, and a histogram of |w| in
+    wavelengths at the highest frequency each row is imaged at.
+    '''
+
+    t=pt.table(ms+'/SPECTRAL_WINDOW',readonly=True,ack=False)
+    freqs=t.getcell('CHAN_FREQ',0)
+    t.close()
+    fmin=float(np.min(freqs))
+    fmax=float(np.max(freqs))
+    lmin=0.0
+    if uvmin:
+        lmin=float(uvmin)*1e3
+    lmax=None
+    if uvmax:
+        lmax=float(uvmax)*1e3
+
+    t=pt.table(ms,readonly=True,ack=False)
+    if baselines:
+        sel=t.query(msview.baseline_selection(ms,baselines),columns='UVW,FLAG_ROW')
+        t.close()
+        t=sel
+    nrows=t.nrows()
+    counts=np.zeros(0,dtype=np.int64)
+    wmax=0.0
+    wmax_lambda=0.0
+    uvmax_lambda=0.0
+    used=0
+    for start in range(0,nrows,blocksize):
+        nr=min(blocksize,nrows-start)
+        uvw=t.getcol('UVW',start,nr)
+        flagrow=t.getcol('FLAG_ROW',start,nr)
+        uvd=np.sqrt(uvw[:,0]**2+uvw[:,1]**2)
+        ok=(uvd>0) & np.logical_not(flagrow)
+        # the channel range of each row that is inside the uv range
+        fhi=np.where(ok,fmax,0.0)
+        flo=np.where(ok,fmin,0.0)
+        if lmax is not None:
+            fhi=np.minimum(fhi,lmax*C/np.where(ok,uvd,1.0))
+        if lmin>0:
+            flo=np.maximum(flo,lmin*C/np.where(ok,uvd,1.0))
+        ok&=(flo<=fhi)
+        if not(np.any(ok)):
+            continue
+        w=np.abs(uvw[ok,2])
+        wl=w*fhi[ok]/C
+        used+=int(np.sum(ok))
+        wmax=max(wmax,float(np.max(w)))
+        wmax_lambda=max(wmax_lambda,float(np.max(wl)))
+        uvmax_lambda=max(uvmax_lambda,float(np.max(uvd[ok]*fhi[ok]/C)))
+        c=np.bincount((wl/WBIN).astype(np.int64))
+        if len(c)>len(counts):
+            counts=np.concatenate([counts,np.zeros(len(c)-len(counts),dtype=np.int64)])
+        counts[:len(c)]+=c
+    t.close()
+    return {'uvmin':uvmin,'uvmax':uvmax,'baselines':baselines,'rows':used,'wmax':wmax,
+            'wmax_lambda':wmax_lambda,'uvmax_lambda':uvmax_lambda,
+            'binwidth':WBIN,'histogram':[int(c) for c in counts]}
+
+def percentile(result,p):
+    # |w| in wavelengths below which fraction p of the rows lie
+    counts=np.array(result['histogram'])
+    if len(counts)==0:
+        return 0.0
+    cum=np.cumsum(counts)
+    i=int(np.searchsorted(cum,p*cum[-1]))
+    return (i+1)*result['binwidth']
+
+def cached_scan(ms,uvmin=None,uvmax=None,baselines=None):
+    '''
+    Return scan(ms,uvmin,uvmax,baselines), from <ms>.wscan.json if it
+    was made from the same MS with the same selection.
+    '''
+    cachefile=ms.rstrip('/')+'.wscan.json'
+    key={'uvmin':uvmin,'uvmax':uvmax,'baselines':baselines,'ms':stamp(ms)}
+    try:
+        cached=json.load(open(cachefile))
+        if cached['key']==json.loads(json.dumps(key)):
+            return cached['result']
+    except (IOError,ValueError,KeyError):
+        pass
+    result=scan(ms,uvmin,uvmax,baselines)
+    f=open(cachefile+'.tmp','w')
+    json.dump({'key':key,'result':result},f)
+    f.close()
+    os.rename(cachefile+'.tmp',cachefile)
+    return result
+
+def fft_size(n):
+    # smallest size >= n with no prime factors above 5
+    n=int(math.ceil(n))
+    while True:
+        m=n
+        for p in (2,3,5):
+            while m%p==0:
+                m//=p
+        if m==1:
+            return n
+        n+=1
+
+def grid_size(npix,padding):
+    # the padded grid awimager will use
+    return int(int(npix)*float(padding))
+
+def suggest(result,npix,padding):
+
+    '''
+    Return (wmax,npix,padding) for awimager from a scan and the
+    configured npix and padding (strings, as in the config file): wmax
+    in metres just above the largest |w| measured, npix raised to the
+    next size that FFTs well, and padding raised so that the padded
+    grid does too.
+    '''
+
+    wmax=int(math.ceil(result['wmax']*1.001+1))
+    n=fft_size(int(npix))
+    grid=fft_size(n*float(padding))
+    # awimager truncates npix*padding, so stay just above the grid size
+    return wmax,str(n),'%.6f' % ((grid+0.5)/n)
+
+def describe(result):
+    return 'measured |w| max %.0f m (%.0f lambda, 99%% below %.0f lambda) from %i rows, uv max %.0f lambda' % (result['wmax'],result['wmax_lambda'],percentile(result,0.99),result['rows'],result['uvmax_lambda'])
+
+if __name__=='__main__':
+
+    if len(sys.argv)<2:
+        print 'Usage: wscan.py MS [uvmin [uvmax [baselines]]]'
+        sys.exit(1)
+    uvmin=None
+    uvmax=None
+    baselines=None
+    if len(sys.argv)>2:
+        uvmin=float(sys.argv[2])
+    if len(sys.argv)>3:
+        uvmax=float(sys.argv[3])
+    if len(sys.argv)>4:
+        baselines=sys.argv[4]
+    result=cached_scan(sys.argv[1],uvmin,uvmax,baselines)
+    print describe(result)
+    counts=result['histogram']
+    step=max(1,len(counts)//20)
+    for i in range(0,len(counts),step):
+        print '%8.0f - %8.0f lambda: %i' % (i*result['binwidth'],(i+step)*result['binwidth'],sum(counts[i:i+step]))